@@ -1,27 +1,38 @@
+import json
 import os
 import shutil
 import traceback
 import uuid
 from datetime import timedelta, datetime
+from io import BytesIO
 
 import cv2
 import numpy as np
 from PIL import Image
 from flask import Flask, request, redirect, send_from_directory, render_template, send_file, url_for, \
-    session
+    session, jsonify, Response, stream_with_context
 from flask_apscheduler import APScheduler
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.utils import secure_filename
 
-from lib.ProPainter.inference_propainter import inpaint
+from lib.ProPainter.inference_propainter import get_engine, read_mask_images, EmptyMaskError
+from lib.ProPainter.utils.flow_cache import FlowCache
 from util.MiVOS_util import MiVOS_Manager
-from util.interactive_util import get_video_info, resize_and_save_frames, array_to_bytesio, compose_mask, \
-    convert_to_mp4, reduce_fps
+from util.frame_store import FrameStore
+from util.job_util import JobQueue, JobError, JobConflict, QueueFull, Job
+from util.model_util import registry, key_cache_budget
+from util.interactive_util import ingest_video, array_to_bytesio, compose_mask, mask_to_png
 from util.scribble_util import scale_points
 
 UPLOAD_FOLDER = 'app/uploads'  # Folder where images should be saved to
+FLOW_CACHE_FOLDER = 'app/flow_cache'  # Folder where optical flows are cached between inpainting runs
+FLOW_CACHE_SIZE_IN_MB = 512
+RAFT_TOLERANCE = 0.01  # RAFT stops refining once the mean flow update is below this (pixels at 1/8 resolution)
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'gif', 'mpeg', 'mov', 'webm', 'flv'}
 MAX_CONTENT_LENGTH_IN_MB = 3
+JOB_WORKERS = 2  # Number of propagation/inpainting jobs that run at the same time
+PER_REGION_INPAINTING = False  # Inpaint separate masked regions in separate crops, see eval_runtime --per_region
+KEY_CACHE_SIZE_IN_MB = 2048  # Memory the MiVOS key caches of all sessions may use together
 
 app = Flask(__name__, template_folder='app/template', static_folder='app/static')
 
@@ -35,8 +46,23 @@ if os.path.exists(UPLOAD_FOLDER):
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+if os.path.exists(FLOW_CACHE_FOLDER):
+    shutil.rmtree(FLOW_CACHE_FOLDER)
+
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH_IN_MB * 1024 * 1024  # Max file size
 manager_list = {}
+frame_stores = {}
+
+# Load the models once per process, every session shares them
+registry.warm_up()
+print(registry.report())
+inpainting_engine = get_engine()
+inpainting_engine.flow_cache = FlowCache(FLOW_CACHE_FOLDER, max_bytes=FLOW_CACHE_SIZE_IN_MB * 1024 * 1024)
+inpainting_engine.raft_tol = RAFT_TOLERANCE
+key_cache_budget.limit = KEY_CACHE_SIZE_IN_MB * 1024 * 1024
+
+# Propagation and inpainting run in the background, the client polls their progress
+job_queue = JobQueue(max_workers=JOB_WORKERS)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///videos.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -70,20 +96,49 @@ def delete_old_videos():
         old_videos = Video.query.filter(Video.timestamp < cutoff_time).all()
 
         for video in old_videos:
+            # Do not delete videos that are still being processed
+            if job_queue.is_active(video.id):
+                continue
+            frame_stores.pop(video.id, None)
             if os.path.exists(video.root_folder):
                 shutil.rmtree(video.root_folder)
                 print('Deleted folder: ' + video.id)
             if video.id in manager_list:
-                del manager_list[video.id]
+                manager_list.pop(video.id).close()
+            job_queue.discard(video.id)
+            inpainting_engine.forget(video.id)
             db.session.delete(video)
             db.session.commit()
             print('Deleted video with ID: ', video.id)
+        job_queue.expire()
 
 
 # Schedule the task to run every 10 minutes
 scheduler.add_job(id='delete_old_videos', func=delete_old_videos, trigger='interval', minutes=10)
 
 
+def get_frame_store(video):
+    """
+    :return: The frame store of a video, opened once and then shared by all requests
+    """
+    store = frame_stores.get(video.id)
+    if store is None:
+        store = FrameStore(os.path.join(video.root_folder, 'frames'))
+        frame_stores[video.id] = store
+    return store
+
+
+def get_manager(video):
+    """
+    :return: The MiVOS session of a video, a new one on its current frames if the last one was dropped
+    """
+    manager = manager_list.get(video.id)
+    if manager is None:
+        manager = MiVOS_Manager(get_frame_store(video).frames, warm_up=True, s2m_roi=True)
+        manager_list[video.id] = manager
+    return manager
+
+
 def renew_timestamp(video_id):
     video = Video.query.get(video_id)
     if video:
@@ -126,15 +181,19 @@ def upload_file():
             file_path = os.path.join(root_folder, video_name)
             file.save(file_path)
 
-            file_path = convert_to_mp4(file_path)
-            file_path = reduce_fps(file_path)
-
-            # Save frames
+            # Save frames, the video is decoded only once
             frame_folder = os.path.join(root_folder, 'frames')
-            resize_and_save_frames(file_path, frame_folder)
-            num_frames, fps = get_video_info(file_path)
-
-            video = Video(id=video_id, root_folder=root_folder, fps=fps, num_frames=num_frames,
+            try:
+                store = ingest_video(file_path, frame_folder)
+            except ValueError as e:
+                print('Upload error: ', e)
+                shutil.rmtree(root_folder)
+                session['message'] = 'Failed to read video'
+                return redirect(url_for('index'))
+            os.remove(file_path)  # The frames are all that is needed from now on
+
+            frame_stores[video_id] = store
+            video = Video(id=video_id, root_folder=root_folder, fps=store.fps, num_frames=store.num_frames,
                           timestamp=datetime.utcnow())
             db.session.add(video)
             db.session.commit()
@@ -142,11 +201,13 @@ def upload_file():
             # Create mask folder and create an empty mask image
             mask_folder = os.path.join(root_folder, 'masks')
             os.makedirs(mask_folder, exist_ok=True)
-            temp_img = Image.open(os.path.join(frame_folder, '00000.png'))
-            empty_img = Image.new("RGBA", temp_img.size, (0, 0, 0, 0))
+            empty_img = Image.new("RGBA", (store.width, store.height), (0, 0, 0, 0))
             empty_img.save(os.path.join(root_folder, 'empty.png'))
 
-            manager_list[video_id] = MiVOS_Manager(frame_folder)
+            manager_list[video_id] = MiVOS_Manager(store.frames, warm_up=True, s2m_roi=True)
+
+            # Compute the optical flow while the user is drawing the mask
+            inpainting_engine.precompute_flows(store.frames, video_id, generation=store.generation)
 
             return redirect(url_for('mask_page', video_id=video_id))
         else:
@@ -191,7 +252,11 @@ def get_frame(video_id, num):
     if not video:
         session['message'] = 'Session expired'
         return redirect(url_for('index'))
-    return send_from_directory(os.path.join(video.root_folder, 'frames'), '{:05}.png'.format(int(num)))
+    store = get_frame_store(video)
+    num = int(num)
+    if num < 0 or num >= store.num_frames:
+        return 'Frame not found', 404
+    return send_file(BytesIO(store.get_png(num)), mimetype='image/png')
 
 
 @app.route('/mask/<video_id>/<num>')
@@ -201,7 +266,13 @@ def get_mask(video_id, num):
         session['message'] = 'Session expired'
         return 'Session expired', 410
 
-    mask_path = os.path.join(video.root_folder, 'masks', '{:05}.png'.format(int(num)))
+    num = int(num)
+    manager = manager_list.get(video.id)
+    if request.args.get('job') and manager is not None and 0 <= num < manager.num_frames:
+        # Mask streamed by a propagation job, it is only written to the mask folder once the job has finished
+        return send_file(mask_to_png(manager.get_mask(num)), mimetype='image/png')
+
+    mask_path = os.path.join(video.root_folder, 'masks', '{:05}.png'.format(num))
     if os.path.exists(mask_path):
         image_path = mask_path
     else:
@@ -214,11 +285,16 @@ def get_mask(video_id, num):
 @app.route('/reset_interaction', methods=['POST'])
 def reset_interaction():
     data = request.get_json()
-    if not data['video_id'] in manager_list:
+    video = Video.query.get(data['video_id'])
+    if not video:
         session['message'] = 'Session expired'
         return 'Session expired', 410
-    renew_timestamp(data['video_id'])
-    manager_list[data['video_id']].reset_this_interaction()
+    renew_timestamp(video.id)
+    try:
+        with job_queue.exclusive(video.id):
+            get_manager(video).reset_this_interaction()
+    except JobConflict as e:
+        return job_running(e)
     return 'Reset interaction', 200
 
 
@@ -233,12 +309,16 @@ def reset():
     root_folder = video.root_folder
 
     renew_timestamp(video_id)
-    manager_list[video_id].on_reset()
+    try:
+        with job_queue.exclusive(video_id):
+            get_manager(video).on_reset()
 
-    # Delete mask file
-    mask_path = os.path.join(root_folder, 'masks', '{:05}.png'.format(int(data['frame_num'])))
-    if os.path.exists(mask_path):
-        os.remove(mask_path)
+            # Delete mask file
+            mask_path = os.path.join(root_folder, 'masks', '{:05}.png'.format(int(data['frame_num'])))
+            if os.path.exists(mask_path):
+                os.remove(mask_path)
+    except JobConflict as e:
+        return job_running(e)
 
     empty_image = os.path.join(root_folder, 'empty.png')
     return send_file(empty_image)
@@ -255,13 +335,17 @@ def undo():
     root_folder = video.root_folder
 
     renew_timestamp(video_id)
-    mask = manager_list[video_id].on_undo()
+    try:
+        with job_queue.exclusive(video_id):
+            mask = get_manager(video).on_undo()
 
-    mask_folder = os.path.join(root_folder, 'masks')
-    mask = compose_mask(mask)
+            mask_folder = os.path.join(root_folder, 'masks')
+            mask = compose_mask(mask)
 
-    img = Image.fromarray(mask)
-    img.save(os.path.join(mask_folder, '{:05d}.png'.format(data['frame_num'])))
+            img = Image.fromarray(mask)
+            img.save(os.path.join(mask_folder, '{:05d}.png'.format(data['frame_num'])))
+    except JobConflict as e:
+        return job_running(e)
 
     # Send current mask for instant feedback
     mask_io = array_to_bytesio(mask)
@@ -282,23 +366,16 @@ def save_video():
     root_folder = video.root_folder
     fps = video.fps
 
-    frame_folder = os.path.join(root_folder, 'frames')
-    frames = [f for f in os.listdir(frame_folder)]
-    frames.sort()
-
-    first_frame_path = os.path.join(frame_folder, frames[0])
-    frame = cv2.imread(first_frame_path)
-    height, width, layers = frame.shape
+    store = get_frame_store(video)
+    height, width = store.height, store.width
 
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
     output_path = os.path.join(root_folder, 'inpainted.mp4')
     video = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
 
     # Iterate over each frame and write it to the video
-    for f in frames:
-        frame_path = os.path.join(frame_folder, f)
-        frame = cv2.imread(frame_path)
-        video.write(frame)
+    for frame in store.frames:
+        video.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
     video.release()
     cv2.destroyAllWindows()
 
@@ -321,47 +398,135 @@ def s2m():
     # Scale drawing_points to image size
     h1 = data['height']
     w1 = data['width']
-    h2, w2 = manager_list[video_id].get_size()
-    drawing_points = scale_points(drawing_points, h1, w1, h2, w2)
-    mask = manager_list[video_id].on_drawn(drawing_points, data['frame_num'], int(data['k']))
+    try:
+        with job_queue.exclusive(video_id):
+            manager = get_manager(video)
+            h2, w2 = manager.get_size()
+            drawing_points = scale_points(drawing_points, h1, w1, h2, w2)
+            mask = manager.on_drawn(drawing_points, data['frame_num'], int(data['k']))
 
-    mask_folder = os.path.join(root_folder, 'masks')
-    mask = compose_mask(mask)
+            mask_folder = os.path.join(root_folder, 'masks')
+            mask = compose_mask(mask)
 
-    img = Image.fromarray(mask)
-    img.save(os.path.join(mask_folder, '{:05d}.png'.format(data['frame_num'])))
+            img = Image.fromarray(mask)
+            img.save(os.path.join(mask_folder, '{:05d}.png'.format(data['frame_num'])))
+    except JobConflict as e:
+        return job_running(e)
 
     # Return current mask for instant feedback
     mask_io = array_to_bytesio(mask)
     return send_file(mask_io, mimetype='image/png')
 
 
-@app.route('/propagate', methods=['POST'])
-def propagate():
-    data = request.get_json()
-    video = Video.query.get(data['video_id'])
-    if not video:
-        session['message'] = 'Session expired'
-        return 'Session expired', 410
-    video_id = video.id
-    root_folder = video.root_folder
+def run_propagation(job, video_id, manager, root_folder):
+    streamed = set()
 
-    renew_timestamp(video_id)
-    mask_list = manager_list[video_id].on_run()
+    def mask_event(frame_num):
+        # Only the url is sent, the mask is encoded when the client requests it and not on the propagation thread
+        return {'frame': frame_num, 'mask': '/mask/{}/{}?job={}'.format(video_id, frame_num, job.id)}
+
+    def on_frame(frame_num, changed):
+        job.step()
+        # Send every changed mask to the client as soon as it is final
+        if changed:
+            job.add_event(mask_event(frame_num))
+            streamed.add(frame_num)
+
+    mask_list = manager.on_run(total_cb=job.set_total, step_cb=on_frame)
 
     mask_folder = os.path.join(root_folder, 'masks')
     os.makedirs(mask_folder, exist_ok=True)
 
     if mask_list is None or len(mask_list) <= 0:
-        # flash('No mask available to propagate')
-        return 'Failed to get mask', 400
+        raise JobError('Failed to get mask', 400)
 
-    for i in range(len(mask_list)):
+    # Re-write the masks that changed, and every mask that is not on disk yet. Inpainting needs one mask per frame,
+    # an empty mask never counts as changed
+    changed = set(manager.changed_frames)
+    for i in sorted(changed | manager.unsaved_frames):
         img = compose_mask(mask_list[i])
         img = Image.fromarray(img)
         img.save(os.path.join(mask_folder, '{:05d}.png'.format(i)))
+        # The interacted frame is not propagated, but its mask can still change
+        if i in changed and i not in streamed:
+            job.add_event(mask_event(i))
+    manager.unsaved_frames.clear()
+
+    dirty_range = manager.dirty_range
+    if dirty_range is None:
+        return {'message': 'Propagated', 'start': 0, 'end': 0}
+    return {'message': 'Propagated', 'start': dirty_range[0], 'end': dirty_range[1]}
+
+
+def run_inpainting(job, video_id, store, root_folder, result_url):
+    try:
+        masks = read_mask_images(os.path.join(root_folder, 'masks'))
+        if len(masks) == 0:
+            raise EmptyMaskError('No mask to inpaint')
+        if len(masks) not in (1, store.num_frames):
+            raise JobError('Masks are incomplete, propagate the mask again', 400)
+        res_frames = inpainting_engine.inpaint(store.frames, masks,
+                                               per_region=PER_REGION_INPAINTING,
+                                               video_name=video_id,
+                                               cache_owner=video_id,
+                                               cache_generation=store.generation,
+                                               total_cb=job.set_total,
+                                               step_cb=job.step)
+        # The result is written into the frames the session and the precomputed flows were computed on.
+        # Drop both first, a new session is started on the inpainted frames when it is needed again
+        if video_id in manager_list:
+            manager_list.pop(video_id).close()
+        inpainting_engine.forget(video_id)
+        store.write_all(res_frames)
+    except (EmptyMaskError, FileNotFoundError):
+        raise JobError('No mask', 404)
+    except JobError:
+        raise
+    except Exception as e:
+        print('Inpainting error: ', e)
+        traceback.print_exc()
+        raise JobError('Inpainting error', 400)
+
+    return {'message': 'Inpainted', 'redirect': result_url}
+
+
+def job_running(e):
+    """
+    Response for requests that would change a video while a job is working on it
+    """
+    return jsonify(e.job.to_dict()), 409
+
+
+def submit_job(video_id, kind, fn, *args):
+    """
+    Queues a job for a video and returns the response containing its id
+    """
+    try:
+        job = job_queue.submit(video_id, kind, fn, *args)
+    except JobConflict as e:
+        return jsonify(e.job.to_dict()), 409
+    except QueueFull:
+        return 'Server busy', 503
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/propagate', methods=['POST'])
+def propagate():
+    data = request.get_json()
+    video = Video.query.get(data['video_id'])
+    if not video:
+        session['message'] = 'Session expired'
+        return 'Session expired', 410
+    video_id = video.id
+    root_folder = video.root_folder
 
-    return 'Propagated', 200
+    renew_timestamp(video_id)
+    try:
+        with job_queue.exclusive(video_id):
+            # Submitted before the section ends, so no scribble or reset can change the session in between
+            return submit_job(video_id, 'propagate', run_propagation, video_id, get_manager(video), root_folder)
+    except JobConflict as e:
+        return job_running(e)
 
 
 @app.route('/inpaint', methods=['POST'])
@@ -375,19 +540,65 @@ def inpaint_video():
     root_folder = video.root_folder
 
     renew_timestamp(video_id)
+    # url_for needs the request context, which the worker thread does not have
+    result_url = url_for('result_page', video_id=video_id)
+    return submit_job(video_id, 'inpaint', run_inpainting, video_id, get_frame_store(video), root_folder,
+                      result_url)
+
+
+@app.route('/job/<job_id>')
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return 'Job not found', 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/job/<job_id>/events')
+def get_job_events(job_id):
+    """
+    Streams the partial results of a job as server-sent events.
+    A final 'done' event contains the status and the result or error of the job.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return 'Job not found', 404
+
+    def stream():
+        num_sent = 0
+        while True:
+            events, active = job.wait_for_events(num_sent)
+            for event in events:
+                yield 'data: ' + json.dumps(event) + '\n\n'
+            num_sent += len(events)
+            if not active and len(events) == 0:
+                break
+            # Progress of the job, this also keeps the connection alive
+            yield 'event: progress\ndata: ' + json.dumps(job.to_dict()) + '\n\n'
+
+        done = job.to_dict()
+        if job.status == Job.FAILED:
+            done['status_code'] = job.status_code
+        else:
+            done['result'] = job.result
+        yield 'event: done\ndata: ' + json.dumps(done) + '\n\n'
+        job_queue.mark_fetched(job)
 
-    try:
-        inpaint(os.path.join(root_folder, 'frames'),
-                os.path.join(root_folder, 'masks'),
-                os.path.join(root_folder, 'frames'))
-    except TypeError:
-        return 'No mask', 404
-    except Exception as e:
-        print('Inpainting error: ', e)
-        traceback.print_exc()
-        return 'Inpainting error', 400
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-    return redirect(url_for('result_page', video_id=video_id))
+
+@app.route('/job/<job_id>/result')
+def get_job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return 'Job not found', 404
+    if job.active:
+        return jsonify(job.to_dict()), 202
+    job_queue.mark_fetched(job)
+    if job.status == Job.FAILED:
+        return job.error, job.status_code
+    return jsonify(job.result)
 
 
 @app.route('/again', methods=['POST'])
@@ -402,13 +613,21 @@ def inpaint_again():
 
     renew_timestamp(video_id)
     mask_folder = os.path.join(root_folder, 'masks')
-    frame_folder = os.path.join(root_folder, 'frames')
-    # Delete masks
-    if os.path.exists(mask_folder):
-        shutil.rmtree(mask_folder)
-        os.makedirs(mask_folder, exist_ok=True)
-    # initialise frame
-    manager_list[video_id] = MiVOS_Manager(frame_folder)
+    store = get_frame_store(video)
+    try:
+        with job_queue.exclusive(video_id):
+            # Delete masks
+            if os.path.exists(mask_folder):
+                shutil.rmtree(mask_folder)
+                os.makedirs(mask_folder, exist_ok=True)
+            # initialise frame
+            if video_id in manager_list:
+                manager_list[video_id].close()
+            manager_list[video_id] = MiVOS_Manager(store.frames, warm_up=True, s2m_roi=True)
+            # The frames now contain the previous result, their flow has to be computed again
+            inpainting_engine.precompute_flows(store.frames, video_id, generation=store.generation)
+    except JobConflict as e:
+        return job_running(e)
     return redirect(url_for('mask_page', video_id=video_id))
 
 
@@ -172,6 +172,10 @@ function reset_scribble() {
             window.location.href = '/';
             return;
         }
+        if (response.status === 409) {
+            show_alert('Wait until the running job has finished');
+            return;
+        }
         if (!response.ok) {
             console.error('Failed to get mask.');
             return;
@@ -254,6 +258,10 @@ function upload_drawing() {
             window.location.href = '/';
             return;
         }
+        if (response.status === 409) {
+            show_alert('Wait until the running job has finished');
+            return;
+        }
         if (!response.ok) {
             console.error('Failed to get mask.');
             return;
@@ -272,17 +280,106 @@ function upload_drawing() {
     undo_button.disabled = false;
 }
 
-function propagate() {
-    disable_buttons();
-    undo_button.disabled = true;
+/*
+    Polls a background job until it has finished and returns its result
+ */
+function wait_for_job(job_id, on_progress) {
+    return new Promise((resolve, reject) => {
+        let poll = () => {
+            fetch('/job/' + job_id).then(response => {
+                if (!response.ok) {
+                    throw new Error('Job not found');
+                }
+                return response.json();
+            }).then(job => {
+                if (job.status === 'queued' || job.status === 'running') {
+                    if (on_progress) {
+                        on_progress(job);
+                    }
+                    setTimeout(poll, 500);
+                    return;
+                }
+                return fetch('/job/' + job_id + '/result').then(response => {
+                    if (!response.ok) {
+                        reject(response);
+                        return;
+                    }
+                    response.json().then(resolve);
+                });
+            }).catch(reject);
+        };
+        poll();
+    });
+}
+
+/*
+    Receives the partial results of a background job as server-sent events until it has finished.
+    If streaming is not possible, the job is polled instead and the result has streamed set to false.
+ */
+function stream_job(job_id, on_event, on_progress) {
+    let poll = () => wait_for_job(job_id, on_progress).then(result => {
+        result.streamed = false;
+        return result;
+    });
+    if (!window.EventSource) {
+        return poll();
+    }
+    return new Promise((resolve, reject) => {
+        let source = new EventSource('/job/' + job_id + '/events');
+        let finished = false;
+        source.onmessage = event => on_event(JSON.parse(event.data));
+        source.addEventListener('progress', event => {
+            if (on_progress) {
+                on_progress(JSON.parse(event.data));
+            }
+        });
+        source.addEventListener('done', event => {
+            finished = true;
+            source.close();
+            let job = JSON.parse(event.data);
+            if (job.status === 'failed') {
+                reject(job);
+            } else {
+                resolve(job.result);
+            }
+        });
+        source.onerror = () => {
+            if (finished) {
+                return;
+            }
+            // Fall back to polling, e.g. if a proxy does not support streaming
+            source.close();
+            poll().then(resolve, reject);
+        };
+    });
+}
+
+function start_timer() {
     let startTime = Date.now();
     let timer = document.getElementById('timer');
+    let progress = '';
     let intervalId = setInterval(function () {
         let elapsed = ((Date.now() - startTime) / 1000).toFixed(2);
-        timer.textContent = `Time Elapsed: ${elapsed} seconds`;
+        timer.textContent = `Time Elapsed: ${elapsed} seconds` + progress;
     }, 100);
+    return {
+        set_progress(job) {
+            progress = (job.total > 0) ? ` (${job.done}/${job.total})` : '';
+        },
+        stop() {
+            clearInterval(intervalId);
+            let totalDuration = ((Date.now() - startTime) / 1000).toFixed(2);
+            timer.textContent = `Time Elapsed: ${totalDuration} seconds`;
+        }
+    };
+}
 
-    // Send the image data to the server
+function propagate() {
+    disable_buttons();
+    undo_button.disabled = true;
+    let timer = start_timer();
+
+    // Start the propagation on the server
     fetch('/propagate', {
         method: 'POST',
         headers: {
@@ -296,22 +393,32 @@ function propagate() {
             window.location.href = '/';
             return;
         }
-
-        clearInterval(intervalId);
-        let totalDuration = ((Date.now() - startTime) / 1000).toFixed(2);
-        timer.textContent = `Time Elapsed: ${totalDuration} seconds`;
-
         if (!response.ok) {
-            console.error('Failed to get mask.');
-            show_alert('First draw a mask to propagate');
-            enable_buttons();
+            throw response;
+        }
+        return response.json();
+    }).then(job => {
+        if (job) {
+            // Show every mask as soon as it has been propagated
+            return stream_job(job.job_id, event => {
+                slideshow.masks[event.frame] = event.mask;
+                if (event.frame === slideshow.current_frame) {
+                    slideshow.update_slideshow();
+                }
+            }, timer.set_progress);
+        }
+    }).then(result => {
+        timer.stop();
+        // Only the masks in the changed range have to be fetched again if they were not streamed
+        if (result && result.streamed === false) {
+            slideshow.load_masks(result.start, result.end).then(r => slideshow.update_slideshow());
         }
-    }).then(response => {
-        slideshow.load_masks().then(r => slideshow.update_slideshow());
         enable_buttons();
     }).catch(error => {
-        clearInterval(intervalId);
-        console.error('Error saving image:', error);
+        timer.stop();
+        console.error('Failed to get mask.', error);
+        show_alert('First draw a mask to propagate');
+        enable_buttons();
     });
 }
 
@@ -332,6 +439,10 @@ function undo() {
             window.location.href = '/';
             return;
         }
+        if (response.status === 409) {
+            show_alert('Wait until the running job has finished');
+            return;
+        }
         if (!response.ok) {
             console.error('Failed to get mask.');
             return;
@@ -357,13 +468,7 @@ function undo() {
 function inpaint() {
     disable_buttons();
     undo_button.disabled = true;
-
-    let startTime = Date.now();
-    let timer = document.getElementById('timer');
-    let intervalId = setInterval(function () {
-        let elapsed = ((Date.now() - startTime) / 1000).toFixed(2);
-        timer.textContent = `Time Elapsed: ${elapsed} seconds`;
-    }, 100);
+    let timer = start_timer();
 
     fetch('/inpaint', {
         method: 'POST',
@@ -373,31 +478,34 @@ function inpaint() {
         body: JSON.stringify({
             video_id: video_id
         })
-    }).then((response) => {
-        if (response.redirected) {
-            window.location.href = response.url;
-        }
-        clearInterval(intervalId);
-        let totalDuration = ((Date.now() - startTime) / 1000).toFixed(2);
-        timer.textContent = `Time Elapsed: ${totalDuration} seconds`;
-
+    }).then(response => {
         if (response.status === 410) {
             window.location.href = '/';
             return;
         }
         if (!response.ok) {
-            console.error('Failed to inpaint.');
-            if (response.status === 404) {
-                show_alert('No mask to inpaint');
-            } else {
-                show_alert('Error: Inpainting failed')
-            }
+            throw response;
+        }
+        return response.json();
+    }).then(job => {
+        if (job) {
+            return wait_for_job(job.job_id, timer.set_progress);
+        }
+    }).then(result => {
+        timer.stop();
+        if (result) {
+            window.location.href = result.redirect;
+        }
+    }).catch(error => {
+        timer.stop();
+        console.error('Failed to inpaint.', error);
+        if (error.status === 404) {
+            show_alert('No mask to inpaint');
+        } else {
+            show_alert('Error: Inpainting failed');
         }
         enable_buttons();
         undo_button.disabled = false;
-    }).catch(error => {
-        clearInterval(intervalId);
-        console.error('Error inpainting:', error);
     });
 }
 
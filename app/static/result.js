@@ -37,6 +37,10 @@ function again() {
             video_id: video_id
         })
     }).then((response) => {
+        if (response.status === 409) {
+            // The video is still being processed
+            return;
+        }
         if (!response.ok) {
             window.location.href = '/';
         }
@@ -38,10 +38,13 @@ class Slideshow {
 
     }
 
-    load_masks() {
+    /*
+        Fetches the masks of the frames in [start, end), all masks by default
+     */
+    load_masks(start = 0, end = this.num_frames) {
         let promise = Promise.resolve();  // Start with a resolved promise
 
-        for (let i = 0; i < num_frames; i++) {
+        for (let i = start; i < end; i++) {
             promise = promise
                 .then(() => fetch('/mask/' + String(this.video_id) + '/' + String(i)))
                 .then(response => response.blob())
@@ -29,6 +29,8 @@ parser.add_argument('--single_object', action='store_true',
 parser.add_argument('--eval_each_object', action='store_true',
                     help='Run evaluation same as reported in MiVOS paper. For multiple objects, evaluate each mask, then take their average.')
 
+parser.add_argument('--mem_slots', type=int, default=None,
+                    help='Cap the number of propagated memories, compare the summary with an uncapped run for the accuracy delta')
 args = parser.parse_args()
 
 davis_path = args.davis
@@ -89,7 +91,8 @@ with DavisInteractiveSession(davis_root=davis_path, report_save_dir=out_path, ma
                 # Note that ALL pre-computed features are flushed in this step
                 # We are not using pre-computed features for the same sequence with different user-id
                 del processor  # Should release some juicy mem
-            processor = DAVISProcessor(prop_model, fusion_model, s2m_model, images[sequence], num_objects[sequence])
+            processor = DAVISProcessor(prop_model, fusion_model, s2m_model, images[sequence], num_objects[sequence],
+                                       mem_slots=args.mem_slots)
             print(sequence)
 
             # Save last time
@@ -125,3 +128,8 @@ with DavisInteractiveSession(davis_root=davis_path, report_save_dir=out_path, ma
 
     report = sess.get_report()
     summary = sess.get_global_summary(save_file=path.join(out_path, 'summary.json'))
+
+# Compare these numbers between runs with and without --mem_slots for the accuracy delta of the capped memory bank
+print('Memory slots:', args.mem_slots if args.mem_slots is not None else 'unlimited')
+print('AUC:', summary['auc'])
+print('Metric at threshold:', summary['metric_at_threshold'])
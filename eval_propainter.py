@@ -10,9 +10,9 @@ from PIL import Image
 import torch
 from torch.utils.data import DataLoader
 
-from lib.ProPainter.model.modules.flow_comp_raft import RAFT_bi
-from lib.ProPainter.model.recurrent_flow_completion import RecurrentFlowCompleteNet
-from lib.ProPainter.model.propainter import InpaintGenerator
+from lib.ProPainter.inference_propainter import InpaintingEngine, get_flow_size, resize_clip, crop_flows
+from lib.ProPainter.utils.flow_cache import quantize_flows, dequantize_flows, round_trip_epe
+from lib.ProPainter.utils.flow_util import resize_flow_pytorch
 
 # from core.dataset import TestDataset
 from lib.ProPainter.core.dataset import TestDataset
@@ -34,6 +34,28 @@ def get_ref_index(neighbor_ids, length, ref_stride=10):
     return ref_index
 
 
+def crop_flow_epe(engine, full_frames, flows_bi, top_left, crop_size, raft_iter):
+    """
+    End-point error between flows computed on the crop and the flows the app uses for the crop instead: computed on
+    the whole frame, quantized like in the flow cache, then cropped and resized
+    :param full_frames: Uncropped frames from the data loader, uint8 tensors of shape (1, H, W, 3)
+    :param flows_bi: Forward and backward flows computed on the crop, shape (1, T - 1, 2, h, w)
+    :return: Mean end-point error in pixels of the crop flow resolution, and the mean error of the quantization
+             round trip alone in pixels of the full frame
+    """
+    frames = torch.cat(full_frames, dim=0).permute(0, 3, 1, 2).float() / 255 * 2 - 1
+    height, width = frames.shape[-2:]
+    full_flows = engine.compute_flows(frames.unsqueeze(0).to(engine.device), raft_iter)
+    quantized = [quantize_flows(f[0]) for f in full_flows]
+    quantization_epe = sum(round_trip_epe(f[0], q)[0] for f, q in zip(full_flows, quantized)) / 2
+    full_flows = tuple(dequantize_flows(*q).unsqueeze(0) for q in quantized)
+    flow_h, flow_w = flows_bi[0].shape[-2:]
+    bottom_right = (top_left[0] + crop_size[0] - 1, top_left[1] + crop_size[1] - 1)
+    cropped = crop_flows(full_flows, (width, height), top_left, bottom_right, (flow_w, flow_h))
+    epe = [torch.norm(c - f.float().cpu(), dim=2).mean() for c, f in zip(cropped, flows_bi)]
+    return float(sum(epe) / len(epe)), quantization_epe
+
+
 def main_worker(args):
     args.size = (args.width, args.height)
     w, h = args.size
@@ -47,20 +69,17 @@ def main_worker(args):
 
     # set up models
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    fix_raft = RAFT_bi(args.raft_model_path, device)
-
-    fix_flow_complete = RecurrentFlowCompleteNet(args.fc_model_path)
-    for p in fix_flow_complete.parameters():
-        p.requires_grad = False
-    fix_flow_complete.to(device)
-    fix_flow_complete.eval()
-
-    model = InpaintGenerator(model_path=args.propainter_model_path).to(device)
-    model.eval()
+    engine = InpaintingEngine(device, raft_path=args.raft_model_path, flow_complete_path=args.fc_model_path,
+                              propainter_path=args.propainter_model_path)
+    fix_raft = engine.fix_raft
+    fix_flow_complete, model = engine.get_models()
 
     time_all = []
+    epe_all = []
 
     print('Start evaluation ...')
+    if args.flow_scale < 1.0:
+        print('Flow size:', get_flow_size(args.size, args.flow_scale))
     result_path = args.output
     if not os.path.exists(result_path):
         os.makedirs(result_path, exist_ok=True)
@@ -100,17 +119,24 @@ def main_worker(args):
         torch.cuda.synchronize()
         time_start = time()
 
+        flow_w, flow_h = get_flow_size((w, h), args.flow_scale)
+        low_res_flow = (flow_w, flow_h) != (w, h)
         with torch.no_grad():
+            if low_res_flow:
+                flow_frames = resize_clip(frames, (flow_w, flow_h))
+                flow_masks = (resize_clip(masks, (flow_w, flow_h)) > 0).float()
+            else:
+                flow_frames, flow_masks = frames, masks
+
             # ---- compute flow ----
             short_len = 60
             if frames.size(1) > short_len:
                 gt_flows_f_list, gt_flows_b_list = [], []
+                feats = None
                 for f in range(0, video_length, short_len):
                     end_f = min(video_length, f + short_len)
-                    if f == 0:
-                        flows_f, flows_b = fix_raft(frames[:, f:end_f], iters=args.raft_iter)
-                    else:
-                        flows_f, flows_b = fix_raft(frames[:, f - 1:end_f], iters=args.raft_iter)
+                    flows_f, flows_b, feats = fix_raft(flow_frames[:, f:end_f], iters=args.raft_iter,
+                                                       prev_feats=feats, return_feats=True, tol=args.raft_tol)
 
                     gt_flows_f_list.append(flows_f)
                     gt_flows_b_list.append(flows_b)
@@ -118,11 +144,13 @@ def main_worker(args):
                     gt_flows_b = torch.cat(gt_flows_b_list, dim=1)
                     gt_flows_bi = (gt_flows_f, gt_flows_b)
             else:
-                gt_flows_bi = fix_raft(frames, iters=args.raft_iter)
+                gt_flows_bi = fix_raft(flow_frames, iters=args.raft_iter, tol=args.raft_tol)
 
             # ---- complete flow ----
-            pred_flows_bi, _ = fix_flow_complete.forward_bidirect_flow(gt_flows_bi, masks)
-            pred_flows_bi = fix_flow_complete.combine_flow(gt_flows_bi, pred_flows_bi, masks)
+            pred_flows_bi, _ = fix_flow_complete.forward_bidirect_flow(gt_flows_bi, flow_masks)
+            pred_flows_bi = fix_flow_complete.combine_flow(gt_flows_bi, pred_flows_bi, flow_masks)
+            if low_res_flow:
+                pred_flows_bi = tuple(resize_flow_pytorch(f, h, w) for f in pred_flows_bi)
 
             # ---- temporal propagation ----
             prop_imgs, updated_local_masks = model.img_propagation(masked_frames, pred_flows_bi, masks, 'nearest')
@@ -131,7 +159,9 @@ def main_worker(args):
             updated_masks = updated_local_masks.view(b, t, 1, h, w)
             updated_frames = frames * (1 - masks) + prop_imgs.view(b, t, 3, h, w) * masks  # merge
 
-            del gt_flows_bi, frames, updated_local_masks
+            # Kept for the flow comparison, which is not timed
+            crop_gt_flows_bi = gt_flows_bi if args.crop_flow_epe and args.bounding_box else None
+            del gt_flows_bi, frames, flow_frames, flow_masks, updated_local_masks
             torch.cuda.empty_cache()
 
         ori_frames = frames_PIL
@@ -193,6 +223,15 @@ def main_worker(args):
         time_i = time() - time_start
         time_i = time_i * 1.0 / video_length
         time_all.append(time_i)
+        if crop_gt_flows_bi is not None:
+            epe, quantization_epe = crop_flow_epe(engine, full_frames, crop_gt_flows_bi, top_left, crop_size,
+                                                  args.raft_iter)
+            epe_all.append(epe)
+            print(f'Crop flow EPE of cached full-frame flows: {epe:.4f} | Avg: {sum(epe_all) / len(epe_all):.4f} '
+                  f'| Quantization round trip EPE: {quantization_epe:.5f}')
+            del crop_gt_flows_bi
+        # Mean RAFT iterations per frame pair over all videos so far
+        raft_iters = fix_raft.iteration_stats()['mean_iters']
 
         if args.task == 'video_completion':
             # calculate metrics
@@ -233,16 +272,17 @@ def main_worker(args):
             avg_time = sum(time_all) / len(time_all)
             print(
                 f'[{index + 1:3}/{len(test_loader)}] Name: {str(video_name):25} | PSNR/SSIM: {cur_psnr:.4f}/{cur_ssim:.4f} \
-                    | Avg PSNR/SSIM: {avg_psnr:.4f}/{avg_ssim:.4f} | Time: {avg_time:.4f}'
+                    | Avg PSNR/SSIM: {avg_psnr:.4f}/{avg_ssim:.4f} | Time: {avg_time:.4f} | RAFT iters: {raft_iters:.1f}'
             )
             eval_summary.write(
                 f'[{index + 1:3}/{len(test_loader)}] Name: {str(video_name):25} | PSNR/SSIM: {cur_psnr:.4f}/{cur_ssim:.4f} \
-                    | Avg PSNR/SSIM: {avg_psnr:.4f}/{avg_ssim:.4f} | Time: {avg_time:.4f}\n'
+                    | Avg PSNR/SSIM: {avg_psnr:.4f}/{avg_ssim:.4f} | Time: {avg_time:.4f} | RAFT iters: {raft_iters:.1f}\n'
             )
         else:
             avg_time = sum(time_all) / len(time_all)
             print(
-                f'[{index + 1:3}/{len(test_loader)}] Name: {str(video_name):25} | Time: {avg_time:.4f}'
+                f'[{index + 1:3}/{len(test_loader)}] Name: {str(video_name):25} | Time: {avg_time:.4f} '
+                f'| RAFT iters: {raft_iters:.1f}'
             )
 
         # saving images for evaluating warping errors
@@ -262,10 +302,14 @@ def main_worker(args):
 
         fid_score = calculate_vfid(real_i3d_activations, output_i3d_activations)
         print('Finish evaluation... Average Frame PSNR/SSIM/VFID: '
-              f'{avg_frame_psnr:.2f}/{avg_frame_ssim:.4f}/{fid_score:.3f} | Time: {avg_time:.4f}')
+              f'{avg_frame_psnr:.2f}/{avg_frame_ssim:.4f}/{fid_score:.3f} | Time: {avg_time:.4f} '
+              f'| RAFT iters: {raft_iters:.1f} | Flow scale: {args.flow_scale}')
         eval_summary.write(
             'Finish evaluation... Average Frame PSNR/SSIM/VFID: '
-            f'{avg_frame_psnr:.2f}/{avg_frame_ssim:.4f}/{fid_score:.3f} | Time: {avg_time:.4f}')
+            f'{avg_frame_psnr:.2f}/{avg_frame_ssim:.4f}/{fid_score:.3f} | Time: {avg_time:.4f} '
+            f'| RAFT iters: {raft_iters:.1f} | Flow scale: {args.flow_scale}')
+        if len(epe_all) > 0:
+            eval_summary.write(f'\nAverage crop flow EPE of cached full-frame flows: {sum(epe_all) / len(epe_all):.4f}')
         eval_summary.close()
     else:
         print('Finish evaluation... Time: {avg_time:.4f}')
@@ -278,6 +322,10 @@ if __name__ == '__main__':
     parser.add_argument("--ref_stride", type=int, default=10)
     parser.add_argument("--neighbor_length", type=int, default=20)
     parser.add_argument("--raft_iter", type=int, default=20)
+    parser.add_argument("--raft_tol", type=float, default=None,
+                        help='Stop RAFT early once the mean flow update is below this tolerance, raft_iter is the cap')
+    parser.add_argument("--flow_scale", type=float, default=1.0,
+                        help='Estimate and complete the flow at this fraction of the process size')
     parser.add_argument('--task', default='video_completion', choices=['object_removal', 'video_completion'])
     parser.add_argument('--raft_model_path', default='saves/raft_things.pth', type=str)
     parser.add_argument('--fc_model_path', default='saves/recurrent_flow_completion.pth', type=str)
@@ -288,6 +336,9 @@ if __name__ == '__main__':
     parser.add_argument('--save_results', action='store_true')
     parser.add_argument('--num_workers', default=4, type=int)
     parser.add_argument('--bounding_box', action='store_true')
+    parser.add_argument('--crop_flow_epe', action='store_true',
+                        help='With --bounding_box, compare the flow computed on the crop against cropped full-frame '
+                             'flows that went through the flow cache')
 
     args = parser.parse_args()
     main_worker(args)
@@ -8,9 +8,10 @@ from argparse import ArgumentParser
 import numpy as np
 from PIL import Image
 
-from lib.ProPainter.inference_propainter import inpaint
+from lib.ProPainter.inference_propainter import inpaint, InpaintingEngine
 from util.MiVOS_util import MiVOS_Manager
 from util.interactive_util import compose_mask
+from util.model_util import registry
 
 """
 Arguments loading
@@ -18,7 +19,15 @@ Arguments loading
 parser = ArgumentParser()
 parser.add_argument('--dataset', default='datasets/runtime_dataset')
 parser.add_argument('--bounding_box', action='store_true')
+parser.add_argument('--per_region', action='store_true', help='Inpaint separate masked regions in separate crops')
 parser.add_argument('--single_object', action='store_true')
+parser.add_argument('--s2m_roi', action='store_true', help='Run S2M on a region around the scribbles')
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'bf16', 'auto'],
+                    help='Precision of the MiVOS networks, masks are compared against fp32 if it is not fp32')
+parser.add_argument('--raft_tol', type=float, default=None,
+                    help='Stop RAFT early once the mean flow update is below this tolerance')
+parser.add_argument('--key_batch_size', type=int, default=None,
+                    help='Frames per key encoding pass, 1 to compare against unbatched encoding')
 parser.add_argument('--output')
 args = parser.parse_args()
 
@@ -26,6 +35,11 @@ dataset_path = args.dataset
 output_path = args.output
 os.makedirs(output_path, exist_ok=True)
 
+# Load the models before measuring, like the app does on startup
+registry.warm_up()
+print(registry.report())
+inpainting_engine = InpaintingEngine(raft_tol=args.raft_tol)
+
 resolution_path = os.path.join(dataset_path, 'JPEGImages', '480p')
 frames_path = os.path.join(dataset_path, 'JPEGImages', 'Frames1000')
 resolutions = [144, 240, 360, 480]
@@ -56,9 +70,11 @@ def change_num_frames(folder_path, num_frames, out_path):
     return
 
 
-def eval_video_runtime(image_folder, out_path, folder):
-    mask_start_time = time.time()
-
+def segment_video(image_folder, precision):
+    """
+    Draws the scribbles of the video and propagates them
+    :return: The propagated masks and the key cache stats of the session
+    """
     scribble_path = os.path.join(dataset_path, 'Scribbles', video + '.json')
     with open(scribble_path, 'r') as file:
         data = json.load(file)
@@ -67,7 +83,8 @@ def eval_video_runtime(image_folder, out_path, folder):
         num_obj = 1
     else:
         num_obj = data['num_objects']
-    manager = MiVOS_Manager(image_folder, num_objects=num_obj)
+    manager = MiVOS_Manager(image_folder, num_objects=num_obj, precision=precision, s2m_roi=args.s2m_roi,
+                            key_batch_size=args.key_batch_size)
     height, width = manager.get_size()
 
     scribbles = data['scribbles']
@@ -83,7 +100,29 @@ def eval_video_runtime(image_folder, out_path, folder):
         mask = manager.on_drawn(scaled_path, num_frame, obj_id)
 
     # Propagation
-    mask_list = manager.on_run()
+    masks = manager.on_run().copy()
+    key_stats = manager.processor.cache_stats()
+    # Return the key cache to the shared budget for the next video
+    manager.close()
+    return masks, key_stats
+
+
+def mask_iou(masks, reference_masks):
+    """
+    :return: Mean IoU of the masked pixels over all frames, frames that are empty in both count as 1
+    """
+    ious = []
+    for m, r in zip(masks, reference_masks):
+        union = np.logical_or(m > 0, r > 0).sum()
+        intersection = np.logical_and(m > 0, r > 0).sum()
+        ious.append(intersection / union if union > 0 else 1.0)
+    return float(np.mean(ious))
+
+
+def eval_video_runtime(image_folder, out_path, folder):
+    mask_start_time = time.time()
+
+    mask_list, key_stats = segment_video(image_folder, args.precision)
 
     # Always save masks to simulate actual pipeline
     mask_path = os.path.join(out_path, 'Masks', folder, video)
@@ -95,19 +134,31 @@ def eval_video_runtime(image_folder, out_path, folder):
 
     mask_end_time = time.time()
     mask_runtime = mask_end_time - mask_start_time
+
+    # Accuracy of reduced precision, compared to full precision masks (not timed)
+    iou = None
+    if args.precision != 'fp32':
+        iou = mask_iou(mask_list, segment_video(image_folder, 'fp32')[0])
+
+    inpainting_engine.fix_raft.reset_iteration_stats()
     inpaint_start_time = time.time()
 
     # Inpaint and save images
     inpaint(image_folder,
             mask_path,
             os.path.join(out_path, 'Inpaint', folder, video),
-            bounding_box=args.bounding_box)
+            bounding_box=args.bounding_box,
+            per_region=args.per_region,
+            engine=inpainting_engine)
 
     inpaint_end_time = time.time()
     inpaint_runtime = inpaint_end_time - inpaint_start_time
     inpaint_runtime_per_frame = inpaint_runtime / len(os.listdir(image_folder))
     mask_runtime_per_frame = mask_runtime / len(os.listdir(image_folder))
-    return mask_runtime, inpaint_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame
+    raft_iters = inpainting_engine.fix_raft.iteration_stats()['mean_iters']
+    key_encodes = (key_stats['batched_encodes'], key_stats['single_encodes'])
+    return mask_runtime, inpaint_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame, iou, raft_iters, \
+        key_encodes
 
 
 def write_summary(file, details_list, resolution=None, num_frames=None):
@@ -130,18 +181,28 @@ def write_summary(file, details_list, resolution=None, num_frames=None):
     print(title, ', Average time: ', round(average_time, 2), ' seconds\n')
 
     # Write results to text file
-    file.write(title + '\n')
-    for name, _, _, total, m, i in video_details_list:
+    file.write(title + ', Precision: ' + args.precision + ', Per region: ' + str(args.per_region) + '\n')
+    for name, _, _, total, m, i, _, raft_iters, key_encodes in video_details_list:
         f.write(f'Video: {name.ljust(20)}'
                 f'Video segmentation time per frame: {str(round(m, 3)).ljust(6)} seconds, '
                 f'Inpainting time per frame: {str(round(i, 3)).ljust(6)} seconds, '
-                f'Total time: {str(round(total, 3)).ljust(6)} seconds\n')
+                f'Total time: {str(round(total, 3)).ljust(6)} seconds, '
+                f'RAFT iterations per frame pair: {round(raft_iters, 1)}, '
+                f'Key encodes batched/single: {key_encodes[0]}/{key_encodes[1]}\n')
 
     f.write('Average Total Time: ' + str(round(average_time, 3)) + ' seconds\n')
     f.write('Average Video Segmentation Time: ' + str(round(average_mask_time, 3)) + ' seconds\n')
     f.write('Average Inpainting Time: ' + str(round(average_inpaint_time, 3)) + ' seconds\n')
     f.write('Average Video Segmentation Time per frame: ' + str(round(average_mask_per_frame_time, 3)) + ' seconds\n')
     f.write('Average Inpainting Time per frame: ' + str(round(average_inpaint_per_frame_time, 3)) + ' seconds\n')
+    f.write('Average RAFT iterations per frame pair: ' + str(round(statistics.mean([t[7] for t in details_list]), 1)) +
+            '\n')
+    f.write('Key encodes batched/single: ' + str(sum(t[8][0] for t in details_list)) + '/' +
+            str(sum(t[8][1] for t in details_list)) + '\n')
+    iou_list = [t[6] for t in details_list if t[6] is not None]
+    if len(iou_list) > 0:
+        f.write('Precision: ' + args.precision + ', Average mask IoU vs fp32: ' +
+                str(round(statistics.mean(iou_list), 4)) + '\n')
     f.write('\n')
 
 with open(os.path.join(output_path, 'summary.txt'), 'w') as f:
@@ -161,12 +222,13 @@ with open(os.path.join(output_path, 'summary.txt'), 'w') as f:
 
             resize_images(video_path, res, temp_path)
 
-            mask_runtime, inpaint_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame = eval_video_runtime(temp_path, output_path, str(res) + 'p')
+            mask_runtime, inpaint_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame, iou, raft_iters, \
+                key_encodes = eval_video_runtime(temp_path, output_path, str(res) + 'p')
 
             # Delete temp folder
             shutil.rmtree(temp_path)
             total_runtime = inpaint_runtime + mask_runtime
-            video_details_list.append((video, mask_runtime, inpaint_runtime, total_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame))
+            video_details_list.append((video, mask_runtime, inpaint_runtime, total_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame, iou, raft_iters, key_encodes))
 
             print('Video: ', video, ', Time: ', round(total_runtime, 2), ' seconds\n')
         write_summary(f, video_details_list, resolution=res)
@@ -181,12 +243,13 @@ with open(os.path.join(output_path, 'summary.txt'), 'w') as f:
             print('Evaluating ' + video + ' on #Frames: ' + str(n))
 
             change_num_frames(video_path, n, temp_path)
-            mask_runtime, inpaint_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame = eval_video_runtime(temp_path, output_path, 'Frames' + str(n))
+            mask_runtime, inpaint_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame, iou, raft_iters, \
+                key_encodes = eval_video_runtime(temp_path, output_path, 'Frames' + str(n))
 
             # Delete temp folder
             shutil.rmtree(temp_path)
             total_runtime = inpaint_runtime + mask_runtime
-            video_details_list.append((video, mask_runtime, inpaint_runtime, total_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame))
+            video_details_list.append((video, mask_runtime, inpaint_runtime, total_runtime, mask_runtime_per_frame, inpaint_runtime_per_frame, iou, raft_iters, key_encodes))
 
             print('Video: ', video, ', Time: ', round(total_runtime, 2), ' seconds\n')
         write_summary(f, video_details_list, num_frames=n)
@@ -13,7 +13,7 @@ class DAVISProcessor:
     Acts as the junction between DAVIS interactive track and our inference_core
     """
 
-    def __init__(self, prop_net, fuse_net, s2m_net, images, num_objects, device='cuda:0'):
+    def __init__(self, prop_net, fuse_net, s2m_net, images, num_objects, device='cuda:0', mem_slots=None):
         self.s2m_net = s2m_net.to(device, non_blocking=True)
 
         images, self.pad = pad_divide_by(images, 16, images.shape[-2:])
@@ -33,7 +33,8 @@ class DAVISProcessor:
         self.interacted_count = 0
         self.davis_schedule = [2, 5, 7]
 
-        self.processor = InferenceCore(prop_net, fuse_net, images, num_objects, mem_profile=0, device=device)
+        self.processor = InferenceCore(prop_net, fuse_net, images, num_objects, mem_profile=0, device=device,
+                                       mem_slots=mem_slots)
 
     def to_mask(self, scribble, single_object=False):
         # First we select the only frame with scribble
@@ -64,7 +65,7 @@ class DAVISProcessor:
 
             # Use hard mask because we train S2M with such
             inputs = torch.cat([self.processor.get_image_buffered(idx),
-                                (self.processor.masks[idx] == ki).to(self.device).float().unsqueeze(0), Rs], 1)
+                                (self.processor.get_hard_mask(idx) == ki).float().unsqueeze(0), Rs], 1)
             mask[ki - 1] = torch.sigmoid(self.s2m_net(inputs))
         mask = aggregate_wbg(mask, keep_bg=True, hard=True)
         return mask, idx
@@ -4,19 +4,63 @@ Handles propagation and fusion
 See eval_semi_davis.py / eval_interactive_davis.py for examples
 """
 
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import torch
 
+from lib.MiVOS_STCN.dataset.range_transform import im_normalization
 from lib.MiVOS_STCN.model.aggregate import aggregate_wbg
 from lib.MiVOS_STCN.model.fusion_net import FusionNet
 from lib.MiVOS_STCN.model.propagation.prop_net import PropagationNetwork
-from lib.MiVOS_STCN.util.tensor_util import pad_divide_by
+from lib.MiVOS_STCN.util.tensor_util import pad_divide_by, get_pad_array, unpad_3dim
+
+
+def key_feat_bytes(nh, nw, element_size=4):
+    """
+    Estimated size of the encode_key features of one padded nh*nw frame
+    k16 (64) + f16_thin (512) + f16 (1024) channels at 1/16, f8 (512) at 1/8 and f4 (256) at 1/4 resolution
+    """
+    elements = 1600 * (nh//16) * (nw//16) + 512 * (nh//8) * (nw//8) + 256 * (nh//4) * (nw//4)
+    return elements * element_size
+
+
+class KeyCacheBudget:
+    """
+    Memory budget shared by the key caches of all sessions in a process, so that the caches of concurrent sessions
+    together stay below limit bytes
+
+    warm_up_fraction - Part of the budget that background warm-ups may fill, the rest is left for propagation
+    """
+    def __init__(self, limit, warm_up_fraction=0.5):
+        self.limit = limit
+        self.warm_up_fraction = warm_up_fraction
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size, warm_up=False):
+        """
+        Return: True if size bytes were reserved, False if they do not fit
+        """
+        limit = self.limit * self.warm_up_fraction if warm_up else self.limit
+        with self._lock:
+            if self.used + size > limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
 
 
 class InferenceCore:
     """
-    images - leave them in original dimension (unpadded), but do normalize them. 
-            Should be CPU tensors of shape B*T*3*H*W
+    images - Either uint8 RGB frames of shape T*H*W*3 (numpy array, may be a memmap) or
+            normalized float tensors of shape B*T*3*H*W, in original dimension (unpadded).
+            uint8 frames are kept as they are (no copy) and only normalized and padded when a frame is accessed,
+            which needs a quarter of the memory of the float tensors
             
     mem_profile - How extravagant I can use the GPU memory. 
                 Usually more memory -> faster speed but I have not drawn the exact relation
@@ -30,92 +74,331 @@ class InferenceCore:
     mem_freq - Period at which new memory are put in the bank
                 Higher number -> less memory usage
                 Unlike the last option, this *is* a space-performance tradeoff
+
+    key_cache_bytes - Upper limit of the key feature cache of this session, chosen by mem_profile if None.
+                The budget is sized from the video (frames * features per frame) and capped at this limit.
+                The least recently used features are evicted first
+
+    key_cache_budget - KeyCacheBudget shared with the other sessions of the process, no shared limit if None
+
+    key_batch_size - Number of frames whose keys are encoded together ahead of the propagation,
+                chosen by mem_profile if None
+
+    memory_dtype - Data type of the memory bank keys/values, e.g. torch.bfloat16 to halve its size when running
+                with reduced precision
+
+    obj_batch_size - Maximum number of objects that go through the memory readout, decoder and fusion in one
+                forward pass, all objects at once if None. Lower it to bound the memory usage with many objects
+
+    mem_slots - Maximum number of propagated memories in the bank, None for no limit.
+                The memories of interacted frames are always kept, once the slots are full the oldest propagated
+                memory is replaced. This keeps the cost per frame constant on long videos
+
+    prob_dtype - Storage type of the object probabilities, they are converted to float32 per frame on access
+                torch.float16 - Half the size of float32, the default
+                torch.uint8 - Quantized to 1/255 steps, a quarter of the size of float32
+                torch.float32 - Exact
     """
     def __init__(self, prop_net:PropagationNetwork, fuse_net:FusionNet, images, num_objects, 
-                    mem_profile=0, mem_freq=5, device='cuda:0'):
+                    mem_profile=0, mem_freq=5, device='cuda:0', key_cache_bytes=None, key_batch_size=None,
+                    mem_slots=None, memory_dtype=torch.float32, obj_batch_size=None, prob_dtype=torch.float16,
+                    key_cache_budget=None):
         self.prop_net = prop_net.to(device, non_blocking=True)
         if fuse_net is not None:
             self.fuse_net = fuse_net.to(device, non_blocking=True)
         self.mem_profile = mem_profile
         self.mem_freq = mem_freq
+        self.mem_slots = mem_slots
+        self.memory_dtype = memory_dtype
+        self.obj_batch_size = obj_batch_size
         self.device = device
 
         if mem_profile == 0:
             self.data_dev = device
             self.result_dev = device
-            self.k_buf_size = 105
-            self.i_buf_size = -1 # no need to buffer image
+            self.k_buf_bytes = 4 * 1024**3
+            self.k_batch_size = 8
+            self.i_buf_size = 8
         elif mem_profile == 1:
             self.data_dev = 'cpu'
             self.result_dev = device
-            self.k_buf_size = 105
+            self.k_buf_bytes = 4 * 1024**3
+            self.k_batch_size = 8
             self.i_buf_size = 105
         elif mem_profile == 2:
             self.data_dev = 'cpu'
             self.result_dev = 'cpu'
-            self.k_buf_size = 3
+            self.k_buf_bytes = 256 * 1024**2
+            self.k_batch_size = 4
             self.i_buf_size = 3
         else:
             self.data_dev = 'cpu'
             self.result_dev = 'cpu'
-            self.k_buf_size = 1
+            self.k_buf_bytes = 0 # only the last frame
+            self.k_batch_size = 1
             self.i_buf_size = 1
+        if key_cache_bytes is not None:
+            self.k_buf_bytes = key_cache_bytes
+        if key_batch_size is not None:
+            self.k_batch_size = key_batch_size
 
-        # True dimensions
-        t = images.shape[1]
-        h, w = images.shape[-2:]
         self.k = num_objects
-
-        # Pad each side to multiples of 16
-        self.images, self.pad = pad_divide_by(images, 16, images.shape[-2:])
-        # Padded dimensions
-        nh, nw = self.images.shape[-2:]
-        self.images = self.images.to(self.data_dev, non_blocking=False)
-
-        # These two store the same information in different formats
-        self.masks = torch.zeros((t, 1, nh, nw), dtype=torch.uint8, device=self.result_dev)
+        if isinstance(images, np.ndarray) or images.dtype == torch.uint8:
+            # True dimensions
+            t, h, w = images.shape[:3]
+            self.frames = images
+            self.images = None
+            # Padding of each side to multiples of 16
+            self.pad = get_pad_array(h, w, 16)
+            nh, nw = h + self.pad[2] + self.pad[3], w + self.pad[0] + self.pad[1]
+        else:
+            # True dimensions
+            t = images.shape[1]
+            h, w = images.shape[-2:]
+
+            # Pad each side to multiples of 16
+            self.frames = None
+            self.images, self.pad = pad_divide_by(images, 16, images.shape[-2:])
+            # Padded dimensions
+            nh, nw = self.images.shape[-2:]
+            self.images = self.images.to(self.data_dev, non_blocking=False)
+
+        # Hard masks (unpadded), the only copy. masks is a tensor view of np_masks, use get_hard_mask for the
+        # padded mask of a frame
         self.np_masks = np.zeros((t, h, w), dtype=np.uint8)
+        self.masks = torch.from_numpy(self.np_masks)
 
-        # Object probabilities, background included
-        self.prob = torch.zeros((self.k+1, t, 1, nh, nw), dtype=torch.float32, device=self.result_dev)
-        self.prob[0] = 1e-7
+        # Object probabilities, background included. Read/written with get_prob/set_prob
+        self.prob = torch.zeros((self.k+1, t, 1, nh, nw), dtype=prob_dtype, device=self.result_dev)
+        self.prob[0] = self._encode_prob(torch.tensor(1e-7))
 
         self.t, self.h, self.w = t, h, w
         self.nh, self.nw = nh, nw
         self.kh = self.nh//16
         self.kw = self.nw//16
 
-        self.key_buf = {}
-        self.image_buf = {}
+        # No point in a budget larger than the features of the whole video
+        self.k_buf_bytes = min(self.k_buf_bytes, t * key_feat_bytes(nh, nw))
+        self.key_cache_budget = key_cache_budget
+
+        # LRU caches, least recently used first
+        self.key_buf = OrderedDict()
+        self.key_buf_used = 0
+        self.image_buf = OrderedDict()
+        self.key_hits = 0
+        self.key_misses = 0
+        # Frames whose keys were encoded in a batch / alone
+        self.batched_encodes = 0
+        self.single_encodes = 0
+        self._buf_lock = threading.RLock()
+        self._warm_up_thread = None
+        self._warm_up_stop = threading.Event()
+        self._closed = False
         self.interacted = set()
 
+        # Frames whose hard mask changed in the last interact call, see interact
+        self.changed_frames = []
+
         self.certain_mem_k = None
         self.certain_mem_v = None
 
+    def load_images(self, indices):
+        """
+        Normalized and padded frames on the device, N*3*nh*nw
+        """
+        if self.images is not None:
+            return torch.cat([self.images[:,ti] for ti in indices], 0).to(self.device)
+
+        frames = np.stack([self.frames[ti] for ti in indices], 0)
+        frames = torch.from_numpy(frames).to(self.device).permute(0, 3, 1, 2).float() / 255
+        frames, _ = pad_divide_by(im_normalization(frames), 16, (self.h, self.w))
+        return frames
+
+    def _encode_prob(self, prob):
+        if self.prob.dtype == torch.uint8:
+            return (prob * 255).round().clamp(0, 255)
+        return prob
+
+    def get_prob(self, ti):
+        """
+        Probabilities of a frame as float32 on the device, (k+1)*1*nh*nw
+        """
+        prob = self.prob[:,ti].to(self.device).float()
+        if self.prob.dtype == torch.uint8:
+            prob /= 255
+        return prob
+
+    def set_prob(self, ti, prob):
+        self.prob[:,ti] = self._encode_prob(prob).to(self.result_dev)
+
+    def get_hard_mask(self, ti):
+        """
+        Hard mask of a frame, padded like the images, 1*nh*nw on the device
+        """
+        mask = self.masks[ti].to(self.device).unsqueeze(0)
+        mask, _ = pad_divide_by(mask, 16, (self.h, self.w))
+        return mask
+
+    def memory_footprint(self):
+        """
+        Return: Memory used by the session state in bytes. The frames are not included if they were passed in as
+                uint8, as they are shared with the caller
+        """
+        def size(t):
+            return t.numel() * t.element_size()
+
+        footprint = {'prob': size(self.prob), 'masks': self.np_masks.nbytes}
+        footprint['images'] = size(self.images) if self.images is not None else 0
+        with self._buf_lock:
+            footprint['key_cache'] = self.key_buf_used
+            footprint['image_cache'] = sum(size(i) for i in self.image_buf.values())
+        footprint['memory_bank'] = 0
+        if self.certain_mem_k is not None:
+            footprint['memory_bank'] = size(self.certain_mem_k) + size(self.certain_mem_v)
+        footprint['total'] = sum(footprint.values())
+        return footprint
+
     def get_image_buffered(self, idx):
-        if self.data_dev == self.device:
+        if self.images is not None and self.data_dev == self.device:
             return self.images[:,idx]
 
-        # buffer the .cuda() calls
-        if idx not in self.image_buf:
-            # Flush buffer
-            if len(self.image_buf) > self.i_buf_size:
-                self.image_buf = {}
-        self.image_buf[idx] = self.images[:,idx].to(self.device)
-        result = self.image_buf[idx]
-
+        # buffer the .cuda() calls and the normalization
+        with self._buf_lock:
+            result = self.image_buf.get(idx)
+            if result is not None:
+                self.image_buf.move_to_end(idx)
+                return result
+
+        result = self.load_images([idx])
+        with self._buf_lock:
+            self.image_buf[idx] = result
+            while len(self.image_buf) > max(self.i_buf_size, 1):
+                self.image_buf.popitem(last=False)
         return result
 
     def get_key_feat_buffered(self, idx):
-        if idx not in self.key_buf:
-            # Flush buffer
-            if len(self.key_buf) > self.k_buf_size:
-                self.key_buf = {}
+        with self._buf_lock:
+            result = self.key_buf.get(idx)
+            if result is not None:
+                self.key_buf.move_to_end(idx)
+                self.key_hits += 1
+                return result
+            self.key_misses += 1
+            self.single_encodes += 1
+
+        result = self.prop_net.encode_key(self.get_image_buffered(idx))
+        self._put_key_feat(idx, result)
+        return result
 
-            self.key_buf[idx] = self.prop_net.encode_key(self.get_image_buffered(idx))
-        result = self.key_buf[idx]
+    def prefetch_keys(self, indices, evict=True):
+        """
+        Encodes the keys of all given frames that are not cached yet, k_batch_size frames per forward pass
+        evict - If False, stops once the cache is full instead of evicting older features
 
-        return result
+        Return: False if the cache was full
+        """
+        with self._buf_lock:
+            missing = [ti for ti in indices if ti not in self.key_buf]
+
+        for i in range(0, len(missing), self.k_batch_size):
+            chunk = missing[i:i+self.k_batch_size]
+            if len(chunk) == 1:
+                feats = [self.prop_net.encode_key(self.get_image_buffered(chunk[0]))]
+            else:
+                frames = self.load_images(chunk)
+                feats = self.prop_net.encode_key_batch(frames, self.k_batch_size)
+            with self._buf_lock:
+                if len(chunk) == 1:
+                    self.single_encodes += 1
+                else:
+                    self.batched_encodes += len(chunk)
+            for ti, f in zip(chunk, feats):
+                if not self._put_key_feat(ti, f, evict=evict):
+                    return False
+        return True
+
+    def _put_key_feat(self, idx, feats, evict=True):
+        """
+        Adds features to the key cache, evicting the least recently used ones if the budget is exceeded
+        evict - If False, the features are only added if they fit without evicting anything.
+                Used by the warm-up, which may also only fill part of the shared budget
+
+        Return: True if the features were added
+        """
+        size = sum(f.numel() * f.element_size() for f in feats)
+        with self._buf_lock:
+            if self._closed:
+                return False
+            if idx in self.key_buf:
+                return True
+            if not evict and self.key_buf_used + size > self.k_buf_bytes:
+                return False
+            if self.key_cache_budget is not None:
+                # Other sessions may hold the rest of the shared budget, only our own features can be evicted
+                while not self.key_cache_budget.reserve(size, warm_up=not evict):
+                    if not evict or len(self.key_buf) == 0:
+                        return False
+                    self._evict_oldest_key_feat()
+            self.key_buf[idx] = feats
+            self.key_buf_used += size
+            # Always keep the newest entry
+            while self.key_buf_used > self.k_buf_bytes and len(self.key_buf) > 1:
+                self._evict_oldest_key_feat()
+        return True
+
+    def _evict_oldest_key_feat(self):
+        _, old = self.key_buf.popitem(last=False)
+        size = sum(f.numel() * f.element_size() for f in old)
+        self.key_buf_used -= size
+        if self.key_cache_budget is not None:
+            self.key_cache_budget.release(size)
+
+    def start_warm_up(self, context=None):
+        """
+        Encodes the keys of all frames in a background thread until the key cache is full,
+        so that propagation mostly finds its features in the cache
+        context - Function returning the context manager the encoding runs in, e.g. the autocast of the
+                  propagation so that the cached keys have the same precision. torch.no_grad if None
+        """
+        if self._warm_up_thread is not None:
+            return
+        self._warm_up_thread = threading.Thread(target=self._warm_up, args=(context or torch.no_grad,),
+                                                daemon=True)
+        self._warm_up_thread.start()
+
+    def stop_warm_up(self):
+        self._warm_up_stop.set()
+
+    def close(self):
+        """
+        Stops the warm-up and frees the key cache, returning its memory to the shared budget
+        """
+        self.stop_warm_up()
+        with self._buf_lock:
+            self._closed = True
+            while len(self.key_buf) > 0:
+                self._evict_oldest_key_feat()
+            self.image_buf.clear()
+
+    def _warm_up(self, context):
+        with context():
+            step = max(self.k_batch_size, 1)
+            for ti in range(0, self.t, step):
+                if self._warm_up_stop.is_set():
+                    return
+                if not self.prefetch_keys(range(ti, min(ti+step, self.t)), evict=False):
+                    # Cache is full
+                    return
+
+    def cache_stats(self):
+        """
+        Return: Hits, misses and memory usage of the key cache, and the number of frames whose keys were encoded in
+                a batch or alone
+        """
+        with self._buf_lock:
+            return {'hits': self.key_hits, 'misses': self.key_misses,
+                    'entries': len(self.key_buf), 'bytes': self.key_buf_used,
+                    'batched_encodes': self.batched_encodes, 'single_encodes': self.single_encodes}
 
     def do_pass(self, key_k, key_v, idx, forward=True, step_cb=None):
         """
@@ -123,7 +406,8 @@ class InferenceCore:
         key_k/key_v -  memory feature of the starting frame
         idx - Frame index of the starting frame
         forward - forward/backward propagation
-        step_cb - Callback function used for GUI (progress bar) only
+        step_cb - Callback function used for GUI, called with the index of every finished frame and whether its
+                  hard mask changed. The hard mask of that frame (np_masks) is final when it is called
         """
 
         # Pointer in the memory bank
@@ -137,12 +421,16 @@ class InferenceCore:
         else:
             closest_ti = max([ti for ti in self.interacted if ti < idx] + [-1])
             total_m = (idx - closest_ti - 1)//self.mem_freq + 1 + num_certain_keys
+        if self.mem_slots is not None:
+            total_m = min(total_m, num_certain_keys + self.mem_slots)
+        # Next propagated memory to be replaced once the bank is full
+        oldest_slot = 0
         _, CK, _, H, W = key_k.shape
         K, CV, _, _, _ = key_v.shape
 
         # Pre-allocate keys/values memory
-        keys = torch.empty((1, CK, total_m, H, W), dtype=torch.float32, device=self.device)
-        values = torch.empty((K, CV, total_m, H, W), dtype=torch.float32, device=self.device)
+        keys = torch.empty((1, CK, total_m, H, W), dtype=self.memory_dtype, device=self.device)
+        values = torch.empty((K, CV, total_m, H, W), dtype=self.memory_dtype, device=self.device)
 
         # Initial key/value passed in
         keys[:,:,0:num_certain_keys] = self.certain_mem_k
@@ -157,34 +445,51 @@ class InferenceCore:
             this_range = range(idx-1, closest_ti, -1)
             end = closest_ti + 1
 
-        for ti in this_range:
+        this_range = list(this_range)
+        for i, ti in enumerate(this_range):
+            # Encode the keys of the next frames in one batch once the propagation reaches a frame that is not
+            # cached. Prefetching on every frame would only ever find the one new frame at the end of the window
+            if self.k_batch_size > 1:
+                with self._buf_lock:
+                    cached = ti in self.key_buf
+                if not cached:
+                    self.prefetch_keys(this_range[i:i+self.k_batch_size])
 
             this_k = keys[:,:,:m_front]
             this_v = values[:,:,:m_front]
             k16, qv16, qf16, qf8, qf4 = self.get_key_feat_buffered(ti)
-            out_mask = self.prop_net.segment_with_query(this_k, this_v, qf8, qf4, k16, qv16)
+            out_mask = self.prop_net.segment_with_query(this_k, this_v, qf8, qf4, k16, qv16,
+                                                        obj_batch=self.obj_batch_size)
 
             out_mask = aggregate_wbg(out_mask, keep_bg=True)
 
-            if ti != end and abs(ti-last_ti) >= self.mem_freq:
-                keys[:,:,m_front:m_front+1] = k16.unsqueeze(2)
-                values[:,:,m_front:m_front+1] = self.prop_net.encode_value(
+            if ti != end and abs(ti-last_ti) >= self.mem_freq and total_m > num_certain_keys:
+                if m_front < total_m:
+                    slot = m_front
+                    m_front += 1
+                else:
+                    # The bank is full, replace the oldest propagated memory
+                    slot = num_certain_keys + oldest_slot
+                    oldest_slot = (oldest_slot + 1) % (total_m - num_certain_keys)
+                keys[:,:,slot:slot+1] = k16.unsqueeze(2)
+                values[:,:,slot:slot+1] = self.prop_net.encode_value(
                         self.get_image_buffered(ti), qf16, out_mask[1:])
 
-                m_front += 1
                 last_ti = ti
 
             # In-place fusion, maximizes the use of queried buffer
             # esp. for long sequence where the buffer will be flushed
             if (closest_ti != self.t) and (closest_ti != -1):
-                self.prob[:,ti] = self.fuse_one_frame(closest_ti, idx, ti, self.prob[:,ti], out_mask,
-                                        key_k, k16).to(self.result_dev)
+                self.set_prob(ti, self.fuse_one_frame(closest_ti, idx, ti, self.get_prob(ti), out_mask,
+                                        key_k, k16))
             else:
-                self.prob[:,ti] = out_mask.to(self.result_dev)
+                self.set_prob(ti, out_mask)
+
+            changed = self.update_hard_mask(ti)
 
             # Callback function for the GUI
             if step_cb is not None:
-                step_cb()
+                step_cb(ti, changed)
 
         return closest_ti
 
@@ -198,10 +503,18 @@ class InferenceCore:
         nr = abs(tr-ti) / abs(tc-tr)
         dist = torch.FloatTensor([nc, nr]).to(self.device).unsqueeze(0)
         attn_map = self.prop_net.get_attention(mk16, self.pos_mask_diff, self.neg_mask_diff, qk16)
-        for k in range(1, self.k+1):
-            w = torch.sigmoid(self.fuse_net(self.get_image_buffered(ti), 
-                    prev_mask[k:k+1].to(self.device), curr_mask[k:k+1].to(self.device), attn_map[k:k+1], dist))
-            prob[k-1] = w 
+        image = self.get_image_buffered(ti)
+        prev_mask = prev_mask.to(self.device)
+        curr_mask = curr_mask.to(self.device)
+
+        # All objects (background excluded) in as few forward passes as obj_batch_size allows
+        batched = self.k if self.obj_batch_size is None else max(self.obj_batch_size, 1)
+        for ks in range(1, self.k+1, batched):
+            ke = min(self.k+1, ks+batched)
+            n = ke - ks
+            w = torch.sigmoid(self.fuse_net(image.expand(n, -1, -1, -1), prev_mask[ks:ke], curr_mask[ks:ke],
+                    attn_map[ks:ke], dist.expand(n, -1)))
+            prob[ks-1:ke-1] = w
         return aggregate_wbg(prob, keep_bg=True)
 
     def interact(self, mask, idx, total_cb=None, step_cb=None):
@@ -212,17 +525,19 @@ class InferenceCore:
         idx - Frame index of the interacted frame
         total_cb, step_cb - Callback functions for the GUI
 
-        Return: all mask results in np format for DAVIS evaluation
+        Return: all mask results in np format for DAVIS evaluation.
+                Only the frames listed in changed_frames have been updated
         """
         self.interacted.add(idx)
+        self.changed_frames = []
 
         mask = mask.to(self.device)
         mask, _ = pad_divide_by(mask, 16, mask.shape[-2:])
-        self.mask_diff = mask - self.prob[:, idx].to(self.device)
+        self.mask_diff = mask - self.get_prob(idx)
         self.pos_mask_diff = self.mask_diff.clamp(0, 1)
         self.neg_mask_diff = (-self.mask_diff).clamp(0, 1)
 
-        self.prob[:, idx] = mask
+        self.set_prob(idx, mask)
         key_k, _, qf16, _, _ = self.get_key_feat_buffered(idx)
         key_k = key_k.unsqueeze(2)
         key_v = self.prop_net.encode_value(self.get_image_buffered(idx), qf16, mask[1:])
@@ -234,10 +549,11 @@ class InferenceCore:
             self.certain_mem_k = torch.cat([self.certain_mem_k, key_k], 2)
             self.certain_mem_v = torch.cat([self.certain_mem_v, key_v], 2)
 
+        # Only the frames between the neighbouring interacted frames are propagated
+        front_limit = min([ti for ti in self.interacted if ti > idx] + [self.t])
+        back_limit = max([ti for ti in self.interacted if ti < idx] + [-1])
         if total_cb is not None:
             # Finds the total num. frames to process
-            front_limit = min([ti for ti in self.interacted if ti > idx] + [self.t])
-            back_limit = max([ti for ti in self.interacted if ti < idx] + [-1])
             total_num = front_limit - back_limit - 2 # -1 for shift, -1 for center frame
             if total_num > 0:
                 total_cb(total_num)
@@ -245,19 +561,34 @@ class InferenceCore:
         self.do_pass(key_k, key_v, idx, True, step_cb=step_cb)
         self.do_pass(key_k, key_v, idx, False, step_cb=step_cb)
 
-        # This is a more memory-efficient argmax
-        for ti in range(self.t):
-            self.masks[ti] = torch.argmax(self.prob[:,ti], dim=0)
-        out_masks = self.masks
+        # do_pass already updated the hard masks of the propagated frames. The interacted frame is the only other
+        # frame whose prob changed
+        self.update_hard_mask(idx)
+        self.changed_frames.sort()
+        return self.np_masks
 
-        # Trim paddings
-        if self.pad[2]+self.pad[3] > 0:
-            out_masks = out_masks[:,:,self.pad[2]:-self.pad[3],:]
-        if self.pad[0]+self.pad[1] > 0:
-            out_masks = out_masks[:,:,:,self.pad[0]:-self.pad[1]]
+    def update_hard_mask(self, ti):
+        """
+        Argmax of prob for a single frame, copied to np_masks if it differs from the current hard mask
 
-        self.np_masks = (out_masks.detach().cpu().numpy()[:,0]).astype(np.uint8)
-        return self.np_masks
+        Return: True if the hard mask changed
+        """
+        mask = torch.argmax(self.get_prob(ti), dim=0)
+        mask = unpad_3dim(mask, self.pad)[0].to(torch.uint8).cpu()
+        if torch.equal(mask, self.masks[ti]):
+            return False
+        self.masks[ti] = mask
+        self.changed_frames.append(ti)
+        return True
+
+    @property
+    def dirty_range(self):
+        """
+        Range [start, end) of the frames whose hard mask changed in the last interact call, None if none changed
+        """
+        if len(self.changed_frames) == 0:
+            return None
+        return self.changed_frames[0], self.changed_frames[-1] + 1
 
     def update_mask_only(self, prob_mask, idx):
         """
@@ -268,15 +599,8 @@ class InferenceCore:
         Return: all mask results in np format for DAVIS evaluation
         """
         mask = torch.argmax(prob_mask, 0)
-        self.masks[idx] = mask
 
         # Mask - 1 * H * W
-        if self.pad[2]+self.pad[3] > 0:
-            mask = mask[:,self.pad[2]:-self.pad[3],:]
-        if self.pad[0]+self.pad[1] > 0:
-            mask = mask[:,:,self.pad[0]:-self.pad[1]]
-
-        mask = (mask.detach().cpu().numpy()[0]).astype(np.uint8)
-        self.np_masks[idx] = mask
+        self.masks[idx] = unpad_3dim(mask, self.pad)[0].to(torch.uint8).cpu()
 
         return self.np_masks
\ No newline at end of file
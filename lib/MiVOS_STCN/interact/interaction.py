@@ -22,6 +22,58 @@ from .interactive_utils import color_map
 
 
 max_history = 50
+# Memory budget of the undo history of a scribble interaction (and of the visualization history in the GUI)
+max_history_bytes = 64 * 1024**2
+
+
+def nbytes(x):
+    """
+    Memory used by a numpy array or tensor, 0 for None
+    """
+    if x is None:
+        return 0
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+    return x.nbytes
+
+
+class HistoryStack:
+    """
+    Undo stack bounded by the memory of its entries instead of their number, the oldest entries are dropped first
+    """
+    def __init__(self, max_bytes=max_history_bytes):
+        self.max_bytes = max_bytes
+        self.entries = deque()
+        self.size = 0
+
+    def push(self, entry, size):
+        """
+        size - Memory used by the entry in bytes
+        """
+        self.entries.append((entry, size))
+        self.size += size
+        # Always keep the newest entry
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, old_size = self.entries.popleft()
+            self.size -= old_size
+
+    def pop(self):
+        entry, size = self.entries.pop()
+        self.size -= size
+        return entry
+
+    def peek(self):
+        return self.entries[-1][0]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (entry for entry, _ in self.entries)
 
 class Interaction:
     def __init__(self, image, prev_mask, true_size, controller):
@@ -193,11 +245,15 @@ class ScribbleInteraction(Interaction):
 
         self.drawn_map = np.empty((self.h, self.w), dtype=np.uint8)
         self.drawn_map.fill(255)
+        # drawn_map at the end of the last path, the history only stores the pixels each path changed
+        self.committed_map = self.drawn_map.copy()
+        # (changed pixels, their previous labels, out_prob, out_mask) before every path, so undo does not
+        # need to run the network again
+        self.history = HistoryStack(max_history_bytes)
         # background + k
         self.curr_path = [[] for _ in range(self.K + 1)]
         self.all_paths = [self.curr_path]
         self.size = 3
-        self.surplus_history = False
 
     """
     k - object id
@@ -241,8 +297,13 @@ class ScribbleInteraction(Interaction):
         # Complete the drawing
         self.curr_path = [[] for _ in range(self.K + 1)]
         self.all_paths.append(self.curr_path)
-        self.history.append(self.drawn_map.copy())
-        self.surplus_history = True
+
+        # Store the delta of the drawn map and the prediction before this path
+        changed = np.flatnonzero(self.drawn_map != self.committed_map).astype(np.int32)
+        old_labels = self.committed_map.flat[changed]
+        self.committed_map.flat[changed] = self.drawn_map.flat[changed]
+        self.history.push((changed, old_labels, self.out_prob, self.out_mask),
+                          nbytes(changed) + nbytes(old_labels) + nbytes(self.out_prob) + nbytes(self.out_mask))
 
     def predict(self):
         self.out_prob = self.controller.interact(self.image, self.prev_mask, self.drawn_map)
@@ -250,19 +311,19 @@ class ScribbleInteraction(Interaction):
         return self.out_mask
 
     def undo(self):
-        if self.surplus_history:
-            self.history.pop()
-            self.surplus_history = False
-        self.drawn_map = self.history.pop()
+        # Restores the drawn map and the prediction before the last path, no inference needed
+        changed, old_labels, self.out_prob, self.out_mask = self.history.pop()
+        self.drawn_map.flat[changed] = old_labels
+        self.committed_map.flat[changed] = old_labels
         # pop the current path (which is empty) and the last path
         self.all_paths = self.all_paths[:-2]
         self.curr_path = [[] for _ in range(self.K + 1)]
         self.all_paths.append(self.curr_path)
-        return self.predict()
+        return self.out_mask
 
     def can_undo(self):
-        return (len(self.history) > 0) and not (
-            self.surplus_history and (len(self.history) < 2))
+        # There is nothing to go back to before the first path
+        return (len(self.history) > 0) and (self.history.peek()[3] is not None)
 
 
 class ClickInteraction(Interaction):
@@ -1,8 +1,9 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
 from ..model.s2m.s2m_network import deeplabv3plus_resnet50 as S2M
 
-from ..util.tensor_util import pad_divide_by
+from ..util.tensor_util import pad_divide_by, unpad
 
 
 class S2MController:
@@ -11,28 +12,125 @@ class S2MController:
     Takes the image, previous mask, and scribbles to produce a new mask
     ignore_class is usually 255 
     0 is NOT the ignore class -- it is the label for the background
+
+    roi - Only run S2M on a region of interest around the scribbles and the previous masks of the scribbled
+            objects, the rest of the frame keeps the previous mask. Like the CropperInteraction/LocalInteraction
+            pair, the region is cropped, predicted and stitched back into the full frame
+    roi_size - Longer side the region is downscaled to if it is larger, regions are never upscaled
+    roi_context - Context added on each side of the region, relative to its size
+    roi_max_area - Fraction of the frame above which the full frame is used instead of the region
+    inference - Function returning the context manager every interaction runs in, e.g. PrecisionPolicy.inference
+            so that S2M (full frame or region) runs in the precision of the session. torch.no_grad if None
     """
-    def __init__(self, s2m_net:S2M, num_objects, ignore_class, device='cuda:0'):
+    def __init__(self, s2m_net:S2M, num_objects, ignore_class, device='cuda:0', obj_batch_size=None,
+                    roi=False, roi_size=480, roi_context=0.25, roi_max_area=0.5, inference=None):
         self.s2m_net = s2m_net
         self.num_objects = num_objects
         self.ignore_class = ignore_class
         self.device = device
+        # Maximum number of objects per S2M forward pass, all objects at once if None
+        self.obj_batch_size = obj_batch_size
+        self.roi = roi
+        self.roi_size = roi_size
+        self.roi_context = roi_context
+        self.roi_max_area = roi_max_area
+        self.inference = inference if inference is not None else torch.no_grad
 
     def interact(self, image, prev_mask, scr_mask):
+        with self.inference():
+            return self._interact(image, prev_mask, scr_mask)
+
+    def _interact(self, image, prev_mask, scr_mask):
         image = image.to(self.device, non_blocking=True)    
         prev_mask = prev_mask.to(self.device, non_blocking=True)    
 
+        # Positive/negative scribbles of every object, K*2*H*W
+        obj_ids = np.arange(1, self.num_objects+1).reshape(-1, 1, 1)
+        p_srb = (scr_mask[None] == obj_ids)
+        n_srb = (scr_mask[None] != obj_ids) * (scr_mask[None] != self.ignore_class)
+        Rs = torch.from_numpy(np.stack([p_srb, n_srb], 1).astype(np.uint8)).float().to(image.device)
+        Rs, _ = pad_divide_by(Rs, 16, Rs.shape[-2:])
+
+        # Previous mask of every object, K*1*H*W
+        obj_ids = torch.arange(1, self.num_objects+1, device=image.device).view(-1, 1, 1)
+        prev_masks = (prev_mask == obj_ids).float().unsqueeze(1)
+
+        box = self.get_roi(prev_masks, Rs) if self.roi else None
+        if box is None:
+            return self.predict(image, prev_masks, Rs)
+
+        y0, y1, x0, x1 = box
+        unaggre_mask = prev_masks.clone()
+        unaggre_mask[:, :, y0:y1, x0:x1] = self.predict_roi(image[:, :, y0:y1, x0:x1],
+                                                            prev_masks[:, :, y0:y1, x0:x1], Rs[:, :, y0:y1, x0:x1])
+        return unaggre_mask
+
+    def get_roi(self, prev_masks, Rs):
+        """
+        Box around the scribbles and the previous masks of the objects with positive scribbles, plus context
+
+        Return: (y0, y1, x0, x1) in padded coordinates, None if the full frame should be used
+        """
+        h, w = Rs.shape[-2:]
+        region = Rs.sum(dim=(0, 1)) > 0
+        if not region.any():
+            return None
+        scribbled = Rs[:, 0].flatten(start_dim=1).any(1)
+        if scribbled.any():
+            region = region | (prev_masks[scribbled, 0] > 0).any(0)
+
+        ys = torch.nonzero(region.any(1)).flatten()
+        xs = torch.nonzero(region.any(0)).flatten()
+        y0, y1 = ys[0].item(), ys[-1].item() + 1
+        x0, x1 = xs[0].item(), xs[-1].item() + 1
+
+        # At least 16 pixels of context, the network needs to see the surroundings of the scribble
+        ch = max(int((y1-y0) * self.roi_context), 16)
+        cw = max(int((x1-x0) * self.roi_context), 16)
+        y0, y1 = max(0, y0-ch), min(h, y1+ch)
+        x0, x1 = max(0, x0-cw), min(w, x1+cw)
+
+        if (y1-y0) * (x1-x0) > self.roi_max_area * h * w:
+            return None
+        return y0, y1, x0, x1
+
+    def predict_roi(self, image, prev_masks, Rs):
+        """
+        S2M on a cropped region, downscaled to roi_size if it is larger
+
+        Return: K*1*h*w probabilities in the size of the crop
+        """
         h, w = image.shape[-2:]
-        unaggre_mask = torch.zeros((self.num_objects, 1, h, w), dtype=torch.float32, device=image.device)
+        scale = min(1.0, self.roi_size / max(h, w))
+        if scale < 1:
+            size = (max(int(h * scale), 1), max(int(w * scale), 1))
+            image = F.interpolate(image, size=size, mode='area')
+            prev_masks = (F.interpolate(prev_masks, size=size, mode='area') > 0.5).float()
+            # Keep thin strokes
+            Rs = (F.interpolate(Rs, size=size, mode='area') > 0).float()
 
-        for ki in range(1, self.num_objects+1):
-            p_srb = (scr_mask==ki).astype(np.uint8)
-            n_srb = ((scr_mask!=ki) * (scr_mask!=self.ignore_class)).astype(np.uint8)
+        image, pad = pad_divide_by(image, 16, image.shape[-2:])
+        prev_masks, _ = pad_divide_by(prev_masks, 16, prev_masks.shape[-2:])
+        Rs, _ = pad_divide_by(Rs, 16, Rs.shape[-2:])
 
-            Rs = torch.from_numpy(np.stack([p_srb, n_srb], 0)).unsqueeze(0).float().to(image.device)
-            Rs, _ = pad_divide_by(Rs, 16, Rs.shape[-2:])
+        out = unpad(self.predict(image, prev_masks, Rs), pad)
+        if scale < 1:
+            out = F.interpolate(out, size=(h, w), mode='bilinear', align_corners=False)
+        return out
+
+    def predict(self, image, prev_masks, Rs):
+        """
+        image - 1*3*H*W, prev_masks - K*1*H*W, Rs - K*2*H*W, all padded
+
+        Return: K*1*H*W probabilities
+        """
+        h, w = image.shape[-2:]
+        unaggre_mask = torch.zeros((self.num_objects, 1, h, w), dtype=torch.float32, device=image.device)
 
-            inputs = torch.cat([image, (prev_mask==ki).float().unsqueeze(0), Rs], 1)
-            unaggre_mask[ki-1] = torch.sigmoid(self.s2m_net(inputs))
+        batched = self.num_objects if self.obj_batch_size is None else max(self.obj_batch_size, 1)
+        for ks in range(0, self.num_objects, batched):
+            ke = min(self.num_objects, ks+batched)
+            inputs = torch.cat([image.expand(ke-ks, -1, -1, -1), prev_masks[ks:ke], Rs[ks:ke]], 1)
+            unaggre_mask[ks:ke] = torch.sigmoid(self.s2m_net(inputs))
 
-        return unaggre_mask
\ No newline at end of file
+        return unaggre_mask
@@ -72,10 +72,13 @@ def softmax_w_g_top(x, top=None, gauss=None):
     return output
 
 class EvalMemoryReader(nn.Module):
-    def __init__(self, top_k, km):
+    def __init__(self, top_k, km, query_chunk=1024, memory_chunk=8192):
         super().__init__()
         self.top_k = top_k
         self.km = km
+        # Working set of read_topk, an affinity block never exceeds memory_chunk*query_chunk elements
+        self.query_chunk = query_chunk
+        self.memory_chunk = memory_chunk
 
     def get_affinity(self, mk, qk):
         B, CK, T, H, W = mk.shape
@@ -109,11 +112,72 @@ class EvalMemoryReader(nn.Module):
         B, CV, T, H, W = mv.shape
 
         mo = mv.view(B, CV, T*H*W) 
-        mem = torch.bmm(mo, affinity) # Weighted-sum B, CV, HW
+        # The affinity of the single query is broadcast over the objects
+        mem = torch.matmul(mo, affinity) # Weighted-sum B, CV, HW
         mem = mem.view(B, CV, H, W)
 
         return mem
 
+    def read_topk(self, mk, qk, mv):
+        """
+        Same result as readout(get_affinity(mk, qk), mv) with top_k and without km, but the THW*HW affinity is
+        never materialised. Query positions are processed in chunks and a running top-k is kept over chunks of
+        the memory, so the working set does not grow with the size of the memory bank.
+
+        mk - B*CK*T*H*W memory keys, B=1
+        qk - B*CK*H*W query key
+        mv - K*CV*T*H*W memory values of K objects
+
+        Return: K*CV*H*W readout
+        """
+        B, CK, T, H, W = mk.shape
+        K, CV = mv.shape[:2]
+
+        mk = mk.flatten(start_dim=2)
+        qk = qk.flatten(start_dim=2)
+        mo = mv.view(K, CV, T*H*W)
+        THW, HW = mk.shape[2], qk.shape[2]
+        top_k = min(self.top_k, THW)
+
+        # The memory bank may be stored in reduced precision, the affinity is always accumulated in float32
+        c = qk.float().pow(2).sum(1).unsqueeze(1)
+        scale = math.sqrt(CK)
+
+        out = []
+        for qs in range(0, HW, self.query_chunk):
+            qe = min(HW, qs+self.query_chunk)
+            q = qk[:, :, qs:qe]
+
+            # Running top-k over the memory chunks
+            values = indices = None
+            for ms in range(0, THW, self.memory_chunk):
+                me = min(THW, ms+self.memory_chunk)
+                mk_chunk = mk[:, :, ms:me]
+                a = mk_chunk.float().pow(2).sum(1).unsqueeze(2)
+                # Autocast would run the product in reduced precision again, which can change the selected entries
+                with torch.autocast(device_type=q.device.type, enabled=False):
+                    b = 2 * (mk_chunk.float().transpose(1, 2) @ q.float())
+                affinity = (-a+b-c[:, :, qs:qe]) / scale   # B, chunk, q
+
+                chunk_values, chunk_indices = torch.topk(affinity, k=min(top_k, me-ms), dim=1)
+                chunk_indices += ms
+                if values is None:
+                    values, indices = chunk_values, chunk_indices
+                else:
+                    values = torch.cat([values, chunk_values], 1)
+                    indices = torch.cat([indices, chunk_indices], 1)
+                    values, selected = torch.topk(values, k=top_k, dim=1)
+                    indices = torch.gather(indices, 1, selected)
+
+            x_exp = torch.exp(values - values[:, 0:1])
+            x_exp /= torch.sum(x_exp, dim=1, keepdim=True)   # B, top_k, q
+
+            # Weighted sum of the selected memory values
+            selected_mv = mo.index_select(2, indices.flatten()).view(K, CV, top_k, qe-qs)
+            out.append((selected_mv.float() * x_exp.unsqueeze(1)).sum(2))
+
+        return torch.cat(out, 2).view(K, CV, H, W)
+
 class AttentionMemory(nn.Module):
     def __init__(self, k):
         super().__init__()
@@ -176,20 +240,46 @@ class PropagationNetwork(nn.Module):
 
         return k16, f16_thin, f16, f8, f4
 
-    def segment_with_query(self, mk16, mv16, qf8, qf4, qk16, qv16): 
-        affinity = self.memory.get_affinity(mk16, qk16)
+    def encode_key_batch(self, frames, batch_size=8):
+        """
+        Encodes the keys of several frames, batch_size frames per forward pass
+        frames - N*3*H*W
 
+        Return: list with the encode_key features of every frame, each with a batch dimension of 1
+        """
+        feats = []
+        for i in range(0, frames.shape[0], batch_size):
+            batch_feats = self.encode_key(frames[i:i+batch_size])
+            for j in range(batch_feats[0].shape[0]):
+                # Copy, so that evicting a single frame from a cache frees its memory
+                feats.append(tuple(f[j:j+1].clone() for f in batch_feats))
+        return feats
+
+    def segment_with_query(self, mk16, mv16, qf8, qf4, qk16, qv16, obj_batch=None): 
+        """
+        obj_batch - Maximum number of objects in one readout/decoder forward pass to bound the memory usage,
+                    all objects at once if None
+        """
         k = mv16.shape[0]
-        # Do it batch by batch to reduce memory usage
-        batched = 1
-        m4 = torch.cat([
-            self.memory.readout(affinity, mv16[i:i+1]) for i in range(0, k, batched)
-        ], 0)
+        batched = k if obj_batch is None else max(obj_batch, 1)
+        if self.memory.top_k is not None and self.memory.km is None:
+            # Memory bounded top-k readout, the top-k selection is shared by the objects of a batch
+            m4 = torch.cat([
+                self.memory.read_topk(mk16, qk16, mv16[i:i+batched]) for i in range(0, k, batched)
+            ], 0)
+        else:
+            affinity = self.memory.get_affinity(mk16, qk16)
+            m4 = torch.cat([
+                self.memory.readout(affinity, mv16[i:i+batched]) for i in range(0, k, batched)
+            ], 0)
 
         qv16 = qv16.expand(k, -1, -1, -1)
         m4 = torch.cat([m4, qv16], 1)
 
-        return torch.sigmoid(self.decoder(m4, qf8, qf4))
+        # The query features have a batch size of 1 and are broadcast over the objects in the decoder
+        return torch.cat([
+            torch.sigmoid(self.decoder(m4[i:i+batched], qf8, qf4)) for i in range(0, k, batched)
+        ], 0)
 
     def get_W(self, mk16, qk16):
         W = self.attn_memory(mk16, qk16)
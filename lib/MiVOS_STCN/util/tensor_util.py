@@ -65,6 +65,14 @@ def pad_divide_by(in_img, d, in_size=None):
     else:
         h, w = in_size
 
+    pad_array = get_pad_array(h, w, d)
+    out = F.pad(in_img, pad_array)
+    return out, pad_array
+
+def get_pad_array(h, w, d):
+    """
+    Padding (left, right, top, bottom) of pad_divide_by, without padding anything
+    """
     if h % d > 0:
         new_h = h + d - h % d
     else:
@@ -75,9 +83,7 @@ def pad_divide_by(in_img, d, in_size=None):
         new_w = w
     lh, uh = int((new_h-h) / 2), int(new_h-h) - int((new_h-h) / 2)
     lw, uw = int((new_w-w) / 2), int(new_w-w) - int((new_w-w) / 2)
-    pad_array = (int(lw), int(uw), int(lh), int(uh))
-    out = F.pad(in_img, pad_array)
-    return out, pad_array
+    return (int(lw), int(uw), int(lh), int(uh))
 
 def unpad(img, pad):
     if pad[2]+pad[3] > 0:
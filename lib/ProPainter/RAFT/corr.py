@@ -10,13 +10,14 @@ except:
 
 
 class CorrBlock:
-    def __init__(self, fmap1, fmap2, num_levels=4, radius=4):
+    def __init__(self, fmap1, fmap2, num_levels=4, radius=4, corr=None):
         self.num_levels = num_levels
         self.radius = radius
         self.corr_pyramid = []
 
         # all pairs correlation
-        corr = CorrBlock.corr(fmap1, fmap2)
+        if corr is None:
+            corr = CorrBlock.corr(fmap1, fmap2)
 
         batch, h1, w1, dim, h2, w2 = corr.shape
         corr = corr.reshape(batch*h1*w1, dim, h2, w2)
@@ -49,6 +50,16 @@ class CorrBlock:
         out = torch.cat(out_pyramid, dim=-1)
         return out.permute(0, 3, 1, 2).contiguous().float()
 
+    @classmethod
+    def bidirectional(cls, fmap1, fmap2, num_levels=4, radius=4):
+        """Correlation of every pair in both directions, fmap1 -> fmap2 followed by fmap2 -> fmap1 in the batch.
+
+        The backward volume is the transpose of the forward one, so the matmul is only done once.
+        """
+        corr = CorrBlock.corr(fmap1, fmap2)
+        corr = torch.cat([corr, corr.permute(0, 4, 5, 3, 1, 2)], dim=0)
+        return cls(None, None, num_levels=num_levels, radius=radius, corr=corr)
+
     @staticmethod
     def corr(fmap1, fmap2):
         batch, dim, ht, wd = fmap1.shape
@@ -60,6 +71,49 @@ class CorrBlock:
         return corr  / torch.sqrt(torch.tensor(dim).float())
 
 
+class LocalCorrBlock:
+    """Same lookup as CorrBlock without the all-pairs volume.
+
+    Correlation is linear, so the pooled volume of level i equals the correlation with the pooled fmap2. Only the
+    (2r+1)^2 dot products around the current coordinates are computed in every lookup, memory is linear in the
+    number of pixels instead of quadratic. Pure PyTorch, works on the CPU.
+    """
+    def __init__(self, fmap1, fmap2, num_levels=4, radius=4):
+        self.num_levels = num_levels
+        self.radius = radius
+        self.fmap1 = fmap1
+
+        self.pyramid = [fmap2]
+        for i in range(self.num_levels-1):
+            fmap2 = F.avg_pool2d(fmap2, 2, stride=2)
+            self.pyramid.append(fmap2)
+
+    def __call__(self, coords):
+        r = self.radius
+        coords = coords.permute(0, 2, 3, 1)
+        batch, dim, h1, w1 = self.fmap1.shape
+        d = torch.linspace(-r, r, 2*r+1, device=coords.device)
+
+        out_pyramid = []
+        for i in range(self.num_levels):
+            centroid_lvl = coords.reshape(batch, h1, w1, 1, 2) / 2**i
+            corr = []
+            # One x offset and all 2r+1 y offsets at a time, keeps the sampled features at (2r+1)*C*H*W
+            for dx in d:
+                delta = torch.stack([dx.expand(2*r+1), d], dim=-1).view(1, 1, 1, 2*r+1, 2)
+                coords_lvl = (centroid_lvl + delta).reshape(batch, h1, w1*(2*r+1), 2)
+                fmap2 = bilinear_sampler(self.pyramid[i], coords_lvl).view(batch, dim, h1, w1, 2*r+1)
+                corr.append((fmap2 * self.fmap1.unsqueeze(-1)).sum(1))
+
+            # Same channel order as CorrBlock, x offset major
+            corr = torch.stack(corr, dim=3)
+            out_pyramid.append(corr.view(batch, h1, w1, -1))
+
+        out = torch.cat(out_pyramid, dim=-1)
+        out = out / torch.sqrt(torch.tensor(dim).float())
+        return out.permute(0, 3, 1, 2).contiguous().float()
+
+
 class CorrLayer(torch.autograd.Function):
     @staticmethod
     def forward(ctx, fmap1, fmap2, coords, r):
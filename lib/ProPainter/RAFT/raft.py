@@ -5,7 +5,7 @@ import torch.nn.functional as F
 
 from .update import BasicUpdateBlock, SmallUpdateBlock
 from .extractor import BasicEncoder, SmallEncoder
-from .corr import CorrBlock, AlternateCorrBlock
+from .corr import CorrBlock, AlternateCorrBlock, LocalCorrBlock
 from .utils.utils import bilinear_sampler, coords_grid, upflow8
 
 try:
@@ -43,6 +43,10 @@ class RAFT(nn.Module):
 
         if 'alternate_corr' not in args._get_kwargs():
             args.alternate_corr = False
+
+        # Look up the correlation on demand instead of building the all-pairs volume
+        if 'local_corr' not in args._get_kwargs():
+            args.local_corr = False
         
         # feature network, context network, and update block
         if args.small:
@@ -84,8 +88,12 @@ class RAFT(nn.Module):
         return up_flow.reshape(N, 2, 8*H, 8*W)
 
 
-    def forward(self, image1, image2, iters=12, flow_init=None, test_mode=True):
-        """ Estimate optical flow between pair of frames """
+    def forward(self, image1, image2, iters=12, flow_init=None, test_mode=True, tol=None, return_iters=False):
+        """ Estimate optical flow between pair of frames
+        tol - Stop before iters once the mean flow update of every pair is below tol (in 1/8 resolution pixels),
+              None to always run all iterations
+        return_iters - Also return the number of iterations run. It is returned rather than stored on the module,
+              which is shared by concurrent callers """
 
         # image1 = 2 * (image1 / 255.0) - 1.0
         # image2 = 2 * (image2 / 255.0) - 1.0
@@ -105,6 +113,8 @@ class RAFT(nn.Module):
         
         if self.args.alternate_corr:
             corr_fn = AlternateCorrBlock(fmap1, fmap2, radius=self.args.corr_radius)
+        elif self.args.local_corr:
+            corr_fn = LocalCorrBlock(fmap1, fmap2, radius=self.args.corr_radius)
         else:
             corr_fn = CorrBlock(fmap1, fmap2, radius=self.args.corr_radius)
 
@@ -140,7 +150,89 @@ class RAFT(nn.Module):
 
             flow_predictions.append(flow_up)
 
+            if tol is not None and self.converged(delta_flow, tol):
+                break
+
         if test_mode:
+            if return_iters:
+                return coords1 - coords0, flow_up, itr + 1
             return coords1 - coords0, flow_up
 
+        if return_iters:
+            return flow_predictions, itr + 1
         return flow_predictions
+
+    def encode(self, images):
+        """ Feature and context encoding of single frames, the features of a frame do not depend on the other
+        frame of the pair (instance norm), so every frame only needs to be encoded once """
+        images = images.contiguous()
+        hdim = self.hidden_dim
+        cdim = self.context_dim
+
+        with autocast(enabled=self.args.mixed_precision):
+            fmap = self.fnet(images)
+            cnet = self.cnet(images)
+            net, inp = torch.split(cnet, [hdim, cdim], dim=1)
+            net = torch.tanh(net)
+            inp = torch.relu(inp)
+
+        return fmap.float(), net, inp
+
+    @staticmethod
+    def converged(delta_flow, tol):
+        """ True if the mean update magnitude of every pair in the batch is below tol """
+        return delta_flow.abs().mean(dim=(1, 2, 3)).max().item() < tol
+
+    def forward_bi(self, feats1, feats2, iters=12, tol=None, local_corr=None):
+        """ Estimate the flow 1 -> 2 and 2 -> 1 of pairs of encoded frames at once
+
+        feats1, feats2 - encode() output of the first and second frames of the pairs
+        iters - Maximum number of update iterations
+        tol - Early exit tolerance, see forward
+        local_corr - Use LocalCorrBlock instead of the all-pairs volume, args.local_corr if None
+        Returns: forward and backward flow at full resolution, number of iterations run
+        """
+        fmap1, net1, inp1 = feats1
+        fmap2, net2, inp2 = feats2
+        n, _, h, w = fmap1.shape
+
+        if local_corr is None:
+            local_corr = self.args.local_corr
+
+        # Both directions share one correlation volume and run through the update block as one batch
+        if self.args.alternate_corr:
+            corr_fn = AlternateCorrBlock(torch.cat([fmap1, fmap2], 0), torch.cat([fmap2, fmap1], 0),
+                                         radius=self.args.corr_radius)
+        elif local_corr:
+            corr_fn = LocalCorrBlock(torch.cat([fmap1, fmap2], 0), torch.cat([fmap2, fmap1], 0),
+                                     radius=self.args.corr_radius)
+        else:
+            corr_fn = CorrBlock.bidirectional(fmap1, fmap2, radius=self.args.corr_radius)
+        net = torch.cat([net1, net2], 0)
+        inp = torch.cat([inp1, inp2], 0)
+
+        coords0 = coords_grid(2*n, h, w).to(fmap1.device)
+        coords1 = coords_grid(2*n, h, w).to(fmap1.device)
+
+        up_mask = None
+        for itr in range(iters):
+            coords1 = coords1.detach()
+            corr = corr_fn(coords1) # index correlation volume
+
+            flow = coords1 - coords0
+            with autocast(enabled=self.args.mixed_precision):
+                net, up_mask, delta_flow = self.update_block(net, inp, corr, flow)
+
+            # F(t+1) = F(t) + \Delta(t)
+            coords1 = coords1 + delta_flow
+
+            if tol is not None and self.converged(delta_flow, tol):
+                break
+
+        # Only the last prediction is used, upsample once
+        if up_mask is None:
+            flow_up = upflow8(coords1 - coords0)
+        else:
+            flow_up = self.upsample_flow(coords1 - coords0, up_mask)
+
+        return flow_up[:n], flow_up[n:], itr + 1
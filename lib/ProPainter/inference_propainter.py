@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+import copy
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import argparse
 import imageio
@@ -9,12 +13,15 @@ from PIL import Image
 from tqdm import tqdm
 
 import torch
+import torch.nn.functional as F
 import torchvision
 
 from .model.modules.flow_comp_raft import RAFT_bi
 from .model.recurrent_flow_completion import RecurrentFlowCompleteNet
 from .model.propainter import InpaintGenerator
 from .utils.download_util import load_file_from_url
+from .utils.flow_cache import flow_key, owner_flow_key
+from .utils.flow_util import resize_flow_pytorch
 from .core.utils import to_tensors
 from .model.misc import get_device
 
@@ -24,6 +31,56 @@ warnings.filterwarnings("ignore")
 
 pretrain_model_url = 'https://github.com/sczhou/ProPainter/releases/download/v0.1.0/'
 
+# Smaller crops are upscaled so that their shorter side has this many pixels
+MIN_CROP_SIZE = 150
+
+
+class EmptyMaskError(ValueError):
+    """
+    Raised when there is no masked pixel to inpaint
+    """
+    pass
+
+
+def pad_box(top_left, bottom_right, padding, width, height):
+    top_left = (max(0, top_left[0] - padding), max(0, top_left[1] - padding))
+    bottom_right = (min(width - 1, bottom_right[0] + padding), min(height - 1, bottom_right[1] + padding))
+    return top_left, bottom_right
+
+
+def merge_boxes(boxes, distance=0):
+    """
+    Merges overlapping boxes until all boxes are disjoint
+    :param boxes: List of (top_left, bottom_right) tuples
+    :param distance: Boxes that are less than this many pixels apart are merged as well
+    :return: List of disjoint boxes
+    """
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                (l1, t1), (r1, b1) = boxes[i]
+                (l2, t2), (r2, b2) = boxes[j]
+                if l1 <= r2 + distance and l2 <= r1 + distance and t1 <= b2 + distance and t2 <= b1 + distance:
+                    boxes[i] = ((min(l1, l2), min(t1, t2)), (max(r1, r2), max(b1, b2)))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def box_distance(box1, box2):
+    """
+    :return: Number of pixels between two boxes along the axis they are furthest apart on, 0 if they overlap
+    """
+    (l1, t1), (r1, b1) = box1
+    (l2, t2), (r2, b2) = box2
+    return max(0, l2 - r1, l1 - r2, t2 - b1, t1 - b2)
+
 
 def find_bounding_box(img_list, padding=10):
     """
@@ -32,38 +89,92 @@ def find_bounding_box(img_list, padding=10):
     :param padding: Space around bounding box in px
     :return: top left and bottom right coordinates of the bounding box plus padding
     """
-    top_left = None
-    bottom_right = None
+    # Union of all masks over time, H x W
+    occupied = np.stack([np.array(img.convert('L')) for img in img_list], axis=0).any(axis=0)
+    height, width = occupied.shape
 
-    width = 0
-    height = 0
-    # Iterate over all images to find the bounding box
-    for img in img_list:
-        img = img.convert('L')
-        pixels = np.array(img)
-        pixels = pixels.T
-        width, height = pixels.shape
-        for y in range(height):
-            for x in range(width):
-                # Check if the pixel is black
-                if pixels[x, y] != 0:
-                    # Update top_left
-                    if top_left is None:
-                        top_left = (x, y)
-                    else:
-                        top_left = (min(top_left[0], x), min(top_left[1], y))
+    if not occupied.any():
+        raise EmptyMaskError('No mask to inpaint')
 
-                    # Update bottom_right
-                    if bottom_right is None:
-                        bottom_right = (x, y)
-                    else:
-                        bottom_right = (max(bottom_right[0], x), max(bottom_right[1], y))
+    rows = np.flatnonzero(occupied.any(axis=1))
+    cols = np.flatnonzero(occupied.any(axis=0))
+    return pad_box((cols[0], rows[0]), (cols[-1], rows[-1]), padding, width, height)
 
-    # Add padding
-    top_left = (max(0, top_left[0] - padding), max(0, top_left[1] - padding))
-    bottom_right = (min(width - 1, bottom_right[0] + padding), min(height - 1, bottom_right[1] + padding))
 
-    return top_left, bottom_right
+def crop_cost(box, num_frames):
+    """
+    :return: Number of pixels processed to inpaint a crop over num_frames frames, including the upscaling of small
+             crops in resize_frames
+    """
+    (left, top), (right, bottom) = box
+    w, h = right - left + 1, bottom - top + 1
+    scale = max(1.0, MIN_CROP_SIZE / min(w, h))
+    return w * h * scale * scale * num_frames
+
+
+def find_regions(img_list, length, padding=10, min_area=64, merge_distance=32, max_regions=4, temporal_padding=5):
+    """
+    Finds the separate masked regions of a video, so that each one can be inpainted in its own crop and only in the
+    frames it is masked in
+    :param img_list: List of PIL masks, a single mask is used for every frame
+    :param length: Number of frames of the video
+    :param min_area: Regions with fewer masked pixels (union over time) do not get a crop of their own, they are added
+                     to the box of the nearest larger region. Every masked pixel is inside one of the returned boxes
+    :param merge_distance: Regions whose padded boxes are less than this many pixels apart are merged
+    :param max_regions: With more regions, a single box around all of them is used
+    :param temporal_padding: Frames before and after the masked frames of a region that are included as context
+    :return: List of (box, (start, end)), box as (top_left, bottom_right) like find_bounding_box and [start, end)
+             the frames the region is inpainted in. A single region if separate crops would not process fewer pixels
+    """
+    masks = np.stack([np.array(img.convert('L')) > 0 for img in img_list], axis=0)
+    occupied = masks.any(axis=0)
+    height, width = occupied.shape
+
+    if not occupied.any():
+        raise EmptyMaskError('No mask to inpaint')
+
+    labels, num_labels = scipy.ndimage.label(occupied)
+    areas = np.asarray(scipy.ndimage.sum(occupied, labels, index=np.arange(1, num_labels + 1)))
+    slices = scipy.ndimage.find_objects(labels)
+    boxes, small_boxes = [], []
+    for label in range(1, num_labels + 1):
+        y_slice, x_slice = slices[label - 1]
+        box = pad_box((x_slice.start, y_slice.start), (x_slice.stop - 1, y_slice.stop - 1), padding, width, height)
+        if areas[label - 1] >= min_area:
+            boxes.append(box)
+        else:
+            small_boxes.append(box)
+    if len(boxes) == 0:
+        # Only small regions, each one is inpainted on its own
+        boxes = small_boxes
+    else:
+        for (l1, t1), (r1, b1) in small_boxes:
+            i = min(range(len(boxes)), key=lambda j: box_distance(boxes[j], ((l1, t1), (r1, b1))))
+            (l2, t2), (r2, b2) = boxes[i]
+            boxes[i] = ((min(l1, l2), min(t1, t2)), (max(r1, r2), max(b1, b2)))
+    boxes = merge_boxes(boxes, merge_distance)
+
+    def frame_range(box):
+        if len(masks) == 1:
+            return 0, length
+        (left, top), (right, bottom) = box
+        present = np.flatnonzero(masks[:, top:bottom + 1, left:right + 1].any(axis=(1, 2)))
+        start = max(0, present[0] - temporal_padding)
+        end = min(length, present[-1] + 1 + temporal_padding)
+        if end - start < 2:
+            # Flow needs at least two frames
+            start = max(0, min(start, length - 2))
+            end = min(length, start + 2)
+        return start, end
+
+    regions = [(box, frame_range(box)) for box in boxes]
+    union = ((min(b[0][0] for b in boxes), min(b[0][1] for b in boxes)),
+             (max(b[1][0] for b in boxes), max(b[1][1] for b in boxes)))
+    union_start, union_end = frame_range(union)
+    regions_cost = sum(crop_cost(box, end - start) for box, (start, end) in regions)
+    if len(regions) > max_regions or regions_cost >= crop_cost(union, union_end - union_start):
+        return [(union, (union_start, union_end))]
+    return regions
 
 
 def crop_images(img_list, top_left, bottom_right):
@@ -91,7 +202,7 @@ def imwrite(img, file_path, params=None, auto_mkdir=True):
 
 
 # resize frames
-def resize_frames(frames, size=None, min_size=150, bounding_box=True):
+def resize_frames(frames, size=None, min_size=MIN_CROP_SIZE, bounding_box=True):
     if size is not None:
         out_size = size
         process_size = (out_size[0] - out_size[0] % 8, out_size[1] - out_size[1] % 8)
@@ -142,22 +253,33 @@ def binary_mask(mask, th=0.1):
     return mask
 
 
-# read frame-wise masks
-def read_mask(mpath, length, flow_mask_dilates=8, mask_dilates=5, bounding_box=True, size=None):
+# read frame-wise mask images
+def read_mask_images(mpath):
     masks_img = []
-    masks_dilated = []
-    flow_masks = []
-
     if mpath.endswith(('jpg', 'jpeg', 'png', 'JPG', 'JPEG', 'PNG')):  # input single img path
         masks_img = [Image.open(mpath)]
     else:
         mnames = sorted(os.listdir(mpath))
         for mp in mnames:
             masks_img.append(Image.open(os.path.join(mpath, mp)))
+    return masks_img
+
+
+# read frame-wise masks
+def read_mask(mpath, length, flow_mask_dilates=8, mask_dilates=5, bounding_box=True, size=None):
+    return process_masks(read_mask_images(mpath), length, flow_mask_dilates, mask_dilates, bounding_box, size)
+
+
+# dilate frame-wise masks and crop them to their bounding box
+def process_masks(masks_img, length, flow_mask_dilates=8, mask_dilates=5, bounding_box=True, size=None, box=None):
+    masks_dilated = []
+    flow_masks = []
 
     # Resizing masks to bounding box
     if bounding_box:
-        top_left, bottom_right = find_bounding_box(masks_img)
+        if box is None:
+            box = find_bounding_box(masks_img)
+        top_left, bottom_right = box
         masks_img, size, out_size = crop_images(masks_img, top_left, bottom_right)
     for mask_img in masks_img:
         if size is not None:
@@ -247,271 +369,601 @@ def get_ref_index(mid_neighbor_id, neighbor_ids, length, ref_stride=10, ref_num=
     return ref_index
 
 
-def inpaint(video_path, mask_path, output_folder, size=(-1, -1), bounding_box=True):
-    # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    device = get_device()
-
-    # Set arguments
-    video = video_path
-    mask = mask_path
-    output = output_folder
-
-    os.makedirs(output, exist_ok=True)
-
-    resize_ratio = 1.0
-    height = size[0]
-    width = size[1]
-    mask_dilation = 4
-    ref_stride = 10
-    neighbor_length = 10
-    subvideo_length = 80
-    raft_iter = 20
-    mode = 'video_inpainting'
-    scale_h = 1.0
-    scale_w = 1.0
-    fp16 = False
-
-    # Use fp16 precision during inference to reduce running memory cost
-    use_half = True if fp16 else False
-    if device == torch.device('cpu'):
-        use_half = False
-
-    frames, fps, size, video_name = read_frame_from_videos(video)
-    out_frames = frames
-    if not width == -1 and not height == -1:
-        size = (width, height)
-    if not resize_ratio == 1.0:
-        size = (int(resize_ratio * size[0]), int(resize_ratio * size[1]))
-
-    if not bounding_box:
-        frames, size, out_size = resize_frames(frames, size, bounding_box=bounding_box)
-
-    if not os.path.exists(output):
-        os.makedirs(output, exist_ok=True)
-    if mode == 'video_inpainting':
+def crop_flows(flows_bi, frame_size, top_left, bottom_right, size):
+    """
+    Turns flows computed on the whole frame into the flows of a cropped and resized clip
+    :param flows_bi: Forward and backward flows of shape (1, T, 2, h, w), computed on the whole frame resized to (w, h)
+    :param frame_size: (width, height) of the original frames
+    :param top_left: Top left coordinate of the crop in the original frames
+    :param bottom_right: Bottom right coordinate of the crop in the original frames
+    :param size: (width, height) the crop is processed at
+    :return: Forward and backward flows of shape (1, T, 2, size[1], size[0])
+    """
+    width, height = frame_size
+    crop_w = bottom_right[0] - top_left[0] + 1
+    crop_h = bottom_right[1] - top_left[1] + 1
+    out_w, out_h = size
+
+    # Sample the flow at the pixel centres of the resized crop, in normalised coordinates of the whole frame
+    xs = top_left[0] + (torch.arange(out_w, dtype=torch.float32) + 0.5) * crop_w / out_w
+    ys = top_left[1] + (torch.arange(out_h, dtype=torch.float32) + 0.5) * crop_h / out_h
+    grid_y, grid_x = torch.meshgrid(ys / height * 2 - 1, xs / width * 2 - 1, indexing='ij')
+    grid = torch.stack((grid_x, grid_y), dim=-1).unsqueeze(0)
+
+    cropped = []
+    for flows in flows_bi:
+        b, t, _, h, w = flows.shape
+        flows = flows.view(b * t, 2, h, w).float()
+        flows = F.grid_sample(flows, grid.to(flows.device).expand(b * t, -1, -1, -1), mode='bilinear',
+                              padding_mode='border', align_corners=False)
+        # Flow vectors are in pixels, scale them from the flow resolution to the crop resolution
+        scale = torch.tensor([width / w * out_w / crop_w, height / h * out_h / crop_h], device=flows.device)
+        flows = flows * scale.view(1, 2, 1, 1)
+        cropped.append(flows.view(b, t, 2, out_h, out_w))
+    return tuple(cropped)
+
+
+def get_flow_size(size, flow_scale=1.0):
+    """
+    :param size: (width, height) a clip is processed at
+    :param flow_scale: Fraction of the process size the flow is estimated and completed at
+    :return: (width, height) of the flow, multiples of 8 as RAFT requires
+    """
+    if flow_scale >= 1.0:
+        return size
+    return (max(8, int(size[0] * flow_scale) // 8 * 8), max(8, int(size[1] * flow_scale) // 8 * 8))
+
+
+def resize_clip(clip, size, mode='area'):
+    """
+    :param clip: Tensor of shape (B, T, C, H, W)
+    :param size: (width, height) to resize to
+    :return: Tensor of shape (B, T, C, size[1], size[0])
+    """
+    b, t, c, h, w = clip.shape
+    clip = F.interpolate(clip.reshape(b * t, c, h, w), size=(size[1], size[0]), mode=mode)
+    return clip.view(b, t, c, size[1], size[0])
+
+
+def mask_occupancy(masks):
+    """
+    :param masks: Mask tensor of shape (1, T, 1, H, W)
+    :return: Boolean array of length T, True for frames with at least one masked pixel
+    """
+    return masks.flatten(2).amax(2).view(-1).cpu().numpy() > 0
+
+
+def _init_precompute_worker():
+    # Linux applies nice values per thread, so this only lowers the priority of the calling worker thread.
+    # torch.set_num_threads is process-wide and would also throttle every foreground request, do not use it here
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+    except (AttributeError, OSError):
+        pass
+
+
+class InpaintingEngine:
+    """
+    Owns the RAFT, flow completion and ProPainter networks for the lifetime of the process.
+    Checkpoints are loaded once in the constructor, inpaint can then be called repeatedly for different videos.
+    """
+
+    def __init__(self, device=None, raft_path='saves/raft_things.pth',
+                 flow_complete_path='saves/recurrent_flow_completion.pth', propainter_path='saves/ProPainter.pth',
+                 flow_cache=None, raft_tol=None, raft_corr='auto'):
+        """
+        :param flow_cache: Optional FlowCache, RAFT is skipped for clips whose flow is already cached
+        :param raft_tol: Stop the RAFT refinement of a clip once the mean flow update of every frame pair is below
+                         this tolerance (in pixels at 1/8 resolution), raft_iter is then only the maximum.
+                         None always runs raft_iter iterations
+        :param raft_corr: 'all_pairs' builds RAFT's all-pairs correlation volume, 'local' looks up the correlation
+                          on demand with memory linear in the number of pixels, so longer clips fit into one RAFT
+                          batch. 'auto' uses the local lookup for frames wider than 640 pixels
+        """
+        if device is None:
+            device = get_device()
+        self.device = device
+        self.raft_path = raft_path
+        self.flow_cache = flow_cache
+        self.raft_tol = raft_tol
+        self.raft_corr = raft_corr
+
+        ##############################################
+        # set up RAFT and flow competition model
+        ##############################################
+        self.fix_raft = RAFT_bi(raft_path, device)
+
+        self.fix_flow_complete = RecurrentFlowCompleteNet(flow_complete_path)
+        for p in self.fix_flow_complete.parameters():
+            p.requires_grad = False
+        self.fix_flow_complete.to(device)
+        self.fix_flow_complete.eval()
+
+        ##############################################
+        # set up ProPainter model
+        ##############################################
+        self.model = InpaintGenerator(model_path=propainter_path).to(device)
+        for p in self.model.parameters():
+            p.requires_grad = False
+        self.model.eval()
+
+        # Keep the fp32 weights around, half precision copies are only created when requested
+        self._half_models = None
+
+        # Flow precomputation for whole videos runs on a single low priority worker, created on first use
+        self._precompute_executor = None
+        self._precompute_lock = threading.Lock()
+        self._precomputed = {}
+
+    def get_models(self, use_half=False):
+        """
+        :return: The flow completion and ProPainter networks in the requested precision
+        """
+        if not use_half:
+            return self.fix_flow_complete, self.model
+        if self._half_models is None:
+            self._half_models = (copy.deepcopy(self.fix_flow_complete).half(), copy.deepcopy(self.model).half())
+        return self._half_models
+
+    def inpaint(self, frames, masks, size=(-1, -1), bounding_box=True, resize_ratio=1.0, mask_dilation=4,
+                ref_stride=10, neighbor_length=10, subvideo_length=80, raft_iter=20, fp16=False, video_name='',
+                per_region=False, flow_scale=1.0, cache_owner=None, cache_generation=0, total_cb=None,
+                step_cb=None):
+        """
+        Inpaints the masked region of a video
+
+        :param frames: List of RGB frames as PIL images or uint8 arrays
+        :param masks: List of masks as PIL images or uint8 arrays, non-zero pixels are inpainted.
+                      A single mask is used for every frame
+        :param size: (height, width) the video is processed at if no bounding box is used, (-1, -1) for original size
+        :param bounding_box: Only inpaint the bounding box around all masks
+        :param per_region: With bounding_box, inpaint every separate masked region in its own crop and only in the
+                           frames it is masked in, instead of one crop around all of them. See find_regions
+        :param flow_scale: Estimate and complete the flow at this fraction of the process size, it is upsampled for
+                           image propagation and the transformer. Lower values are faster, 1.0 for full resolution
+        :param cache_owner: Identifier (e.g. the video id) computed flows are cached for
+        :param cache_generation: Version of the frames of cache_owner, flows precomputed for another version are
+                                 not used
+        :param total_cb: Called with the number of steps of the transformer stage
+        :param step_cb: Called after every step of the transformer stage
+        :return: List of the inpainted RGB frames as uint8 arrays in their original size
+        """
+        frames = [f if isinstance(f, Image.Image) else Image.fromarray(f) for f in frames]
+        masks = [m if isinstance(m, Image.Image) else Image.fromarray(m) for m in masks]
+
+        height = size[0]
+        width = size[1]
+
+        # Use fp16 precision during inference to reduce running memory cost
+        use_half = True if fp16 else False
+        if self.device == torch.device('cpu'):
+            use_half = False
+
+        size = frames[0].size
+        if not width == -1 and not height == -1:
+            size = (width, height)
+        if not resize_ratio == 1.0:
+            size = (int(resize_ratio * size[0]), int(resize_ratio * size[1]))
+
         frames_len = len(frames)
-        if bounding_box:
-            flow_masks, masks_dilated, top_left, bottom_right, size, out_size = read_mask(mask, frames_len,
-                                                                                      flow_mask_dilates=mask_dilation,
-                                                                                      mask_dilates=mask_dilation,
-                                                                                      bounding_box=bounding_box)
-            frames, _, _ = crop_images(frames, top_left, bottom_right)
-            frames, _ = resize_frames(frames, size)
-        else:
-            flow_masks, masks_dilated, size = read_mask(mask, frames_len,
-                                                                                          flow_mask_dilates=mask_dilation,
-                                                                                          mask_dilates=mask_dilation,
-                                                                                          size=size,
-                                                                                          bounding_box=bounding_box)
-        w, h = size
-    elif mode == 'video_outpainting':
-        assert scale_h is not None and scale_w is not None, 'Please provide a outpainting scale (s_h, s_w).'
-        frames, flow_masks, masks_dilated, size = extrapolation(frames, (scale_h, scale_w))
-        w, h = size
-    else:
-        raise NotImplementedError
-
-    frames_inp = [np.array(f).astype(np.uint8) for f in frames]
-    frames = to_tensors()(frames).unsqueeze(0) * 2 - 1
-    flow_masks = to_tensors()(flow_masks).unsqueeze(0)
-    masks_dilated = to_tensors()(masks_dilated).unsqueeze(0)
-    frames, flow_masks, masks_dilated = frames.to(device), flow_masks.to(device), masks_dilated.to(device)
-
-    ##############################################
-    # set up RAFT and flow competition model
-    ##############################################
-    ckpt_path = 'saves/raft_things.pth'
-    fix_raft = RAFT_bi(ckpt_path, device)
-
-    ckpt_path = 'saves/recurrent_flow_completion.pth'
-    fix_flow_complete = RecurrentFlowCompleteNet(ckpt_path)
-    for p in fix_flow_complete.parameters():
-        p.requires_grad = False
-    fix_flow_complete.to(device)
-    fix_flow_complete.eval()
-
-    ##############################################
-    # set up ProPainter model
-    ##############################################
-    ckpt_path = 'saves/ProPainter.pth'
-    model = InpaintGenerator(model_path=ckpt_path).to(device)
-    model.eval()
-
-    ##############################################
-    # ProPainter inference
-    ##############################################
-    video_length = frames.size(1)
-    print(f'Processing: {video_name} [{video_length} frames]...')
-    with torch.no_grad():
-        # ---- compute flow ----
-        if frames.size(-1) <= 640:
-            short_clip_len = 12
-        elif frames.size(-1) <= 720:
-            short_clip_len = 8
-        elif frames.size(-1) <= 1280:
-            short_clip_len = 4
+        full_flows = self.get_full_frame_flows(cache_owner, raft_iter, cache_generation)
+        frame_size = frames[0].size
+        clip_args = dict(ref_stride=ref_stride, neighbor_length=neighbor_length, subvideo_length=subvideo_length,
+                         raft_iter=raft_iter, use_half=use_half, video_name=video_name, cache_owner=cache_owner,
+                         flow_scale=flow_scale, step_cb=step_cb)
+        num_steps = len(range(0, frames_len, neighbor_length // 2))
+
+        if not bounding_box:
+            frames, size, out_size = resize_frames(frames, size, bounding_box=bounding_box)
+            flow_masks, masks_dilated, size = process_masks(masks, frames_len, flow_mask_dilates=mask_dilation,
+                                                            mask_dilates=mask_dilation, size=size,
+                                                            bounding_box=bounding_box)
+            if total_cb is not None:
+                total_cb(num_steps)
+            flows_bi = None
+            if full_flows is not None:
+                flows_bi = crop_flows(full_flows, frame_size, (0, 0), (frame_size[0] - 1, frame_size[1] - 1), size)
+            comp_frames = self._inpaint_clip(frames, flow_masks, masks_dilated, size, flows_bi=flows_bi, **clip_args)
+            torch.cuda.empty_cache()
+            return [cv2.resize(f, out_size, interpolation=cv2.INTER_CUBIC) for f in comp_frames]
+
+        if per_region:
+            regions = find_regions(masks, frames_len)
         else:
-            short_clip_len = 2
-
-        # use fp32 for RAFT
-        if frames.size(1) > short_clip_len:
-            gt_flows_f_list, gt_flows_b_list = [], []
-            for f in range(0, video_length, short_clip_len):
-                end_f = min(video_length, f + short_clip_len)
-                if f == 0:
-                    flows_f, flows_b = fix_raft(frames[:, f:end_f], iters=raft_iter)
-                else:
-                    flows_f, flows_b = fix_raft(frames[:, f - 1:end_f], iters=raft_iter)
+            regions = [(find_bounding_box(masks), (0, frames_len))]
+        if total_cb is not None:
+            total_cb(sum(len(range(0, end - start, neighbor_length // 2)) for _, (start, end) in regions))
+
+        res_frames = [f.copy() for f in frames]
+        for box, (start, end) in regions:
+            region_masks = masks[start:end] if len(masks) > 1 else masks
+            flow_masks, masks_dilated, top_left, bottom_right, size, out_size = process_masks(
+                region_masks, end - start, flow_mask_dilates=mask_dilation, mask_dilates=mask_dilation,
+                bounding_box=bounding_box, box=box)
+            crop_frames, _, _ = crop_images(frames[start:end], top_left, bottom_right)
+            crop_frames, _ = resize_frames(crop_frames, size)
+            flows_bi = None
+            if full_flows is not None:
+                flows_bi = crop_flows(tuple(f[:, start:end - 1] for f in full_flows), frame_size, top_left,
+                                      bottom_right, size)
+            comp_frames = self._inpaint_clip(crop_frames, flow_masks, masks_dilated, size, flows_bi=flows_bi,
+                                             **clip_args)
+
+            # Compose frames back together
+            for idx in range(end - start):
+                crop = cv2.resize(comp_frames[idx], out_size, interpolation=cv2.INTER_CUBIC)
+                res_frames[start + idx].paste(Image.fromarray(crop), top_left)
+
+        torch.cuda.empty_cache()
+        return [np.array(f) for f in res_frames]
+
+    def precompute_flows(self, frames, cache_owner, raft_iter=20, generation=0):
+        """
+        Starts computing the flows of the whole frames in a low priority background thread.
+        The result is stored in the flow cache and picked up by inpaint calls with the same cache_owner and generation.
+
+        :param frames: List of frames, or a folder with frame images that is read in the background
+        :param cache_owner: Identifier (e.g. the video id) the flows are computed for
+        :param generation: Version of the frames of cache_owner, e.g. the generation of its FrameStore
+        :return: A future, None if the engine has no flow cache
+        """
+        if self.flow_cache is None:
+            return None
+        with self._precompute_lock:
+            if self._precompute_executor is None:
+                self._precompute_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='flow',
+                                                               initializer=_init_precompute_worker)
+            future = self._precompute_executor.submit(self._precompute, frames, cache_owner, raft_iter, generation)
+            self._precomputed[cache_owner] = (generation, future)
+        return future
+
+    def _precompute(self, frames, cache_owner, raft_iter, generation):
+        if isinstance(frames, str):
+            frames = read_frame_from_videos(frames)[0]
+        frames, _ = self._full_frames(frames)
+        frames = (to_tensors()(frames).unsqueeze(0) * 2 - 1).to(self.device)
+        flows_bi = self.compute_flows(frames, raft_iter)
+        self.flow_cache.put(self._owner_flow_key(cache_owner, generation, raft_iter), flows_bi, owner=cache_owner)
+        torch.cuda.empty_cache()
 
-                gt_flows_f_list.append(flows_f)
-                gt_flows_b_list.append(flows_b)
+    @staticmethod
+    def _full_frames(frames):
+        frames = [f if isinstance(f, Image.Image) else Image.fromarray(f) for f in frames]
+        frames, size, _ = resize_frames(frames, frames[0].size, bounding_box=False)
+        return frames, size
+
+    def get_full_frame_flows(self, cache_owner, raft_iter, generation=0):
+        """
+        Returns the flows precomputed for cache_owner. Waits for the precomputation only if it is already running,
+        a precomputation that is still queued behind other videos is cancelled, the caller computes the flows itself
+
+        :return: Forward and backward flows of the whole frames, None if no flows were precomputed for this
+                 generation of the frames
+        """
+        entry = self._precomputed.get(cache_owner)
+        if entry is None or entry[0] != generation or self.flow_cache is None:
+            return None
+        future = entry[1]
+        if future.cancel():
+            with self._precompute_lock:
+                if self._precomputed.get(cache_owner) is entry:
+                    del self._precomputed[cache_owner]
+            return None
+        try:
+            future.result()
+        except Exception as e:
+            print('Flow precomputation failed: ', e)
+            return None
+        return self.flow_cache.get(self._owner_flow_key(cache_owner, generation, raft_iter))
+
+    def forget(self, cache_owner):
+        """
+        Drops the precomputed and cached flows of cache_owner, e.g. when its video is deleted
+        """
+        with self._precompute_lock:
+            entry = self._precomputed.pop(cache_owner, None)
+        if entry is not None:
+            entry[1].cancel()
+        if self.flow_cache is not None:
+            self.flow_cache.evict_owner(cache_owner)
+
+    def _flow_key(self, frames_inp, raft_iter, flow_size):
+        return flow_key(frames_inp, raft_iter, self.raft_tol, tuple(flow_size), self.raft_path)
+
+    def _owner_flow_key(self, cache_owner, generation, raft_iter):
+        return owner_flow_key(cache_owner, generation, raft_iter, self.raft_tol, self.raft_path)
+
+    def compute_flows(self, frames, raft_iter=20, frames_inp=None, cache_owner=None):
+        """
+        Computes the bidirectional optical flow of a clip, using the flow cache if one is set
+
+        :param frames: Frame tensor of shape (1, T, 3, H, W) in [-1, 1] on the device
+        :param frames_inp: The same frames as uint8 arrays, used as cache key
+        :param cache_owner: Identifier (e.g. the video id) the cached flows are stored for
+        :return: Forward and backward flows of shape (1, T - 1, 2, H, W)
+        """
+        key = None
+        if self.flow_cache is not None and frames_inp is not None:
+            key = self._flow_key(frames_inp, raft_iter, frames.shape[-2:])
+            cached = self.flow_cache.get(key)
+            if cached is not None:
+                return cached[0].to(self.device), cached[1].to(self.device)
+
+        fix_raft = self.fix_raft
+        video_length = frames.size(1)
+        local_corr = self.raft_corr == 'local' or (self.raft_corr == 'auto' and frames.size(-1) > 640)
+        with torch.no_grad():
+            if local_corr:
+                # Memory grows linearly with the frame size
+                if frames.size(-1) <= 720:
+                    short_clip_len = 12
+                elif frames.size(-1) <= 1280:
+                    short_clip_len = 8
+                else:
+                    short_clip_len = 4
+            elif frames.size(-1) <= 640:
+                short_clip_len = 12
+            elif frames.size(-1) <= 720:
+                short_clip_len = 8
+            elif frames.size(-1) <= 1280:
+                short_clip_len = 4
+            else:
+                short_clip_len = 2
+
+            # use fp32 for RAFT
+            if frames.size(1) > short_clip_len:
+                gt_flows_f_list, gt_flows_b_list = [], []
+                # Features of the last frame of the previous clip, so boundary frames are only encoded once
+                feats = None
+                for f in range(0, video_length, short_clip_len):
+                    end_f = min(video_length, f + short_clip_len)
+                    flows_f, flows_b, feats = fix_raft(frames[:, f:end_f], iters=raft_iter, prev_feats=feats,
+                                                       return_feats=True, tol=self.raft_tol, local_corr=local_corr)
+
+                    gt_flows_f_list.append(flows_f)
+                    gt_flows_b_list.append(flows_b)
+                    torch.cuda.empty_cache()
+
+                gt_flows_f = torch.cat(gt_flows_f_list, dim=1)
+                gt_flows_b = torch.cat(gt_flows_b_list, dim=1)
+                gt_flows_bi = (gt_flows_f, gt_flows_b)
+            else:
+                gt_flows_bi = fix_raft(frames, iters=raft_iter, tol=self.raft_tol, local_corr=local_corr)
                 torch.cuda.empty_cache()
 
-            gt_flows_f = torch.cat(gt_flows_f_list, dim=1)
-            gt_flows_b = torch.cat(gt_flows_b_list, dim=1)
-            gt_flows_bi = (gt_flows_f, gt_flows_b)
-        else:
-            gt_flows_bi = fix_raft(frames, iters=raft_iter)
-            torch.cuda.empty_cache()
+        if key is not None:
+            self.flow_cache.put(key, gt_flows_bi, owner=cache_owner)
+        return gt_flows_bi
 
-        if use_half:
-            frames, flow_masks, masks_dilated = frames.half(), flow_masks.half(), masks_dilated.half()
-            gt_flows_bi = (gt_flows_bi[0].half(), gt_flows_bi[1].half())
-            fix_flow_complete = fix_flow_complete.half()
-            model = model.half()
-
-        # ---- complete flow ----
-        flow_length = gt_flows_bi[0].size(1)
-        if flow_length > subvideo_length:
-            pred_flows_f, pred_flows_b = [], []
-            pad_len = 5
-            for f in range(0, flow_length, subvideo_length):
-                s_f = max(0, f - pad_len)
-                e_f = min(flow_length, f + subvideo_length + pad_len)
-                pad_len_s = max(0, f) - s_f
-                pad_len_e = e_f - min(flow_length, f + subvideo_length)
-                pred_flows_bi_sub, _ = fix_flow_complete.forward_bidirect_flow(
-                    (gt_flows_bi[0][:, s_f:e_f], gt_flows_bi[1][:, s_f:e_f]),
-                    flow_masks[:, s_f:e_f + 1])
-                pred_flows_bi_sub = fix_flow_complete.combine_flow(
-                    (gt_flows_bi[0][:, s_f:e_f], gt_flows_bi[1][:, s_f:e_f]),
-                    pred_flows_bi_sub,
-                    flow_masks[:, s_f:e_f + 1])
-
-                pred_flows_f.append(pred_flows_bi_sub[0][:, pad_len_s:e_f - s_f - pad_len_e])
-                pred_flows_b.append(pred_flows_bi_sub[1][:, pad_len_s:e_f - s_f - pad_len_e])
-                torch.cuda.empty_cache()
+    def _inpaint_clip(self, frames, flow_masks, masks_dilated, size, ref_stride=10, neighbor_length=10,
+                      subvideo_length=80, raft_iter=20, use_half=False, video_name='', cache_owner=None,
+                      flows_bi=None, flow_scale=1.0, step_cb=None):
+        """
+        Runs flow estimation, flow completion, image propagation and the transformer on frames that are already
+        cropped and resized to size
 
-            pred_flows_f = torch.cat(pred_flows_f, dim=1)
-            pred_flows_b = torch.cat(pred_flows_b, dim=1)
-            pred_flows_bi = (pred_flows_f, pred_flows_b)
-        else:
-            pred_flows_bi, _ = fix_flow_complete.forward_bidirect_flow(gt_flows_bi, flow_masks)
-            pred_flows_bi = fix_flow_complete.combine_flow(gt_flows_bi, pred_flows_bi, flow_masks)
-            torch.cuda.empty_cache()
+        :param flows_bi: Already computed flows of the clip, RAFT is skipped if they are given
+        :param flow_scale: Fraction of size the flow is estimated and completed at, see get_flow_size
 
-        # ---- image propagation ----
-        masked_frames = frames * (1 - masks_dilated)
-        subvideo_length_img_prop = min(100, subvideo_length)  # ensure a minimum of 100 frames for image propagation
-        if video_length > subvideo_length_img_prop:
-            updated_frames, updated_masks = [], []
-            pad_len = 10
-            for f in range(0, video_length, subvideo_length_img_prop):
-                s_f = max(0, f - pad_len)
-                e_f = min(video_length, f + subvideo_length_img_prop + pad_len)
-                pad_len_s = max(0, f) - s_f
-                pad_len_e = e_f - min(video_length, f + subvideo_length_img_prop)
-
-                b, t, _, _, _ = masks_dilated[:, s_f:e_f].size()
-                pred_flows_bi_sub = (pred_flows_bi[0][:, s_f:e_f - 1], pred_flows_bi[1][:, s_f:e_f - 1])
-                prop_imgs_sub, updated_local_masks_sub = model.img_propagation(masked_frames[:, s_f:e_f],
-                                                                               pred_flows_bi_sub,
-                                                                               masks_dilated[:, s_f:e_f],
-                                                                               'nearest')
-                updated_frames_sub = frames[:, s_f:e_f] * (1 - masks_dilated[:, s_f:e_f]) + \
-                                     prop_imgs_sub.view(b, t, 3, h, w) * masks_dilated[:, s_f:e_f]
-                updated_masks_sub = updated_local_masks_sub.view(b, t, 1, h, w)
-
-                updated_frames.append(updated_frames_sub[:, pad_len_s:e_f - s_f - pad_len_e])
-                updated_masks.append(updated_masks_sub[:, pad_len_s:e_f - s_f - pad_len_e])
+        :return: List of the inpainted RGB frames as uint8 arrays in the process size
+        """
+        device = self.device
+        w, h = size
+
+        frames_inp = [np.array(f).astype(np.uint8) for f in frames]
+        frames = to_tensors()(frames).unsqueeze(0) * 2 - 1
+        flow_masks = to_tensors()(flow_masks).unsqueeze(0)
+        masks_dilated = to_tensors()(masks_dilated).unsqueeze(0)
+        frames, flow_masks, masks_dilated = frames.to(device), flow_masks.to(device), masks_dilated.to(device)
+
+        fix_flow_complete, model = self.get_models(use_half)
+
+        ##############################################
+        # ProPainter inference
+        ##############################################
+        video_length = frames.size(1)
+        print(f'Processing: {video_name} [{video_length} frames]...')
+        flow_w, flow_h = get_flow_size(size, flow_scale)
+        low_res_flow = (flow_w, flow_h) != (w, h)
+        with torch.no_grad():
+            # ---- compute flow ----
+            if flows_bi is not None:
+                gt_flows_bi = (flows_bi[0].to(device), flows_bi[1].to(device))
+                if low_res_flow:
+                    gt_flows_bi = tuple(resize_flow_pytorch(f, flow_h, flow_w) for f in gt_flows_bi)
+            elif low_res_flow:
+                gt_flows_bi = self.compute_flows(resize_clip(frames, (flow_w, flow_h)), raft_iter,
+                                                 frames_inp=frames_inp, cache_owner=cache_owner)
+            else:
+                gt_flows_bi = self.compute_flows(frames, raft_iter, frames_inp=frames_inp, cache_owner=cache_owner)
+
+            if low_res_flow:
+                # Any masked pixel marks the low resolution pixel as masked
+                flow_masks = (resize_clip(flow_masks, (flow_w, flow_h)) > 0).to(flow_masks.dtype)
+
+            if use_half:
+                frames, flow_masks, masks_dilated = frames.half(), flow_masks.half(), masks_dilated.half()
+                gt_flows_bi = (gt_flows_bi[0].half(), gt_flows_bi[1].half())
+
+            # Completion and propagation leave frames without mask unchanged, so spans without any masked frame are
+            # passed through. Padding frames of a span are still read by its masked neighbours.
+            flow_occupancy = mask_occupancy(flow_masks)
+            occupancy = mask_occupancy(masks_dilated)
+
+            # ---- complete flow ----
+            flow_length = gt_flows_bi[0].size(1)
+            if not flow_occupancy.any():
+                pred_flows_bi = gt_flows_bi
+            elif flow_length > subvideo_length:
+                pred_flows_f, pred_flows_b = [], []
+                pad_len = 5
+                for f in range(0, flow_length, subvideo_length):
+                    # Forward flow i is masked by frame i, backward flow i by frame i + 1
+                    if not flow_occupancy[f:min(flow_length, f + subvideo_length) + 1].any():
+                        pred_flows_f.append(gt_flows_bi[0][:, f:f + subvideo_length])
+                        pred_flows_b.append(gt_flows_bi[1][:, f:f + subvideo_length])
+                        continue
+                    s_f = max(0, f - pad_len)
+                    e_f = min(flow_length, f + subvideo_length + pad_len)
+                    pad_len_s = max(0, f) - s_f
+                    pad_len_e = e_f - min(flow_length, f + subvideo_length)
+                    pred_flows_bi_sub, _ = fix_flow_complete.forward_bidirect_flow(
+                        (gt_flows_bi[0][:, s_f:e_f], gt_flows_bi[1][:, s_f:e_f]),
+                        flow_masks[:, s_f:e_f + 1])
+                    pred_flows_bi_sub = fix_flow_complete.combine_flow(
+                        (gt_flows_bi[0][:, s_f:e_f], gt_flows_bi[1][:, s_f:e_f]),
+                        pred_flows_bi_sub,
+                        flow_masks[:, s_f:e_f + 1])
+
+                    pred_flows_f.append(pred_flows_bi_sub[0][:, pad_len_s:e_f - s_f - pad_len_e])
+                    pred_flows_b.append(pred_flows_bi_sub[1][:, pad_len_s:e_f - s_f - pad_len_e])
+                    torch.cuda.empty_cache()
+
+                pred_flows_f = torch.cat(pred_flows_f, dim=1)
+                pred_flows_b = torch.cat(pred_flows_b, dim=1)
+                pred_flows_bi = (pred_flows_f, pred_flows_b)
+            else:
+                pred_flows_bi, _ = fix_flow_complete.forward_bidirect_flow(gt_flows_bi, flow_masks)
+                pred_flows_bi = fix_flow_complete.combine_flow(gt_flows_bi, pred_flows_bi, flow_masks)
                 torch.cuda.empty_cache()
 
-            updated_frames = torch.cat(updated_frames, dim=1)
-            updated_masks = torch.cat(updated_masks, dim=1)
+            if low_res_flow:
+                pred_flows_bi = tuple(resize_flow_pytorch(f, h, w) for f in pred_flows_bi)
+
+            # ---- image propagation ----
+            masked_frames = frames * (1 - masks_dilated)
+            subvideo_length_img_prop = min(100, subvideo_length)  # ensure a minimum of 100 frames for image propagation
+            if not occupancy.any():
+                updated_frames, updated_masks = frames, masks_dilated
+            elif video_length > subvideo_length_img_prop:
+                updated_frames, updated_masks = [], []
+                pad_len = 10
+                for f in range(0, video_length, subvideo_length_img_prop):
+                    if not occupancy[f:f + subvideo_length_img_prop].any():
+                        updated_frames.append(frames[:, f:f + subvideo_length_img_prop])
+                        updated_masks.append(masks_dilated[:, f:f + subvideo_length_img_prop])
+                        continue
+                    s_f = max(0, f - pad_len)
+                    e_f = min(video_length, f + subvideo_length_img_prop + pad_len)
+                    pad_len_s = max(0, f) - s_f
+                    pad_len_e = e_f - min(video_length, f + subvideo_length_img_prop)
+
+                    b, t, _, _, _ = masks_dilated[:, s_f:e_f].size()
+                    pred_flows_bi_sub = (pred_flows_bi[0][:, s_f:e_f - 1], pred_flows_bi[1][:, s_f:e_f - 1])
+                    prop_imgs_sub, updated_local_masks_sub = model.img_propagation(masked_frames[:, s_f:e_f],
+                                                                                   pred_flows_bi_sub,
+                                                                                   masks_dilated[:, s_f:e_f],
+                                                                                   'nearest')
+                    updated_frames_sub = frames[:, s_f:e_f] * (1 - masks_dilated[:, s_f:e_f]) + \
+                                         prop_imgs_sub.view(b, t, 3, h, w) * masks_dilated[:, s_f:e_f]
+                    updated_masks_sub = updated_local_masks_sub.view(b, t, 1, h, w)
+
+                    updated_frames.append(updated_frames_sub[:, pad_len_s:e_f - s_f - pad_len_e])
+                    updated_masks.append(updated_masks_sub[:, pad_len_s:e_f - s_f - pad_len_e])
+                    torch.cuda.empty_cache()
+
+                updated_frames = torch.cat(updated_frames, dim=1)
+                updated_masks = torch.cat(updated_masks, dim=1)
+            else:
+                b, t, _, _, _ = masks_dilated.size()
+                prop_imgs, updated_local_masks = model.img_propagation(masked_frames, pred_flows_bi, masks_dilated,
+                                                                       'nearest')
+                updated_frames = frames * (1 - masks_dilated) + prop_imgs.view(b, t, 3, h, w) * masks_dilated
+                updated_masks = updated_local_masks.view(b, t, 1, h, w)
+                torch.cuda.empty_cache()
+
+        ori_frames = frames_inp
+        comp_frames = [None] * video_length
+
+        neighbor_stride = neighbor_length // 2
+        if video_length > subvideo_length:
+            ref_num = subvideo_length // ref_stride
         else:
-            b, t, _, _, _ = masks_dilated.size()
-            prop_imgs, updated_local_masks = model.img_propagation(masked_frames, pred_flows_bi, masks_dilated,
-                                                                   'nearest')
-            updated_frames = frames * (1 - masks_dilated) + prop_imgs.view(b, t, 3, h, w) * masks_dilated
-            updated_masks = updated_local_masks.view(b, t, 1, h, w)
+            ref_num = -1
+
+        # ---- feature propagation + transformer ----
+        for f in tqdm(range(0, video_length, neighbor_stride)):
+            neighbor_ids = [
+                i for i in range(max(0, f - neighbor_stride),
+                                 min(video_length, f + neighbor_stride + 1))
+            ]
+            if not occupancy[neighbor_ids].any():
+                # The transformer output is only used inside the mask
+                for idx in neighbor_ids:
+                    if comp_frames[idx] is None:
+                        comp_frames[idx] = ori_frames[idx]
+                if step_cb is not None:
+                    step_cb()
+                continue
+            ref_ids = get_ref_index(f, neighbor_ids, video_length, ref_stride, ref_num)
+            selected_imgs = updated_frames[:, neighbor_ids + ref_ids, :, :, :]
+            selected_masks = masks_dilated[:, neighbor_ids + ref_ids, :, :, :]
+            selected_update_masks = updated_masks[:, neighbor_ids + ref_ids, :, :, :]
+            selected_pred_flows_bi = (
+                pred_flows_bi[0][:, neighbor_ids[:-1], :, :, :], pred_flows_bi[1][:, neighbor_ids[:-1], :, :, :])
+
+            with torch.no_grad():
+                # 1.0 indicates mask
+                l_t = len(neighbor_ids)
+
+                # pred_img = selected_imgs # results of image propagation
+                pred_img = model(selected_imgs, selected_pred_flows_bi, selected_masks, selected_update_masks, l_t)
+
+                pred_img = pred_img.view(-1, 3, h, w)
+
+                pred_img = (pred_img + 1) / 2
+                pred_img = pred_img.cpu().permute(0, 2, 3, 1).numpy() * 255
+                binary_masks = masks_dilated[0, neighbor_ids, :, :, :].cpu().permute(
+                    0, 2, 3, 1).numpy().astype(np.uint8)
+                for i in range(len(neighbor_ids)):
+                    idx = neighbor_ids[i]
+                    img = np.array(pred_img[i]).astype(np.uint8) * binary_masks[i] \
+                          + ori_frames[idx] * (1 - binary_masks[i])
+                    if comp_frames[idx] is None:
+                        comp_frames[idx] = img
+                    else:
+                        comp_frames[idx] = comp_frames[idx].astype(np.float32) * 0.5 + img.astype(np.float32) * 0.5
+
+                    comp_frames[idx] = comp_frames[idx].astype(np.uint8)
+
             torch.cuda.empty_cache()
+            if step_cb is not None:
+                step_cb()
 
-    ori_frames = frames_inp
-    comp_frames = [None] * video_length
+        return comp_frames
 
-    neighbor_stride = neighbor_length // 2
-    if video_length > subvideo_length:
-        ref_num = subvideo_length // ref_stride
-    else:
-        ref_num = -1
-
-    # ---- feature propagation + transformer ----
-    for f in tqdm(range(0, video_length, neighbor_stride)):
-        neighbor_ids = [
-            i for i in range(max(0, f - neighbor_stride),
-                             min(video_length, f + neighbor_stride + 1))
-        ]
-        ref_ids = get_ref_index(f, neighbor_ids, video_length, ref_stride, ref_num)
-        selected_imgs = updated_frames[:, neighbor_ids + ref_ids, :, :, :]
-        selected_masks = masks_dilated[:, neighbor_ids + ref_ids, :, :, :]
-        selected_update_masks = updated_masks[:, neighbor_ids + ref_ids, :, :, :]
-        selected_pred_flows_bi = (
-            pred_flows_bi[0][:, neighbor_ids[:-1], :, :, :], pred_flows_bi[1][:, neighbor_ids[:-1], :, :, :])
 
-        with torch.no_grad():
-            # 1.0 indicates mask
-            l_t = len(neighbor_ids)
-
-            # pred_img = selected_imgs # results of image propagation
-            pred_img = model(selected_imgs, selected_pred_flows_bi, selected_masks, selected_update_masks, l_t)
-
-            pred_img = pred_img.view(-1, 3, h, w)
-
-            pred_img = (pred_img + 1) / 2
-            pred_img = pred_img.cpu().permute(0, 2, 3, 1).numpy() * 255
-            binary_masks = masks_dilated[0, neighbor_ids, :, :, :].cpu().permute(
-                0, 2, 3, 1).numpy().astype(np.uint8)
-            for i in range(len(neighbor_ids)):
-                idx = neighbor_ids[i]
-                img = np.array(pred_img[i]).astype(np.uint8) * binary_masks[i] \
-                      + ori_frames[idx] * (1 - binary_masks[i])
-                if comp_frames[idx] is None:
-                    comp_frames[idx] = img
-                else:
-                    comp_frames[idx] = comp_frames[idx].astype(np.float32) * 0.5 + img.astype(np.float32) * 0.5
+_default_engine = None
+_default_engine_lock = threading.Lock()
 
-                comp_frames[idx] = comp_frames[idx].astype(np.uint8)
 
-        torch.cuda.empty_cache()
+def get_engine():
+    """
+    :return: The inpainting engine shared by the whole process, created on first use
+    """
+    global _default_engine
+    with _default_engine_lock:
+        if _default_engine is None:
+            _default_engine = InpaintingEngine()
+    return _default_engine
 
-    res_frames = []
-    for idx in range(video_length):
-        # Compose frames back together and save
-        if bounding_box:
-            crop = comp_frames[idx]
-            frame = out_frames[idx]
-            crop = cv2.resize(crop, out_size, interpolation=cv2.INTER_CUBIC)
-            # crop = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
-            crop_img = Image.fromarray(crop)
-            frame.paste(crop_img, top_left)
-            res_frames.append(frame)
-            img_output = os.path.join(output, str(idx).zfill(5) + '.png')
-            frame.save(img_output)
-        else:
-            f = comp_frames[idx]
-            f = cv2.resize(f, out_size, interpolation=cv2.INTER_CUBIC)
-            f = cv2.cvtColor(f, cv2.COLOR_BGR2RGB)
-            img_output = os.path.join(output, str(idx).zfill(5) + '.png')
-            imwrite(f, img_output)
 
-torch.cuda.empty_cache()
+def inpaint(video_path, mask_path, output_folder, size=(-1, -1), bounding_box=True, per_region=False, engine=None,
+            flow_scale=1.0, cache_owner=None, total_cb=None, step_cb=None):
+    """
+    Inpaints the frames in video_path with the masks in mask_path and saves the result in output_folder
+    total_cb, step_cb - Progress callbacks, see InpaintingEngine.inpaint
+    """
+    if engine is None:
+        engine = get_engine()
+
+    frames, fps, _, video_name = read_frame_from_videos(video_path)
+    masks = read_mask_images(mask_path)
+    res_frames = engine.inpaint(frames, masks, size=size, bounding_box=bounding_box, per_region=per_region,
+                                flow_scale=flow_scale, video_name=video_name, cache_owner=cache_owner,
+                                total_cb=total_cb, step_cb=step_cb)
+
+    os.makedirs(output_folder, exist_ok=True)
+    for idx, frame in enumerate(res_frames):
+        img_output = os.path.join(output_folder, str(idx).zfill(5) + '.png')
+        imwrite(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), img_output)
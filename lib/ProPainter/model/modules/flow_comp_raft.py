@@ -1,4 +1,6 @@
 import argparse
+import threading
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -15,6 +17,7 @@ def initialize_RAFT(model_path='weights/raft-things.pth', device='cuda'):
     args.small = False
     args.mixed_precision = False
     args.alternate_corr = False
+    args.local_corr = False
     model = torch.nn.DataParallel(RAFT(args))
     model.load_state_dict(torch.load(args.raft_model, map_location='cpu'))
     model = model.module
@@ -36,20 +39,67 @@ class RAFT_bi(nn.Module):
         self.l1_criterion = nn.L1Loss()
         self.eval()
 
-    def forward(self, gt_local_frames, iters=20):
+        self._stats_lock = threading.Lock()
+        self.reset_iteration_stats()
+
+    def reset_iteration_stats(self):
+        with self._stats_lock:
+            self.num_pairs = 0
+            self.num_iters = 0
+            self.max_iters = 0
+
+    def iteration_stats(self):
+        """RAFT iterations used since the last reset.
+
+        Returns:
+            dict: Number of frame pairs, mean and maximum number of iterations per pair.
+        """
+        with self._stats_lock:
+            mean_iters = self.num_iters / self.num_pairs if self.num_pairs > 0 else 0.0
+            return {'pairs': self.num_pairs, 'mean_iters': mean_iters, 'max_iters': self.max_iters}
+
+    def forward(self, gt_local_frames, iters=20, prev_feats=None, return_feats=False, tol=None, local_corr=False):
+        """Bidirectional flow between consecutive frames, every frame is encoded once.
+
+        Args:
+            gt_local_frames (Tensor): Frames of shape (b, t, c, h, w).
+            prev_feats (tuple, optional): RAFT features of the frame before gt_local_frames, as returned with
+                return_feats by the previous clip. The flows between that frame and the first frame are included,
+                so a video can be processed in consecutive clips without encoding the boundary frames twice.
+            return_feats (bool): Also return the features of the last frame.
+            iters (int): Maximum number of RAFT iterations.
+            tol (float, optional): Stop refining once the mean flow update of every pair is below tol,
+                see RAFT.forward. All iterations are run if None.
+            local_corr (bool): Look up the correlation on demand (LocalCorrBlock) instead of building the
+                all-pairs volume, memory is linear instead of quadratic in the number of pixels.
+
+        Returns:
+            tuple[Tensor]: Forward and backward flows of shape (b, t - 1, 2, h, w), (b, t, 2, h, w) with
+            prev_feats, and the features of the last frame if return_feats is set.
+        """
         b, l_t, c, h, w = gt_local_frames.size()
-        # print(gt_local_frames.shape)
 
         with torch.no_grad():
-            gtlf_1 = gt_local_frames[:, :-1, :, :, :].reshape(-1, c, h, w)
-            gtlf_2 = gt_local_frames[:, 1:, :, :, :].reshape(-1, c, h, w)
-            _, gt_flows_forward = self.fix_raft(gtlf_1, gtlf_2, iters=iters, test_mode=True)
-            _, gt_flows_backward = self.fix_raft(gtlf_2, gtlf_1, iters=iters, test_mode=True)
-
-        
-        gt_flows_forward = gt_flows_forward.view(b, l_t-1, 2, h, w)
-        gt_flows_backward = gt_flows_backward.view(b, l_t-1, 2, h, w)
-
+            feats = self.fix_raft.encode(gt_local_frames.reshape(-1, c, h, w))
+            feats = [f.view(b, l_t, *f.shape[1:]) for f in feats]
+            if prev_feats is not None:
+                feats = [torch.cat([p.unsqueeze(1), f], 1) for p, f in zip(prev_feats, feats)]
+            num_pairs = feats[0].shape[1] - 1
+            feats1 = [f[:, :-1].reshape(-1, *f.shape[2:]) for f in feats]
+            feats2 = [f[:, 1:].reshape(-1, *f.shape[2:]) for f in feats]
+            gt_flows_forward, gt_flows_backward, used_iters = self.fix_raft.forward_bi(feats1, feats2, iters=iters,
+                                                                                      tol=tol, local_corr=local_corr)
+
+        with self._stats_lock:
+            self.num_pairs += b * num_pairs
+            self.num_iters += b * num_pairs * used_iters
+            self.max_iters = max(self.max_iters, used_iters)
+
+        gt_flows_forward = gt_flows_forward.view(b, num_pairs, 2, h, w)
+        gt_flows_backward = gt_flows_backward.view(b, num_pairs, 2, h, w)
+
+        if return_feats:
+            return gt_flows_forward, gt_flows_backward, tuple(f[:, -1] for f in feats)
         return gt_flows_forward, gt_flows_backward
 
 
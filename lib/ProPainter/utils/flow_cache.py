@@ -0,0 +1,200 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .flow_util import quantize_flow, dequantize_flow
+
+
+def flow_key(frames, *params):
+    """Hash frames and flow parameters into a cache key.
+
+    Args:
+        frames (list[ndarray]): uint8 frames the flow is computed on.
+        params: Anything else the flow depends on, e.g. the RAFT iterations.
+
+    Returns:
+        str: Hex digest identifying the flow.
+    """
+    h = hashlib.sha1()
+    h.update(repr((len(frames), frames[0].shape, params)).encode('utf-8'))
+    for f in frames:
+        h.update(np.ascontiguousarray(f).data)
+    return h.hexdigest()
+
+
+def owner_flow_key(owner, generation, *params):
+    """Cache key for flows identified by their owner instead of their frames.
+
+    Hashing the frames is not needed when the owner (e.g. a video id) and a
+    generation number that changes whenever its frames change identify them.
+
+    Args:
+        owner (str): Identifier of the frames, e.g. a video id.
+        generation (int): Version of the owner's frames.
+        params: Anything else the flow depends on, e.g. the RAFT iterations.
+
+    Returns:
+        str: Hex digest identifying the flow.
+    """
+    return hashlib.sha1(repr((owner, generation, params)).encode('utf-8')).hexdigest()
+
+
+def quantize_flows(flows, dtype=np.uint16):
+    """Quantize a (T, 2, H, W) flow tensor to 16 bit (or dtype).
+
+    The quantization range is chosen per frame from the largest motion, so no
+    flow is truncated. With 65535 levels a single large motion vector does not
+    noticeably coarsen the step size of the rest of the frame.
+
+    Returns:
+        tuple[ndarray]: dx and dy of shape (T, H, W) and the per frame max_val.
+    """
+    flows = flows.float().cpu().permute(0, 2, 3, 1).numpy()
+    h, w = flows.shape[1:3]
+    dxs, dys, max_vals = [], [], []
+    for flow in flows:
+        max_val = max(float(np.abs(flow[..., 0]).max()) / w, float(np.abs(flow[..., 1]).max()) / h, 1e-6)
+        dx, dy = quantize_flow(flow, max_val=max_val, dtype=dtype)
+        dxs.append(dx)
+        dys.append(dy)
+        max_vals.append(max_val)
+    return np.stack(dxs), np.stack(dys), np.array(max_vals, dtype=np.float32)
+
+
+def dequantize_flows(dx, dy, max_vals):
+    """Inverse of :func:`quantize_flows`.
+
+    Returns:
+        Tensor: Flow of shape (T, 2, H, W).
+    """
+    flows = [dequantize_flow(dx[i], dy[i], max_val=float(max_vals[i])) for i in range(len(max_vals))]
+    return torch.from_numpy(np.stack(flows).astype(np.float32)).permute(0, 3, 1, 2)
+
+
+def round_trip_epe(flows, quantized):
+    """Error introduced by quantizing flows.
+
+    Args:
+        flows (Tensor): Flow of shape (T, 2, H, W).
+        quantized (tuple[ndarray]): The output of :func:`quantize_flows`.
+
+    Returns:
+        tuple[float]: Mean and maximum end-point error in pixels.
+    """
+    epe = torch.norm(dequantize_flows(*quantized) - flows.float().cpu(), dim=1)
+    return float(epe.mean()), float(epe.max())
+
+
+class FlowCache:
+    """On-disk cache for bidirectional optical flow.
+
+    Flows are stored quantized to uint16 in one .npz file per entry. The total
+    size is bounded, the least recently used entries are evicted first. Every
+    entry can be tagged with an owner (e.g. a video id) so that all flows of a
+    session can be removed when the session is cleaned up.
+
+    Args:
+        max_epe (float): Flows whose mean end-point error after the
+            quantization round trip is above this (in pixels) are not cached,
+            so a cache hit gives the same flow as a fresh RAFT run.
+    """
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 ** 2, max_epe=0.01):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_epe = max_epe
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # key -> (path, size in bytes, owner), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        # Largest mean round trip error of a stored entry, and number of entries rejected for their error
+        self.max_round_trip_epe = 0.0
+        self.rejected = 0
+
+    def get(self, key):
+        """Returns the cached (forward, backward) flows of shape (1, T, 2, H, W) or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            with np.load(entry[0]) as data:
+                flows_f = dequantize_flows(data['f_dx'], data['f_dy'], data['f_max'])
+                flows_b = dequantize_flows(data['b_dx'], data['b_dy'], data['b_max'])
+        except (OSError, KeyError, ValueError):
+            self._remove(key)
+            return None
+        return flows_f.unsqueeze(0), flows_b.unsqueeze(0)
+
+    def put(self, key, flows_bi, owner=None):
+        """Stores (forward, backward) flows of shape (1, T, 2, H, W).
+
+        Returns:
+            bool: False if the flows were not stored because quantizing them
+                changed them by more than max_epe.
+        """
+        f_dx, f_dy, f_max = quantized_f = quantize_flows(flows_bi[0][0])
+        b_dx, b_dy, b_max = quantized_b = quantize_flows(flows_bi[1][0])
+        epe = max(round_trip_epe(flows_bi[0][0], quantized_f)[0], round_trip_epe(flows_bi[1][0], quantized_b)[0])
+        if epe > self.max_epe:
+            with self._lock:
+                self.rejected += 1
+            return False
+        path = os.path.join(self.cache_dir, key + '.npz')
+        np.savez_compressed(path, f_dx=f_dx, f_dy=f_dy, f_max=f_max, b_dx=b_dx, b_dy=b_dy, b_max=b_max)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (path, size, owner)
+            self._size += size
+            evicted = []
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                old_key, old = self._entries.popitem(last=False)
+                self._size -= old[1]
+                evicted.append(old[0])
+            self.max_round_trip_epe = max(self.max_round_trip_epe, epe)
+        for p in evicted:
+            _remove_file(p)
+        return True
+
+    def evict_owner(self, owner):
+        """Removes all flows stored for owner."""
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if e[2] == owner]
+        for key in keys:
+            self._remove(key)
+
+    def _remove(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            self._size -= entry[1]
+        _remove_file(entry[0])
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,21 +1,24 @@
 import cv2
 import numpy as np
 import os
+import torch
 import torch.nn.functional as F
 
 def resize_flow(flow, newh, neww):
     oldh, oldw = flow.shape[0:2]
     flow = cv2.resize(flow, (neww, newh), interpolation=cv2.INTER_LINEAR)
-    flow[:, :, 0] *= newh / oldh
-    flow[:, :, 1] *= neww / oldw
+    # Channel 0 is the horizontal, channel 1 the vertical component
+    flow[:, :, 0] *= neww / oldw
+    flow[:, :, 1] *= newh / oldh
     return flow
 
 def resize_flow_pytorch(flow, newh, neww):
-    oldh, oldw = flow.shape[-2:]
-    flow = F.interpolate(flow, (newh, neww), mode='bilinear')
-    flow[:, :, 0] *= newh / oldh
-    flow[:, :, 1] *= neww / oldw
-    return flow
+    """Resize flows of shape (..., 2, H, W) and rescale the flow vectors to the new size."""
+    shape = flow.shape
+    oldh, oldw = shape[-2:]
+    flow = F.interpolate(flow.reshape(-1, 2, oldh, oldw), (newh, neww), mode='bilinear', align_corners=False)
+    flow = torch.stack((flow[:, 0] * (neww / oldw), flow[:, 1] * (newh / oldh)), dim=1)
+    return flow.view(*shape[:-2], newh, neww)
 
 
 def imwrite(img, file_path, params=None, auto_mkdir=True):
@@ -99,8 +102,8 @@ def flowwrite(flow, filename, quantize=False, concat_axis=0, *args, **kwargs):
         # imwrite(dxdy, filename)
 
 
-def quantize_flow(flow, max_val=0.02, norm=True):
-    """Quantize flow to [0, 255].
+def quantize_flow(flow, max_val=0.02, norm=True, dtype=np.uint8):
+    """Quantize flow to [0, 255], or to the range of dtype.
 
     After this step, the size of flow will be much smaller, and can be
     dumped as jpeg images.
@@ -110,6 +113,8 @@ def quantize_flow(flow, max_val=0.02, norm=True):
         max_val (float): Maximum value of flow, values beyond
                         [-max_val, max_val] will be truncated.
         norm (bool): Whether to divide flow values by image width/height.
+        dtype (np.type): Unsigned integer type of the quantized flow,
+            np.uint16 for 65535 levels.
 
     Returns:
         tuple[ndarray]: Quantized dx and dy.
@@ -121,7 +126,8 @@ def quantize_flow(flow, max_val=0.02, norm=True):
         dx = dx / w  # avoid inplace operations
         dy = dy / h
     # use 255 levels instead of 256 to make sure 0 is 0 after dequantization.
-    flow_comps = [quantize(d, -max_val, max_val, 255, np.uint8) for d in [dx, dy]]
+    levels = int(np.iinfo(dtype).max)
+    flow_comps = [quantize(d, -max_val, max_val, levels, dtype) for d in [dx, dy]]
     return tuple(flow_comps)
 
 
@@ -140,7 +146,9 @@ def dequantize_flow(dx, dy, max_val=0.02, denorm=True):
     assert dx.shape == dy.shape
     assert dx.ndim == 2 or (dx.ndim == 3 and dx.shape[-1] == 1)
 
-    dx, dy = [dequantize(d, -max_val, max_val, 255) for d in [dx, dy]]
+    # The number of levels follows from the type the flow was quantized to
+    levels = int(np.iinfo(dx.dtype).max) if np.issubdtype(dx.dtype, np.unsignedinteger) else 255
+    dx, dy = [dequantize(d, -max_val, max_val, levels) for d in [dx, dy]]
 
     if denorm:
         dx *= dx.shape[1]
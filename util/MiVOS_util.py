@@ -1,53 +1,74 @@
-from collections import deque
-
 import numpy as np
 import torch
 
 from lib.MiVOS_STCN.inference_core import InferenceCore
-from lib.MiVOS_STCN.interact.interactive_utils import images_to_torch, load_images
+from lib.MiVOS_STCN.interact.interaction import HistoryStack, max_history_bytes
+from lib.MiVOS_STCN.interact.interactive_utils import load_images
 from lib.MiVOS_STCN.interact.s2m_controller import S2MController
-from lib.MiVOS_STCN.model.fusion_net import FusionNet
-from lib.MiVOS_STCN.model.propagation.prop_net import PropagationNetwork
-from lib.MiVOS_STCN.model.s2m.s2m_network import deeplabv3plus_resnet50 as S2M
+from util.model_util import registry as default_registry, precision_policy as default_precision_policy, \
+    PrecisionPolicy, key_cache_budget as default_key_cache_budget
 from util.scribble_util import MyScribbleInteraction
 
 
 class MiVOS_Manager:
-    def __init__(self, image_folder, num_objects=1):
-        # Check if CUDA is available
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
-        # Set up models
-        prop_saved = torch.load('saves/stcn.pth', map_location=device)
-        prop_model = PropagationNetwork().to(device).eval()
-        prop_model.load_state_dict(prop_saved)
-
-        fusion_saved = torch.load('saves/fusion_stcn.pth', map_location=device)
-        fuse_model = FusionNet().to(device).eval()
-        fuse_model.load_state_dict(fusion_saved)
-
-        s2m_saved = torch.load('saves/s2m.pth', map_location=device)
-        s2m_model = S2M().to(device).eval()
-        s2m_model.load_state_dict(s2m_saved)
+    def __init__(self, images, num_objects=1, registry=None, warm_up=False, precision=None, obj_batch_size=None,
+                 s2m_roi=False, key_batch_size=None, key_cache_budget=None):
+        """
+        :param images: RGB frames as uint8 array of shape T x H x W x 3 (e.g. from a FrameStore), or a folder with
+                       frame images
+        :param warm_up: Encode the key features of all frames in the background, so the first propagation is faster
+        :param precision: PrecisionPolicy or name of a precision ('fp32', 'fp16', 'bf16', 'auto'),
+                          the process-wide policy (MIVOS_PRECISION) if None
+        :param obj_batch_size: Maximum number of objects per forward pass of S2M, propagation and fusion,
+                               all objects at once if None
+        :param s2m_roi: Run S2M only on a region around the scribble instead of the full frame, so the latency of a
+                        scribble depends on its size rather than on the resolution of the video
+        :param key_batch_size: Number of frames whose key features are encoded in one forward pass,
+                               chosen by the memory profile if None
+        :param key_cache_budget: KeyCacheBudget the key cache shares with the other sessions,
+                                 the process-wide budget (MIVOS_KEY_CACHE_MB) if None
+        """
+        # The models are shared between all sessions and only loaded once per process
+        if registry is None:
+            registry = default_registry
+        device = registry.device
+        if precision is None:
+            precision = default_precision_policy
+        elif isinstance(precision, str):
+            precision = PrecisionPolicy(precision, device)
+        self.precision = precision
+        if key_cache_budget is None:
+            key_cache_budget = default_key_cache_budget
+        prop_model = registry.get('propagation')
+        fuse_model = registry.get('fusion')
+        s2m_model = registry.get('s2m')
 
         # Loads the images/masks
-        # Set resolution=-1 to use original size
-        self.images = load_images(image_folder)
+        if isinstance(images, str):
+            images = load_images(images)
+        self.images = images
         self.num_frames, self.height, self.width = self.images.shape[:3]
         self.num_objects = num_objects
 
-        self.s2m_controller = S2MController(s2m_model, num_objects=self.num_objects, ignore_class=255, device=device)
+        self.s2m_controller = S2MController(s2m_model, num_objects=self.num_objects, ignore_class=255, device=device,
+                                            obj_batch_size=obj_batch_size, roi=s2m_roi,
+                                            inference=self.precision.inference)
 
-        self.processor = InferenceCore(prop_model, fuse_model, images_to_torch(self.images, device=device),
-                                       self.num_objects, mem_freq=5, mem_profile=0, device=device)
+        # The processor normalizes the frames on access, self.images is the only copy of the video
+        self.processor = InferenceCore(prop_model, fuse_model, self.images, self.num_objects,
+                                       mem_freq=5, mem_profile=0, device=device, memory_dtype=self.precision.dtype,
+                                       obj_batch_size=obj_batch_size, key_batch_size=key_batch_size,
+                                       key_cache_budget=key_cache_budget)
+        if warm_up:
+            # Cache the keys in the precision propagation will use them in
+            self.processor.start_warm_up(self.precision.inference)
 
         # initialize visualization
-        self.current_mask = np.zeros((self.num_frames, self.height, self.width), dtype=np.uint8)
         self.vis_map = np.zeros((self.height, self.width, 3), dtype=np.uint8)
         self.vis_alpha = np.zeros((self.height, self.width, 1), dtype=np.float32)
         self.brush_vis_map = np.zeros((self.height, self.width, 3), dtype=np.uint8)
         self.brush_vis_alpha = np.zeros((self.height, self.width, 1), dtype=np.float32)
-        self.vis_hist = deque(maxlen=100)
+        self.vis_hist = HistoryStack(max_history_bytes)
 
         # self.cursur is set to the number of the current frame we look at
         self.cursur = 0
@@ -60,12 +81,26 @@ class MiVOS_Manager:
         self.interaction = None
         self.reset_this_interaction()
         self.interacted_mask = None
+        # Frames whose mask has not been saved since it last changed outside of a propagation. All of them at first,
+        # the files in the mask folder may be missing or belong to an older session
+        self.unsaved_frames = set(range(self.num_frames))
 
     def clear_visualization(self):
         self.vis_map.fill(0)
         self.vis_alpha.fill(0)
         self.vis_hist.clear()
-        self.vis_hist.append((self.vis_map.copy(), self.vis_alpha.copy()))
+        self.push_visualization()
+
+    def push_visualization(self):
+        """
+        Pushes the visualization into the history, without a new copy if it has not changed since the last push
+        """
+        if len(self.vis_hist) > 0:
+            vis_map, vis_alpha = self.vis_hist.peek()
+            if np.array_equal(vis_map, self.vis_map) and np.array_equal(vis_alpha, self.vis_alpha):
+                self.vis_hist.push((vis_map, vis_alpha), 0)
+                return
+        self.vis_hist.push((self.vis_map.copy(), self.vis_alpha.copy()), self.vis_map.nbytes + self.vis_alpha.nbytes)
 
     def reset_this_interaction(self):
         self.complete_interaction()
@@ -73,9 +108,12 @@ class MiVOS_Manager:
         self.interaction = None
         self.this_frame_interactions = []
 
-    def on_run(self):
+    def on_run(self, total_cb=None, step_cb=None):
         """
         Propagate the masks
+        :param total_cb: Called with the number of frames that will be propagated
+        :param step_cb: Called after every propagated frame with the frame index and whether its mask changed,
+                        the mask is final at that point and can be read with get_mask
         """
 
         if self.interacted_mask is None:
@@ -83,15 +121,61 @@ class MiVOS_Manager:
             return
 
         # Create a list of propagated masks
-        with torch.cuda.amp.autocast(enabled=True) and torch.set_grad_enabled(False):
-            self.current_mask = self.processor.interact(self.interacted_mask, self.cursur)
+        with self.precision.inference():
+            self.processor.interact(self.interacted_mask, self.cursur, total_cb=total_cb, step_cb=step_cb)
 
         self.interacted_mask = None
         self.reset_this_interaction()
 
-        print('Propagation finished')
+        print('Propagation finished, key cache:', self.processor.cache_stats())
+        print('Session memory: %.1f MB' % (self.memory_footprint()['total'] / 1024 ** 2))
         return self.current_mask
 
+    @property
+    def current_mask(self):
+        """
+        Masks of all frames with the object id per pixel, a view of the processor's masks
+        """
+        return self.processor.np_masks
+
+    def memory_footprint(self):
+        """
+        :return: Memory used by the session in bytes, per buffer. The frames are shared with the caller and not
+                 included
+        """
+        footprint = self.processor.memory_footprint()
+        footprint['visualization'] = self.vis_map.nbytes + self.vis_alpha.nbytes + \
+            self.brush_vis_map.nbytes + self.brush_vis_alpha.nbytes + \
+            self.vis_hist.size
+        footprint['total'] += footprint['visualization']
+        return footprint
+
+    def close(self):
+        """
+        Stops background work of the session and frees its key cache
+        """
+        self.processor.close()
+
+    def get_mask(self, frame_num):
+        """
+        :return: The current mask of a frame with the object id per pixel
+        """
+        return self.processor.np_masks[frame_num]
+
+    @property
+    def changed_frames(self):
+        """
+        Frames whose mask changed in the last propagation
+        """
+        return self.processor.changed_frames
+
+    @property
+    def dirty_range(self):
+        """
+        Range [start, end) of the frames whose mask changed in the last propagation, None if none changed
+        """
+        return self.processor.dirty_range
+
     def on_drawn(self, drawing_points, frame_num, k):
         """
         Execute after a scribble was drawn
@@ -103,10 +187,10 @@ class MiVOS_Manager:
         self.cursur = frame_num
 
         # Push last vis map into history
-        self.vis_hist.append((self.vis_map.copy(), self.vis_alpha.copy()))
+        self.push_visualization()
 
-        prev_hard_mask = self.processor.masks[self.cursur]
-        image = self.processor.images[:, self.cursur]
+        prev_hard_mask = self.processor.get_hard_mask(self.cursur)
+        image = self.processor.get_image_buffered(self.cursur)
         h, w = self.height, self.width
         if self.interaction is None:
             self.interaction = MyScribbleInteraction(image, prev_hard_mask, (h, w), self.s2m_controller,
@@ -117,43 +201,45 @@ class MiVOS_Manager:
         interaction = self.interaction
         interaction.end_path()
 
-        with torch.cuda.amp.autocast(enabled=True) and torch.set_grad_enabled(False):
+        with self.precision.inference():
             self.interacted_mask = interaction.predict()
 
         return self.update_interacted_mask()
 
     def on_undo(self):
-        if self.interaction is None:
-            if len(self.this_frame_interactions) > 1:
-                self.this_frame_interactions = self.this_frame_interactions[:-1]
-                self.interacted_mask = self.this_frame_interactions[-1].predict()
-            else:
-                self.reset_this_interaction()
-                self.interacted_mask = self.processor.prob[:, self.cursur].clone()
-        else:
-            if self.interaction.can_undo():
-                self.interacted_mask = self.interaction.undo()
-            else:
-                if len(self.this_frame_interactions) > 0:
-                    self.interaction = None
-                    self.interacted_mask = self.this_frame_interactions[-1].predict()
+        # Interactions keep their last prediction, undo never runs S2M
+        with self.precision.inference():
+            if self.interaction is None:
+                if len(self.this_frame_interactions) > 1:
+                    self.this_frame_interactions = self.this_frame_interactions[:-1]
+                    self.interacted_mask = self.this_frame_interactions[-1].out_mask
                 else:
                     self.reset_this_interaction()
-                    self.interacted_mask = self.processor.prob[:, self.cursur].clone()
+                    self.interacted_mask = self.processor.get_prob(self.cursur)
+            else:
+                if self.interaction.can_undo():
+                    self.interacted_mask = self.interaction.undo()
+                else:
+                    if len(self.this_frame_interactions) > 0:
+                        self.interaction = None
+                        self.interacted_mask = self.this_frame_interactions[-1].out_mask
+                    else:
+                        self.reset_this_interaction()
+                        self.interacted_mask = self.processor.get_prob(self.cursur)
 
         # Update visualization
         if len(self.vis_hist) > 0:
             # Might be empty if we are undoing the entire interaction
-            self.vis_map, self.vis_alpha = self.vis_hist.pop()
+            # The entry may be shared with older entries, copy it before it can be modified
+            self.vis_map, self.vis_alpha = (v.copy() for v in self.vis_hist.pop())
 
         # Commit changes
         return self.update_interacted_mask()
 
     def on_reset(self):
         # DO not edit prob -- we still need the mask diff
-        self.processor.masks[self.cursur].zero_()
         self.processor.np_masks[self.cursur].fill(0)
-        self.current_mask[self.cursur].fill(0)
+        self.unsaved_frames.add(self.cursur)
         self.reset_this_interaction()
         # return self.current_mask[self.cursur]
 
@@ -164,7 +250,6 @@ class MiVOS_Manager:
         """
 
         self.processor.update_mask_only(self.interacted_mask, self.cursur)
-        self.current_mask[self.cursur] = self.processor.np_masks[self.cursur]
         return self.current_mask[self.cursur]
 
     def complete_interaction(self):
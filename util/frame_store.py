@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+FRAMES_FILE = 'frames.bin'
+META_FILE = 'meta.json'
+
+
+class FrameStoreWriter:
+    """
+    Streams frames into a new frame store, one frame at a time
+    """
+
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.num_frames = 0
+        self.height = None
+        self.width = None
+        self._file = open(os.path.join(folder, FRAMES_FILE), 'wb')
+
+    def append(self, frame):
+        """
+        :param frame: RGB frame as uint8 array of shape H x W x 3, all frames must have the same size
+        """
+        if self.height is None:
+            self.height, self.width = frame.shape[:2]
+        elif frame.shape[:2] != (self.height, self.width):
+            raise ValueError('All frames must have the same size')
+        self._file.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        self.num_frames += 1
+
+    def close(self, fps):
+        """
+        Finishes writing and opens the store
+        :param fps: Frame rate of the frames
+        :return: The FrameStore
+        """
+        self._file.close()
+        if self.num_frames == 0:
+            raise ValueError('Video contains no frames')
+        meta = {'num_frames': self.num_frames, 'height': self.height, 'width': self.width, 'fps': fps}
+        with open(os.path.join(self.folder, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        return FrameStore(self.folder)
+
+    def abort(self):
+        self._file.close()
+
+
+class FrameStore:
+    """
+    All frames of a video in a single memory-mapped uint8 array of shape T x H x W x 3 (RGB), plus a json file with
+    the metadata. MiVOS, ProPainter and the video encoder read the array directly, PNGs are only encoded for the
+    browser and cached until the frame is overwritten.
+    """
+
+    def __init__(self, folder, png_cache_bytes=64 * 1024 ** 2):
+        self.folder = folder
+        with open(os.path.join(folder, META_FILE)) as f:
+            meta = json.load(f)
+        self.num_frames = meta['num_frames']
+        self.height = meta['height']
+        self.width = meta['width']
+        self.fps = meta['fps']
+        self.frames = np.memmap(os.path.join(folder, FRAMES_FILE), dtype=np.uint8, mode='r+',
+                                shape=(self.num_frames, self.height, self.width, 3))
+
+        self.png_cache_bytes = png_cache_bytes
+        self._png_cache = OrderedDict()
+        self._png_cache_size = 0
+        # Incremented on every write, so a PNG encoded from a frame that was overwritten meanwhile is not cached
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create(folder):
+        """
+        :return: A FrameStoreWriter for a new store in folder
+        """
+        return FrameStoreWriter(folder)
+
+    @staticmethod
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, META_FILE))
+
+    def __len__(self):
+        return self.num_frames
+
+    @property
+    def generation(self):
+        """
+        Incremented whenever frames are overwritten, identifies the current content of the store
+        """
+        return self._generation
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+    def write(self, idx, frame):
+        """
+        Overwrites a single frame
+        :param frame: RGB frame as uint8 array of shape H x W x 3
+        """
+        self.frames[idx] = frame
+        self._invalidate(idx)
+
+    def write_all(self, frames):
+        """
+        Overwrites every frame, e.g. with the inpainted result, and starts a new generation.
+        Views of the frames see the new pixels, so anything computed from them (MiVOS sessions, key caches,
+        precomputed flows) has to be dropped before and recomputed after
+        :param frames: RGB frames as uint8 arrays of shape H x W x 3
+        """
+        for idx, frame in enumerate(frames):
+            self.frames[idx] = frame
+        self.frames.flush()
+        with self._lock:
+            self._generation += 1
+            self._png_cache.clear()
+            self._png_cache_size = 0
+
+    def get_png(self, idx):
+        """
+        :return: The frame encoded as PNG
+        """
+        with self._lock:
+            png = self._png_cache.get(idx)
+            if png is not None:
+                self._png_cache.move_to_end(idx)
+                return png
+            generation = self._generation
+
+        _, png = cv2.imencode('.png', cv2.cvtColor(self.frames[idx], cv2.COLOR_RGB2BGR))
+        png = png.tobytes()
+
+        with self._lock:
+            if generation == self._generation and idx not in self._png_cache:
+                self._png_cache[idx] = png
+                self._png_cache_size += len(png)
+            while self._png_cache_size > self.png_cache_bytes and len(self._png_cache) > 1:
+                _, old = self._png_cache.popitem(last=False)
+                self._png_cache_size -= len(old)
+        return png
+
+    def _invalidate(self, idx):
+        with self._lock:
+            self._generation += 1
+            png = self._png_cache.pop(idx, None)
+            if png is not None:
+                self._png_cache_size -= len(png)
@@ -4,92 +4,76 @@ from io import BytesIO
 import cv2
 import numpy as np
 from PIL import Image
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
+from util.frame_store import FrameStore
 
-def convert_to_mp4(file_path):
-    """
-    Converts a saved video file to mp4 and deletes the original file
-
-    :param file_path: The path to the video
-    :return: The filename with a mp4 ending
-    """
-
-    video_name, extension = os.path.splitext(file_path)
-    # Return if file is already an mp4
-    if extension == '.mp4':
-        return file_path
-
-    video = VideoFileClip(file_path)
-    output_filepath = video_name + '.mp4'
-    video.write_videofile(output_filepath)
-
-    video.close()
-    os.remove(file_path)  # Delete original file
-    return output_filepath
-
-
-def reduce_fps(file_path, target_fps=30):
-    video = VideoFileClip(file_path)
-    video_name, extension = os.path.splitext(file_path)
-    if video.fps > target_fps:
-        output_path = video_name + '_' + str(target_fps) + extension
-        video.set_fps(target_fps).write_videofile(output_path, fps=target_fps, codec='libx264')
 
-        video.close()
-        os.remove(file_path)  # Delete original file
-        return output_path
-    else:
-        return file_path
-
-
-def resize_and_save_frames(video_path, output_folder, new_height=360):
+def ingest_video(video_path, output_folder, new_height=360, target_fps=30):
     """
-    Saves every frame of an uploaded video and reduces its resolution
+    Decodes an uploaded video once, drops frames to reduce the frame rate to target_fps, reduces the resolution and
+    streams the remaining frames into a frame store.
+    Frames are selected by their decoded timestamps, so variable frame rate videos and containers that report no or
+    a wrong frame rate are sampled correctly. The stored fps is derived from the timestamps of the kept frames.
 
-    :param new_height: New resolution of the video
     :param video_path: Path from root to the video
-    :param output_folder: Path from root to the folder that should contain the frames
+    :param output_folder: Path from root to the folder of the frame store
+    :param new_height: New resolution of the video
+    :param target_fps: Maximum frame rate of the saved frames
+    :return: The FrameStore, which knows the number of saved frames and their fps
     """
-    os.makedirs(output_folder, exist_ok=True)
-
     cap = cv2.VideoCapture(video_path)
-    frame_count = 0
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            original_height, original_width = frame.shape[:2]
+    if not cap.isOpened():
+        raise ValueError('Unable to open video')
+    source_fps = cap.get(cv2.CAP_PROP_FPS)
+    if not source_fps or source_fps <= 0 or np.isnan(source_fps) or source_fps > 1000:
+        # Some containers (e.g. gif) report no or a bogus frame rate
+        source_fps = target_fps
+    step = 1 / target_fps
+
+    writer = FrameStore.create(output_folder)
+    kept_times = []
+    try:
+        last_time = None
+        next_time = None
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if last_time is not None and not timestamp > last_time:
+                # The backend reports no (or non-increasing) timestamps, fall back to the reported frame rate
+                timestamp = last_time + 1 / source_fps
+            last_time = timestamp
+
+            # Keep a frame whenever its timestamp reaches the next sample time of the output frame rate
+            if next_time is not None and timestamp + 1e-6 < next_time:
+                continue
+            if next_time is None:
+                next_time = timestamp
+            # Skip the sample times of a gap in a variable frame rate video instead of keeping a burst of frames
+            while next_time <= timestamp + 1e-6:
+                next_time += step
+            kept_times.append(timestamp)
 
+            original_height, original_width = frame.shape[:2]
             # Resize frame
             if original_height > new_height:
                 aspect_ratio = original_width / original_height
                 new_width = int(aspect_ratio * new_height)
-                resized_frame = cv2.resize(frame, (new_width, new_height))
-            else:
-                resized_frame = frame
+                frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
 
-            frame_path = os.path.join(output_folder, '{:05}.png'.format(frame_count))
-            cv2.imwrite(frame_path, resized_frame)
-            frame_count += 1
-        else:
-            break
-    cap.release()
-    cv2.destroyAllWindows()
+            writer.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        cap.release()
 
-
-def get_video_info(video_path):
-    """
-    :param video_path: Path from root to the video
-    :return: Number of frames and fps of a video
-    """
-    video = cv2.VideoCapture(video_path)
-    if not video.isOpened():
-        print("Error: Unable to open video.")
-        return None
-    num_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = video.get(cv2.CAP_PROP_FPS)
-    video.release()
-    return num_frames, fps
+    if len(kept_times) > 1 and kept_times[-1] > kept_times[0]:
+        fps = (len(kept_times) - 1) / (kept_times[-1] - kept_times[0])
+    else:
+        fps = min(source_fps, target_fps)
+    return writer.close(fps)
 
 
 def array_to_bytesio(image_array):
@@ -106,21 +90,25 @@ def array_to_bytesio(image_array):
     return img_io
 
 
+# Color per object id, 0 is the background
+COLOR_MAP = [
+    [0, 0, 0],
+    [255, 0, 0],
+    [0, 255, 0],
+    [0, 0, 255],
+    [255, 0, 255],
+    [0, 255, 255],
+    [255, 255, 0],
+]
+
+
 def compose_mask(mask):
     """
     Makes an image where the mask is colored and slightly transparent
     :param mask: a 1-channel image with 1 where the mask is
     :return: the composed mask as an array
     """
-    color_map = [
-        [0, 0, 0],
-        [255, 0, 0],
-        [0, 255, 0],
-        [0, 0, 255],
-        [255, 0, 255],
-        [0, 255, 255],
-        [255, 255, 0],
-    ]
+    color_map = COLOR_MAP
     color_map_np = np.array(color_map)
     colored_image = np.zeros((mask.shape[0], mask.shape[1], 4), dtype=np.uint8)
 
@@ -130,3 +118,20 @@ def compose_mask(mask):
     colored_image[mask >= 1, 3] = 128
 
     return colored_image
+
+
+def mask_to_png(mask):
+    """
+    Encodes a mask as a palette PNG that looks like the composed mask, but is much smaller
+    :param mask: a 1-channel image with the object id per pixel
+    :return: BytesIO with the PNG
+    """
+    image = Image.fromarray(mask.astype(np.uint8), mode='P')
+    image.putpalette([c for color in COLOR_MAP for c in color])
+    # Background is fully transparent, objects are half transparent like in compose_mask
+    transparency = bytes([0] + [128] * (len(COLOR_MAP) - 1))
+
+    img_io = BytesIO()
+    image.save(img_io, 'PNG', transparency=transparency)
+    img_io.seek(0)
+    return img_io
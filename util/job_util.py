@@ -0,0 +1,246 @@
+import contextlib
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+
+class JobError(Exception):
+    """
+    Raised inside a job to fail it with a message and an HTTP status code for the client
+    """
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class JobConflict(Exception):
+    """
+    Raised when a different job is still running for the same video
+    """
+
+    def __init__(self, job):
+        super().__init__('Job ' + job.id + ' is still running')
+        self.job = job
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+    def __init__(self, key, kind):
+        self.id = str(uuid.uuid4())
+        self.key = key
+        self.kind = kind
+        self.status = Job.QUEUED
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.status_code = 200
+        self.timestamp = datetime.utcnow()
+        # Monotonic times the job finished and the client received its result at
+        self.finished_at = None
+        self.fetched_at = None
+        # Partial results (e.g. finished masks) that are streamed to the client while the job runs
+        self.events = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def set_total(self, total):
+        """
+        Progress callback, called once with the number of steps of the job
+        """
+        with self._lock:
+            self.total = total
+            self.done = 0
+
+    def step(self, *args):
+        """
+        Progress callback, called after every finished step
+        """
+        with self._lock:
+            self.done += 1
+            self._changed.notify_all()
+
+    def add_event(self, event):
+        """
+        Publishes a partial result
+        :param event: A small json serializable dict. Events are kept until the job expires, so large results
+                      (e.g. masks) should be referenced by url instead of included
+        """
+        with self._lock:
+            self.events.append(event)
+            self._changed.notify_all()
+
+    def set_status(self, status):
+        with self._lock:
+            self.status = status
+            if status in (Job.FINISHED, Job.FAILED):
+                self.finished_at = time.monotonic()
+            self._changed.notify_all()
+
+    def wait_for_events(self, start, timeout=15):
+        """
+        Blocks until there are events after start, the job has finished or the timeout has passed
+
+        :param start: Number of events the caller has already seen
+        :return: The new events and whether the job is still active
+        """
+        with self._lock:
+            if len(self.events) <= start and self.active:
+                self._changed.wait(timeout)
+            return self.events[start:], self.active
+
+    @property
+    def active(self):
+        return self.status in (Job.QUEUED, Job.RUNNING)
+
+    def to_dict(self):
+        with self._lock:
+            info = {'job_id': self.id, 'kind': self.kind, 'status': self.status,
+                    'done': self.done, 'total': self.total}
+        if self.status == Job.FAILED:
+            info['error'] = self.error
+        return info
+
+
+class JobQueue:
+    """
+    Runs long requests (propagation, inpainting) on a bounded pool of background workers.
+    At most one job per key (video id) is active at any time.
+    Finished jobs are forgotten fetched_ttl seconds after their result was fetched, or after ttl seconds.
+    """
+
+    def __init__(self, max_workers=2, max_pending=16, ttl=600, fetched_ttl=60):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.fetched_ttl = fetched_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = {}
+        # key -> lock held while a request changes the state of the key, see exclusive. Reentrant, so that a request
+        # can submit a job from inside its exclusive section
+        self._key_locks = {}
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.RLock()
+            return lock
+
+    @contextlib.contextmanager
+    def exclusive(self, key):
+        """
+        Context manager for requests that change the state a job of key works on.
+        Requests on the same key run one after another and no other request can submit a job for key meanwhile.
+        Calling submit inside the section queues a job based on the state checked in it.
+
+        :raises JobConflict: If a job is active for key
+        """
+        with self._key_lock(key):
+            with self._lock:
+                active_job = self._active.get(key)
+            if active_job is not None:
+                raise JobConflict(active_job)
+            yield
+
+    def submit(self, key, kind, fn, *args, **kwargs):
+        """
+        Queues fn(job, *args, **kwargs), its return value becomes the result of the job
+
+        :param key: Identifier of the resource the job works on, e.g. the video id
+        :param kind: Type of the job, e.g. 'propagate'
+        :return: The new job, or the active job if the same kind of job is already running for this key
+        """
+        self.expire()
+        # Waits for a request that is changing the state of the key
+        with self._key_lock(key), self._lock:
+            active_job = self._active.get(key)
+            if active_job is not None:
+                if active_job.kind == kind:
+                    return active_job
+                raise JobConflict(active_job)
+            num_pending = sum(1 for j in self._active.values() if j.status == Job.QUEUED)
+            if num_pending >= self.max_pending:
+                raise QueueFull()
+
+            job = Job(key, kind)
+            self._jobs[job.id] = job
+            self._active[key] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.set_status(Job.RUNNING)
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.set_status(Job.FINISHED)
+        except JobError as e:
+            job.error = e.message
+            job.status_code = e.status_code
+            job.set_status(Job.FAILED)
+        except Exception as e:
+            print('Error in ' + job.kind + ' job: ', e)
+            traceback.print_exc()
+            job.error = 'Internal error'
+            job.status_code = 500
+            job.set_status(Job.FAILED)
+        finally:
+            with self._lock:
+                if self._active.get(job.key) is job:
+                    del self._active[job.key]
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def mark_fetched(self, job):
+        """
+        Called once the client has received the result of a finished job, the job expires after fetched_ttl
+        """
+        if not job.active and job.fetched_at is None:
+            job.fetched_at = time.monotonic()
+
+    def expire(self):
+        """
+        Forgets finished jobs whose result was fetched fetched_ttl seconds ago, or that finished ttl seconds ago
+        """
+        now = time.monotonic()
+
+        def is_expired(job):
+            if job.active or job.finished_at is None:
+                return False
+            if job.fetched_at is not None and now - job.fetched_at > self.fetched_ttl:
+                return True
+            return now - job.finished_at > self.ttl
+
+        with self._lock:
+            expired = [i for i, j in self._jobs.items() if is_expired(j)]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def is_active(self, key):
+        with self._lock:
+            return key in self._active
+
+    def discard(self, key):
+        """
+        Forgets all finished jobs of a key, e.g. when the video is deleted
+        """
+        with self._lock:
+            for job_id in [i for i, j in self._jobs.items() if j.key == key and not j.active]:
+                del self._jobs[job_id]
+            if key not in self._active:
+                self._key_locks.pop(key, None)
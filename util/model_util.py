@@ -0,0 +1,197 @@
+import contextlib
+import os
+import threading
+import time
+
+import torch
+
+from lib.MiVOS_STCN.inference_core import KeyCacheBudget
+from lib.MiVOS_STCN.model.fusion_net import FusionNet
+from lib.MiVOS_STCN.model.propagation.prop_net import PropagationNetwork
+from lib.MiVOS_STCN.model.s2m.s2m_network import deeplabv3plus_resnet50 as S2M
+
+
+def get_default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def module_size_in_bytes(module):
+    """
+    :param module: A torch module
+    :return: The memory used by the parameters and buffers of the module
+    """
+    num_bytes = sum(p.numel() * p.element_size() for p in module.parameters())
+    num_bytes += sum(b.numel() * b.element_size() for b in module.buffers())
+    return num_bytes
+
+
+def load_checkpoint(model, checkpoint_path, device):
+    """
+    Loads a checkpoint into a model and turns it into a read-only module for inference
+
+    :param model: The constructed network
+    :param checkpoint_path: Path to the saved state dict
+    :param device: Device the model should be moved to
+    :return: The model in eval mode, without gradients
+    """
+    saved = torch.load(checkpoint_path, map_location=device)
+    model = model.to(device).eval()
+    model.load_state_dict(saved)
+    for p in model.parameters():
+        p.requires_grad = False
+    return model
+
+
+def warm_up_propagation(model, device):
+    image = torch.zeros((1, 3, 128, 128), device=device)
+    mask = torch.zeros((1, 1, 128, 128), device=device)
+    k16, qv16, qf16, qf8, qf4 = model.encode_key(image)
+    value = model.encode_value(image, qf16, mask)
+    model.segment_with_query(k16.unsqueeze(2), value, qf8, qf4, k16, qv16)
+
+
+def warm_up_fusion(model, device):
+    model(torch.zeros((1, 3, 128, 128), device=device), torch.zeros((1, 1, 128, 128), device=device),
+          torch.zeros((1, 1, 128, 128), device=device), torch.zeros((1, 2, 128, 128), device=device),
+          torch.zeros((1, 2), device=device))
+
+
+def warm_up_s2m(model, device):
+    # Image, previous mask, positive and negative scribbles
+    model(torch.zeros((1, 6, 128, 128), device=device))
+
+
+class PrecisionPolicy:
+    """
+    Working precision of the MiVOS networks (propagation, fusion and S2M) and of the memory bank.
+
+    fp32 - Full precision, the default
+    fp16 - Autocast to float16, GPU only
+    bf16 - Autocast to bfloat16, on CPU or GPU
+    auto - fp16 on GPU, bf16 on CPU
+    """
+    PRECISIONS = ('fp32', 'fp16', 'bf16', 'auto')
+
+    def __init__(self, precision='fp32', device=None):
+        if precision not in PrecisionPolicy.PRECISIONS:
+            raise ValueError('Unknown precision ' + str(precision) + ', choose one of ' +
+                             ', '.join(PrecisionPolicy.PRECISIONS))
+        self.device_type = torch.device(device if device is not None else get_default_device()).type
+        if precision == 'auto':
+            precision = 'fp16' if self.device_type == 'cuda' else 'bf16'
+        if precision == 'fp16' and self.device_type != 'cuda':
+            raise ValueError('fp16 is only supported on the GPU, use bf16 on the CPU')
+        self.precision = precision
+        self.dtype = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+
+    @property
+    def enabled(self):
+        return self.precision != 'fp32'
+
+    def autocast(self):
+        """
+        :return: Context manager running the enclosed inference in the policy's precision
+        """
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def inference(self):
+        """
+        :return: Context manager for inference, autocast and no gradients
+        """
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.no_grad())
+        stack.enter_context(self.autocast())
+        return stack
+
+    def __repr__(self):
+        return 'PrecisionPolicy(' + self.precision + ', ' + self.device_type + ')'
+
+
+class ModelRegistry:
+    """
+    Process-wide registry for the networks used by every session.
+    Each network is loaded once (on first use or in warm_up) and the same read-only module is handed to every
+    caller, so creating a new session does not hit the disk or allocate new weights.
+    """
+
+    def __init__(self, device=None):
+        self.device = device if device is not None else get_default_device()
+        self._lock = threading.Lock()
+        self._loaders = {}
+        self._models = {}
+        # name -> {'load_time': seconds, 'warm_up_time': seconds, 'memory': bytes}
+        self.stats = {}
+
+    def register(self, name, loader, warm_up=None):
+        """
+        :param name: Name under which the model can be requested
+        :param loader: Function taking the device and returning the loaded model
+        :param warm_up: Optional function taking the model and the device that runs a dummy forward pass
+        """
+        self._loaders[name] = (loader, warm_up)
+
+    def get(self, name):
+        """
+        Returns the shared model, loading it first if this is the first request
+        """
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._lock:
+            # Another thread might have loaded the model while we were waiting
+            if name not in self._models:
+                loader, _ = self._loaders[name]
+                start_time = time.time()
+                model = loader(self.device)
+                self._models[name] = model
+                self.stats[name] = {'load_time': time.time() - start_time,
+                                    'warm_up_time': 0.0,
+                                    'memory': module_size_in_bytes(model)}
+            return self._models[name]
+
+    def warm_up(self, names=None):
+        """
+        Loads the models and runs a forward pass through each of them, so that the first user request does not
+        pay for lazy initialisation of the backend
+
+        :param names: Models to warm up, all registered models if None
+        """
+        if names is None:
+            names = list(self._loaders.keys())
+        for name in names:
+            model = self.get(name)
+            _, warm_up = self._loaders[name]
+            if warm_up is None:
+                continue
+            start_time = time.time()
+            with precision_policy.inference():
+                warm_up(model, self.device)
+            self.stats[name]['warm_up_time'] = time.time() - start_time
+
+    def report(self):
+        """
+        :return: A printable summary of load time and memory per model
+        """
+        lines = []
+        for name, stats in self.stats.items():
+            lines.append(f'{name.ljust(12)} load: {stats["load_time"]:.2f}s, '
+                         f'warm-up: {stats["warm_up_time"]:.2f}s, '
+                         f'memory: {stats["memory"] / 1024 ** 2:.1f} MB')
+        return '\n'.join(lines)
+
+
+registry = ModelRegistry()
+# Set MIVOS_PRECISION to fp16, bf16 or auto to run the MiVOS networks in reduced precision
+precision_policy = PrecisionPolicy(os.environ.get('MIVOS_PRECISION', 'fp32'), registry.device)
+# Memory all MiVOS key caches of the process may use together, set MIVOS_KEY_CACHE_MB to change it
+key_cache_budget = KeyCacheBudget(int(os.environ.get('MIVOS_KEY_CACHE_MB', 2048)) * 1024 ** 2)
+registry.register('propagation',
+                  lambda device: load_checkpoint(PropagationNetwork(), 'saves/stcn.pth', device),
+                  warm_up_propagation)
+registry.register('fusion',
+                  lambda device: load_checkpoint(FusionNet(), 'saves/fusion_stcn.pth', device),
+                  warm_up_fusion)
+registry.register('s2m',
+                  lambda device: load_checkpoint(S2M(), 'saves/s2m.pth', device),
+                  warm_up_s2m)